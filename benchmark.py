@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Performance measurements for the game. Run from the repository root:
+
+    python benchmark.py headless --ticks 20000
+"""
+
+
+import argparse
+import copy
+import gc
+import os
+import random
+import sys
+import time
+
+import pygame
+
+from bomberman import (
+    HeadlessContext, ClassicGame, DuelGame, AssetManager, ASSET_FILES, TIME_STEP,
+    Level, BlockMatrix, Block, Enemy, Player, SpatialIndex, FlowField, DangerMap,
+    Bomb, CenterFlame, HorizontalFlame, VerticalFlame, Bot, Bots, Replay,
+    Renderer, LEVEL_BACKGROUND, window_size,
+)
+
+
+def open_display(window=False, size=(650, 780)):
+    if not window:
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    pygame.init()
+    return pygame.display.set_mode(size)
+
+
+# Holds a random movement key for a random number of ticks and now and
+# then drops a bomb, for every player of the game it drives.
+class RandomKeys:
+    def __init__(self, seed=None, hold_ticks=(5, 40), bomb_chance=0.02):
+        self.rng = random.Random(seed)
+        self.hold_ticks = hold_ticks
+        self.bomb_chance = bomb_chance
+        self.holding = {}
+
+    def __call__(self, ctx):
+        for i, player in enumerate(ctx.game.level.players):
+            key, ticks = self.holding.get(i, (None, 0))
+            if ticks <= 0:
+                if key is not None:
+                    ctx.release(key)
+                direction = self.rng.choice(['up', 'down', 'left', 'right', None])
+                key = player.controls[direction] if direction is not None else None
+                if key is not None:
+                    ctx.press(key)
+                ticks = self.rng.randint(*self.hold_ticks)
+            self.holding[i] = key, ticks - 1
+
+            bomb_key = player.controls['place_bomb']
+            ctx.release(bomb_key)
+            if self.rng.random() < self.bomb_chance:
+                ctx.press(bomb_key)
+
+
+def bench_headless(args):
+    for game_class in [ClassicGame, DuelGame]:
+        controller = RandomKeys(args.seed)
+        ticks = 0
+        rounds = 0
+        start = time.perf_counter()
+        while ticks < args.ticks:
+            ctx = HeadlessContext(game_class, seed=controller.rng.getrandbits(64))
+            ctx.run(args.ticks - ticks, controller)
+            ticks += ctx.ticks
+            rounds += ctx.menu.is_open
+            controller.holding.clear()
+        elapsed = time.perf_counter() - start
+        print('{:12s} {:8d} ticks  {:7.3f} s  {:10.0f} ticks/s  {} games over'.format(
+            game_class.__name__, ticks, elapsed, ticks/elapsed, rounds,
+        ))
+
+
+def bench_assets(args):
+    screen = open_display(args.window)
+
+    assets = AssetManager(ASSET_FILES)
+    assets.preload()
+    print(assets.report())
+
+    raw = [pygame.image.load(ASSET_FILES[k]) for k in ['grass', 'wall', 'box', 'powerup_life']]
+    converted = [assets[k] for k in ['grass', 'wall', 'box', 'powerup_life']]
+    # One board's worth of tiles per frame
+    for name, imgs in [('unconverted', raw), ('converted', converted)]:
+        start = time.perf_counter()
+        for _ in range(args.frames):
+            for i in range(169):
+                screen.blit(imgs[i % len(imgs)], ((i % 13)*50, (i // 13)*50 + 130))
+        elapsed = time.perf_counter() - start
+        print('{:12s} blits: {:7.3f} ms per 169-tile frame'.format(name, elapsed/args.frames*1000))
+
+
+# A default board with `n` enemies spread over its grass tiles and a
+# player standing still in a corner. With `chase` they go after the player.
+def crowded_level(n, swarm, seed=0, chase=False):
+    rng = random.Random(seed)
+    ctx = HeadlessContext(ClassicGame, seed=seed)
+    game = ctx.game
+    matrix = BlockMatrix()
+    cells = [
+      (x, y) for y in range(matrix.height) for x in range(matrix.width)
+      if matrix.get_block(x, y) == Block.GRASS and x + y > 4
+    ]
+    enemies = [
+      Enemy(game, *rng.choice(cells), rng.choice(['up', 'down', 'left', 'right']))
+      for _ in range(n)
+    ]
+    players = [Player(game, 1, 1)]
+    game.level = Level(None, matrix, players, enemies, swarm=swarm)
+    if chase:
+        game.level.flow = FlowField()
+    return game.level
+
+
+def bench_enemies(args):
+    for n in args.counts:
+        results = []
+        for swarm in [False, True]:
+            lvl = crowded_level(n, swarm, chase=args.chase)
+            start = time.perf_counter()
+            for _ in range(args.ticks):
+                lvl.loop(1/30)
+            elapsed = time.perf_counter() - start
+            results.append(elapsed/args.ticks*1000)
+        print('{:6d} enemies: {:8.3f} ms/tick one by one, {:8.3f} ms/tick as a swarm'.format(n, *results))
+
+
+def bench_snapshot(args):
+    for game_class in [ClassicGame, DuelGame]:
+        ctx = HeadlessContext(game_class, seed=args.seed)
+        controller = RandomKeys(args.seed, bomb_chance=0.05)
+        for _ in range(args.warmup):
+            controller(ctx)
+            ctx.tick()
+        game = ctx.game
+
+        start = time.perf_counter()
+        for _ in range(args.times):
+            state = game.snapshot()
+        snapshot = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(args.times):
+            game.restore(state)
+        restore = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(min(args.times, 100)):
+            copy.deepcopy(game.level)
+        deepcopy = (time.perf_counter() - start)/min(args.times, 100)
+        print('{:12s} snapshot {:6.1f} us  restore {:6.1f} us  (deepcopy of the level {:7.1f} us)'.format(
+            game_class.__name__, snapshot/args.times*1e6, restore/args.times*1e6, deepcopy*1e6,
+        ))
+
+
+# Bombs of each radius going off one at a time at random places of an
+# empty board, with their flames cleared away after each one
+def bench_explosions(args):
+    rng = random.Random(args.seed)
+    ctx = HeadlessContext(ClassicGame, seed=args.seed, board_size=(args.size, args.size))
+    matrix = BlockMatrix(size=(args.size, args.size))
+    cells = [
+      (x, y) for y in range(matrix.height) for x in range(matrix.width)
+      if matrix.get_block(x, y) == Block.GRASS
+    ]
+    lvl = Level(None, matrix, [Player(ctx.game, 1, 1)])
+    for radius in args.radii:
+        flames = 0
+        start = time.perf_counter()
+        for _ in range(args.times):
+            x, y = rng.choice(cells)
+            lvl.explode(x, y, radius)
+            flames += len(lvl.flames)
+            lvl.flames = {}
+            lvl.flame_index = SpatialIndex()
+        elapsed = time.perf_counter() - start
+        print('radius {:3d}: {:7.1f} us per explosion, {:5.1f} flames'.format(
+            radius, elapsed/args.times*1e6, flames/args.times,
+        ))
+
+
+# Bytes taken by an object, counting its __dict__ if it has one
+def object_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+# Size of each kind of entity, then garbage collections and the time
+# they took while bombs go off all over an empty board
+def bench_entities(args):
+    rng = random.Random(args.seed)
+    ctx = HeadlessContext(ClassicGame, seed=args.seed)
+    game = ctx.game
+    samples = [
+      Bomb(1, 1, None, 2, 3), CenterFlame(1, 1, 0.5), HorizontalFlame(1, 1, 2, 0.5, True),
+      VerticalFlame(1, 1, 2, 0.5, True), Enemy(game, 1, 1, 'up'), Player(game, 1, 1),
+    ]
+    for entity in samples:
+        print('{:16s} {:4d} bytes'.format(type(entity).__name__, object_size(entity)))
+
+    size = (args.size, args.size)
+    matrix = BlockMatrix(size=size)
+    cells = [
+      (x, y) for y in range(matrix.height) for x in range(matrix.width)
+      if matrix.get_block(x, y) == Block.GRASS
+    ]
+    # Out of the level, so the flames don't kill it
+    placer = Player(game, 1, 1, bomb_blast_radius=args.radius)
+    lvl = Level(None, matrix, [])
+    pauses = []
+    def on_gc(phase, info):
+        if phase == 'start':
+            pauses.append(time.perf_counter())
+        else:
+            pauses[-1] = time.perf_counter() - pauses[-1]
+    flames = 0
+    before = [s['collections'] for s in gc.get_stats()]
+    gc.callbacks.append(on_gc)
+    start = time.perf_counter()
+    for _ in range(args.ticks):
+        for _ in range(args.bombs):
+            lvl.try_place_bomb(*rng.choice(cells), placer)
+        count = len(lvl.flames)
+        lvl.loop(TIME_STEP)
+        flames += max(0, len(lvl.flames) - count)
+    elapsed = time.perf_counter() - start
+    gc.callbacks.remove(on_gc)
+    after = [s['collections'] for s in gc.get_stats()]
+    print('{} ticks in {:.2f} s ({:.0f} ticks/s, about {} flames made)'.format(
+        args.ticks, elapsed, args.ticks/elapsed, flames,
+    ))
+    print('collections by generation {}, {:.1f} ms collecting'.format(
+        [a - b for a, b in zip(after, before)], sum(pauses)*1000,
+    ))
+
+
+# Keeping the danger map up to date while bombs are placed all over a
+# board with boxes, against working it out from scratch every tick
+def bench_danger(args):
+    ctx = HeadlessContext(ClassicGame, seed=args.seed)
+    size = (args.size, args.size)
+    for fresh in [False, True]:
+        rng = random.Random(args.seed)
+        lvl = Level.generate_singleplayer(
+          ctx.game, None, enemies_limits=[0, 0], boxes_limits=[40, 60],
+          size=size, rng=random.Random(args.seed),
+        )
+        matrix = lvl.matrix
+        cells = [
+          (x, y) for y in range(matrix.height) for x in range(matrix.width)
+          if matrix.get_block(x, y) == Block.GRASS
+        ]
+        placer = Player(ctx.game, 1, 1, bomb_blast_radius=args.radius)
+        updating = 0
+        start = time.perf_counter()
+        for _ in range(args.ticks):
+            for _ in range(args.bombs):
+                lvl.try_place_bomb(*rng.choice(cells), placer)
+            lvl.loop(TIME_STEP)
+            t = time.perf_counter()
+            if fresh:
+                danger = DangerMap(matrix)
+                danger.reset(lvl.bombs.values())
+            else:
+                danger = lvl.danger
+            danger.blast_times()
+            updating += time.perf_counter() - t
+        elapsed = time.perf_counter() - start
+        print('{:12s} {:7.3f} ms/tick keeping the map, {:7.3f} ms/tick in all ({} bombs on the board)'.format(
+            'from scratch' if fresh else 'incremental', updating/args.ticks*1000, elapsed/args.ticks*1000,
+            len(lvl.bombs),
+        ))
+
+
+# `n` bots in one level on a board with boxes, all against each other,
+# and how long they take a tick against the budget they share. Fails if
+# more than 1% of the ticks (the 99th percentile) go over the budget. A
+# tick now and then is let through, as the machine can hold up any one of
+# them by more than the whole budget, which no bot can do anything about.
+def bench_bots(args):
+    ctx = HeadlessContext(DuelGame, seed=args.seed)
+    game = ctx.game
+    size = (args.size, args.size)
+    over = False
+    for n in args.counts:
+        rng = random.Random(args.seed)
+        matrix = BlockMatrix(size=size)
+        cells = [
+          (x, y) for y in range(matrix.height) for x in range(matrix.width)
+          if matrix.get_block(x, y) == Block.GRASS
+        ]
+        rng.shuffle(cells)
+        starts, cells = cells[:n], cells[n:]
+        for x, y in cells[:len(cells)//3]:
+            matrix.set_block(x, y, Block.BOX)
+        # Keys of their own, so the bots don't press each other's
+        players = [
+          Player(game, x, y, controls={name: (i, name) for name in Replay.ACTIONS})
+          for i, (x, y) in enumerate(starts)
+        ]
+        game.level = Level(None, matrix, players)
+        bots = Bots([Bot(i) for i in range(n)], args.budget/1000)
+        durations = []
+        for _ in range(args.ticks):
+            start = time.thread_time()
+            bots.step(game)
+            durations.append(time.thread_time() - start)
+            game.level.loop(TIME_STEP)
+        durations.sort()
+        p99 = durations[int(len(durations)*0.99)]*1000
+        print('{:4d} bots: CPU ms/tick p50 {:6.3f} p99 {:6.3f} max {:6.3f} (budget {}, {} ticks over), {} still alive'.format(
+            n, durations[len(durations)//2]*1000, p99, durations[-1]*1000, args.budget,
+            sum(d*1000 > args.budget for d in durations), sum(p.alive for p in players),
+        ))
+        over = over or p99 > args.budget
+    if over:
+        sys.exit('the bots went over their budget')
+
+
+# Random duels on boards bigger than the screen, drawn every tick, checking
+# that every living player is wholly on one of the views and counting what
+# is pushed to the display. Fails if a player was ever out of view.
+def bench_views(args):
+    out_of_view = 0
+    for size in args.sizes:
+        width, height = (int(n) for n in size.lower().split('x'))
+        screen = open_display(size=window_size((width, height)))
+        renderer = Renderer(screen)
+        controller = RandomKeys(args.seed)
+        ctx = HeadlessContext(DuelGame, seed=args.seed, board_size=(width, height))
+        game = ctx.game
+        game.screen, game.renderer = screen, renderer
+        game.initialize_level()
+        missed = split = 0
+        start = time.perf_counter()
+        for _ in range(args.ticks):
+            if ctx.menu.is_open:
+                ctx.play_again()
+            controller(ctx)
+            ctx.tick()
+            screen.fill(LEVEL_BACKGROUND)
+            game.level.draw()
+            renderer.present()
+
+            canvas = game.level.canvas
+            views = canvas.split or [canvas]
+            split += canvas.split is not None
+            for player in game.level.players:
+                if player.alive and not any(shows(view, player.pos) for view in views):
+                    missed += 1
+        elapsed = time.perf_counter() - start
+        out_of_view += missed
+        print('{:>8s}: {:.2f} ms/frame, {:.1f} rects and {:.0f} kpx pushed per frame, split {:.0%} of frames, '
+              'players out of view {} times'.format(
+            size, elapsed/args.ticks*1000, renderer.rects_pushed/renderer.frames,
+            renderer.pixels_pushed/renderer.frames/1000, split/args.ticks, missed,
+        ))
+    if out_of_view:
+        sys.exit('players were out of view')
+
+
+# Whether something at pos, a cell big, is wholly on the view of `canvas`
+def shows(canvas, pos):
+    s = canvas.scale
+    return all(
+      0 <= pos[axis]*s - canvas.camera[axis] <= canvas.view[axis] - s
+      for axis in (0, 1)
+    )
+
+
+# Duel rounds played one after another in one game, as the server and
+# netplay do, with both players killed at once in some rounds and only
+# one in the others. Fails if a round doesn't end the way it was played,
+# say because an earlier draw stuck.
+def bench_rounds(args):
+    ctx = HeadlessContext(DuelGame, seed=args.seed)
+    game = ctx.game
+    rng = random.Random(args.seed)
+    wrong = 0
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        outcome = rng.choice(['draw', 'p1', 'p2'])
+        players = game.level.players
+        if outcome != 'p2':
+            players[1].die()
+        if outcome != 'p1':
+            players[0].die()
+        expected = {'draw': 'mp_gameover_draw', 'p1': 'mp_gameover_winsp1', 'p2': 'mp_gameover_winsp2'}[outcome]
+        if ctx.run(ctx.ticks + 1000) != expected:
+            wrong += 1
+        ctx.play_again()
+    elapsed = time.perf_counter() - start
+    print('{} rounds in {:.2f} s: P1 won {}, P2 won {}, {} ended the wrong way'.format(
+        args.rounds, elapsed, game.p1_wins, game.p2_wins, wrong,
+    ))
+    if wrong:
+        sys.exit('rounds ended the wrong way')
+
+
+# Classic levels made per second, at each stage's difficulty
+def bench_levels(args):
+    ctx = HeadlessContext(ClassicGame, seed=args.seed)
+    game = ctx.game
+    for stage in args.stages:
+        enemies, boxes = game.calculate_difficulty(stage)
+        start = time.perf_counter()
+        for i in range(args.times):
+            Level.generate_singleplayer(
+              game, None, enemies_limits=enemies, boxes_limits=boxes,
+              size=(args.size, args.size), rng=random.Random(i),
+            )
+        elapsed = time.perf_counter() - start
+        print('stage {:2d}: {:6.0f} levels/s'.format(stage, args.times/elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+
+    headless = sub.add_parser('headless', help='simulation ticks per second with no display')
+    headless.add_argument('--ticks', type=int, default=20000)
+    headless.add_argument('--seed', type=int, default=None)
+    headless.set_defaults(run=bench_headless)
+
+    assets = sub.add_parser('assets', help='asset load time/memory and blit cost')
+    assets.add_argument('--frames', type=int, default=200)
+    assets.add_argument('--window', action='store_true', help='use a real window instead of a dummy display')
+    assets.set_defaults(run=bench_assets)
+
+    enemies = sub.add_parser('enemies', help='cost of simulating many enemies')
+    enemies.add_argument('--counts', type=int, nargs='+', default=[5, 50, 200, 1000])
+    enemies.add_argument('--ticks', type=int, default=300)
+    enemies.add_argument('--chase', action='store_true', help='enemies follow a flow field to the player')
+    enemies.set_defaults(run=bench_enemies)
+
+    snapshot = sub.add_parser('snapshot', help='cost of saving and restoring the game state')
+    snapshot.add_argument('--times', type=int, default=10000)
+    snapshot.add_argument('--warmup', type=int, default=300, help='ticks played before measuring')
+    snapshot.add_argument('--seed', type=int, default=0)
+    snapshot.set_defaults(run=bench_snapshot)
+
+    explosions = sub.add_parser('explosions', help='cost of setting off bombs of growing radius')
+    explosions.add_argument('--radii', type=int, nargs='+', default=[2, 5, 10, 20, 40])
+    explosions.add_argument('--size', type=int, default=41, help='width and height of the board')
+    explosions.add_argument('--times', type=int, default=2000)
+    explosions.add_argument('--seed', type=int, default=0)
+    explosions.set_defaults(run=bench_explosions)
+
+    entities = sub.add_parser('entities', help='memory per entity and garbage collection while playing')
+    entities.add_argument('--ticks', type=int, default=5000)
+    entities.add_argument('--bombs', type=int, default=2, help='bombs placed every tick')
+    entities.add_argument('--radius', type=int, default=8)
+    entities.add_argument('--size', type=int, default=41, help='width and height of the board')
+    entities.add_argument('--seed', type=int, default=0)
+    entities.set_defaults(run=bench_entities)
+
+    danger = sub.add_parser('danger', help='cost of keeping the danger map up to date')
+    danger.add_argument('--ticks', type=int, default=2000)
+    danger.add_argument('--bombs', type=int, default=1, help='bombs placed every tick')
+    danger.add_argument('--radius', type=int, default=6)
+    danger.add_argument('--size', type=int, default=41, help='width and height of the board')
+    danger.add_argument('--seed', type=int, default=0)
+    danger.set_defaults(run=bench_danger)
+
+    bots = sub.add_parser('bots', help='computer players in one level, against their time budget')
+    bots.add_argument('--counts', type=int, nargs='+', default=[1, 4, 16])
+    bots.add_argument('--budget', type=float, default=2, help='ms per tick shared by the bots')
+    bots.add_argument('--ticks', type=int, default=1500)
+    bots.add_argument('--size', type=int, default=25, help='width and height of the board')
+    bots.add_argument('--seed', type=int, default=0)
+    bots.set_defaults(run=bench_bots)
+
+    views = sub.add_parser('views', help='duels on boards bigger than the screen, keeping both players in view')
+    views.add_argument('--sizes', nargs='+', default=['13x13', '41x25', '101x101'], help='boards, as WxH')
+    views.add_argument('--ticks', type=int, default=3000)
+    views.add_argument('--seed', type=int, default=0)
+    views.set_defaults(run=bench_views)
+
+    rounds = sub.add_parser('rounds', help='duel rounds back to back in one game, checking who won each')
+    rounds.add_argument('--rounds', type=int, default=30)
+    rounds.add_argument('--seed', type=int, default=0)
+    rounds.set_defaults(run=bench_rounds)
+
+    levels = sub.add_parser('levels', help='classic level generation rate')
+    levels.add_argument('--stages', type=int, nargs='+', default=[1, 5, 11])
+    levels.add_argument('--size', type=int, default=13, help='width and height of the board')
+    levels.add_argument('--times', type=int, default=2000)
+    levels.add_argument('--seed', type=int, default=0)
+    levels.set_defaults(run=bench_levels)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
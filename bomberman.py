@@ -7,104 +7,233 @@ Created on Thu Nov 21 18:06:36 2019
 """
 
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+import argparse
+import gc
+import hashlib
+import heapq
+import itertools
 import sys
 import pygame
 import math
 import random
-pygame.init()
+import time
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-ASSETS = {
-    'icon': pygame.image.load('assets/icon.png'),
-    'title_screen': pygame.image.load('assets/title_screen.png'),
-    'menu_pointer': pygame.image.load('assets/menu_pointer.png'),
-    'grass': pygame.image.load('assets/grass.png'),
-    'wall': pygame.image.load('assets/wall.png'),
+
+ASSET_FILES = {
+    'icon': 'assets/icon.png',
+    'title_screen': 'assets/title_screen.png',
+    'menu_pointer': 'assets/menu_pointer.png',
+    'grass': 'assets/grass.png',
+    'wall': 'assets/wall.png',
     'materializing_wall': [
-        pygame.image.load('assets/materializing_wall/materializing_wall_{}.png'.format(i)) for i in range(1, 8)
+        'assets/materializing_wall/materializing_wall_{}.png'.format(i) for i in range(1, 8)
     ],
-    'box': pygame.image.load('assets/box.png'),
-    'goal_closed': pygame.image.load('assets/goal_closed.png'),
-    'goal_open': pygame.image.load('assets/goal_open.png'),
-    'powerup_life': pygame.image.load('assets/powerup_life.png'),
+    'box': 'assets/box.png',
+    'goal_closed': 'assets/goal_closed.png',
+    'goal_open': 'assets/goal_open.png',
+    'powerup_life': 'assets/powerup_life.png',
     'goal_opening': [
-        pygame.image.load('assets/goal_opening/goal_opening_{}.png'.format(i)) for i in range(1, 6)
+        'assets/goal_opening/goal_opening_{}.png'.format(i) for i in range(1, 6)
     ],
-    'powerup_blast': pygame.image.load('assets/powerup_blast.png'),
-    'powerup_bombup': pygame.image.load('assets/powerup_bombup.png'),
-    'player1_up': pygame.image.load('assets/player/player1_up.png'),
-    'player1_down': pygame.image.load('assets/player/player1_down.png'),
-    'player1_left': pygame.image.load('assets/player/player1_left.png'),
-    'player1_right': pygame.image.load('assets/player/player1_right.png'),
+    'powerup_blast': 'assets/powerup_blast.png',
+    'powerup_bombup': 'assets/powerup_bombup.png',
+    'player1_up': 'assets/player/player1_up.png',
+    'player1_down': 'assets/player/player1_down.png',
+    'player1_left': 'assets/player/player1_left.png',
+    'player1_right': 'assets/player/player1_right.png',
     'player1_die': [
-      pygame.image.load('assets/player/player1_die_{}.png'.format(i)) for i in range(1, 4)
+      'assets/player/player1_die_{}.png'.format(i) for i in range(1, 4)
     ],
-    'player2_up': pygame.image.load('assets/player/player2_up.png'),
-    'player2_down': pygame.image.load('assets/player/player2_down.png'),
-    'player2_left': pygame.image.load('assets/player/player2_left.png'),
-    'player2_right': pygame.image.load('assets/player/player2_right.png'),
+    'player2_up': 'assets/player/player2_up.png',
+    'player2_down': 'assets/player/player2_down.png',
+    'player2_left': 'assets/player/player2_left.png',
+    'player2_right': 'assets/player/player2_right.png',
     'player2_die': [
-      pygame.image.load('assets/player/player2_die_{}.png'.format(i)) for i in range(1, 4)
+      'assets/player/player2_die_{}.png'.format(i) for i in range(1, 4)
     ],
     'bomb': [
-      pygame.image.load('assets/bomb/bomb_{}.png'.format(i)) for i in range(1, 11)
+      'assets/bomb/bomb_{}.png'.format(i) for i in range(1, 11)
     ],
-    'bomb_chaining': pygame.image.load('assets/chaining_bomb.png'),
+    'bomb_chaining': 'assets/chaining_bomb.png',
     'exploding_box': [
-      pygame.image.load('assets/exploding_box/exploding_box_{}.png'.format(i)) for i in range(1, 7)
+      'assets/exploding_box/exploding_box_{}.png'.format(i) for i in range(1, 7)
     ],
     'flame_center': [
-      pygame.image.load('assets/explosion/explosion_center_{}.png'.format(i)) for i in range(1, 4)
+      'assets/explosion/explosion_center_{}.png'.format(i) for i in range(1, 4)
     ],
     'flame_right': [
-      pygame.image.load('assets/explosion/explosion_right_{}.png'.format(i)) for i in range(1, 4)
+      'assets/explosion/explosion_right_{}.png'.format(i) for i in range(1, 4)
     ],
     'flame_left': [
-      pygame.image.load('assets/explosion/explosion_left_{}.png'.format(i)) for i in range(1, 4)
+      'assets/explosion/explosion_left_{}.png'.format(i) for i in range(1, 4)
     ],
     'flame_up': [
-      pygame.image.load('assets/explosion/explosion_up_{}.png'.format(i)) for i in range(1, 4)
+      'assets/explosion/explosion_up_{}.png'.format(i) for i in range(1, 4)
     ],
     'flame_down': [
-      pygame.image.load('assets/explosion/explosion_down_{}.png'.format(i)) for i in range(1, 4)
+      'assets/explosion/explosion_down_{}.png'.format(i) for i in range(1, 4)
     ],
     'flame_right_end': [
-      pygame.image.load('assets/explosion/explosion_right_end_{}.png'.format(i)) for i in range(1, 4)
+      'assets/explosion/explosion_right_end_{}.png'.format(i) for i in range(1, 4)
     ],
     'flame_left_end': [
-      pygame.image.load('assets/explosion/explosion_left_end_{}.png'.format(i)) for i in range(1, 4)
+      'assets/explosion/explosion_left_end_{}.png'.format(i) for i in range(1, 4)
     ],
     'flame_up_end': [
-      pygame.image.load('assets/explosion/explosion_up_end_{}.png'.format(i)) for i in range(1, 4)
+      'assets/explosion/explosion_up_end_{}.png'.format(i) for i in range(1, 4)
     ],
     'flame_down_end': [
-      pygame.image.load('assets/explosion/explosion_down_end_{}.png'.format(i)) for i in range(1, 4)
+      'assets/explosion/explosion_down_end_{}.png'.format(i) for i in range(1, 4)
     ],
     'enemy': {
       'up': [
-        pygame.image.load('assets/enemy/enemy_up_{}.png'.format(i)) for i in range(1, 5)
+        'assets/enemy/enemy_up_{}.png'.format(i) for i in range(1, 5)
       ],
       'down': [
-        pygame.image.load('assets/enemy/enemy_down_{}.png'.format(i)) for i in range(1, 5)
+        'assets/enemy/enemy_down_{}.png'.format(i) for i in range(1, 5)
       ],
       'left': [
-        pygame.image.load('assets/enemy/enemy_left_{}.png'.format(i)) for i in range(1, 5)
+        'assets/enemy/enemy_left_{}.png'.format(i) for i in range(1, 5)
       ],
       'right': [
-        pygame.image.load('assets/enemy/enemy_right_{}.png'.format(i)) for i in range(1, 5)
+        'assets/enemy/enemy_right_{}.png'.format(i) for i in range(1, 5)
       ],
       'idle': [
-        pygame.image.load('assets/enemy/enemy_idle_{}.png'.format(i)) for i in range(1, 5)
+        'assets/enemy/enemy_idle_{}.png'.format(i) for i in range(1, 5)
       ],
     },
     'enemy_dead': [
-      pygame.image.load('assets/enemy/enemy_dead_{}.png'.format(i)) for i in range(1, 6)
+      'assets/enemy/enemy_dead_{}.png'.format(i) for i in range(1, 6)
     ],
-    
 }
 
 
+# Images are decoded the first time one of their keys is used and converted
+# once to the display's pixel format, so blits don't have to convert them on
+# every frame. Keys are the same as in ASSET_FILES ('flame_center',
+# ASSETS['enemy']['up'], ...).
+class AssetManager:
+    def __init__(self, files):
+        self.files = files
+        self.loaded = {}
+        # key -> (seconds spent loading, bytes of pixel data)
+        self.stats = {}
+
+    def __getitem__(self, key):
+        assets = self.loaded.get(key)
+        if assets is None:
+            start = time.perf_counter()
+            assets = self.load(self.files[key])
+            elapsed = time.perf_counter() - start
+            self.loaded[key] = assets
+            self.stats[key] = elapsed, self.size_of(assets)
+        return assets
+
+    def __contains__(self, key):
+        return key in self.files
+
+    def keys(self):
+        return self.files.keys()
+
+    def load(self, files):
+        if isinstance(files, str):
+            img = pygame.image.load(files)
+            # Converting needs a display mode; images loaded before one is
+            # set (e.g. the window icon) are kept as they are.
+            if pygame.display.get_surface() is not None:
+                if img.get_flags() & pygame.SRCALPHA:
+                    img = img.convert_alpha()
+                else:
+                    img = img.convert()
+            return img
+        if isinstance(files, dict):
+            return {k: self.load(v) for k, v in files.items()}
+        return [self.load(f) for f in files]
+
+    def size_of(self, assets):
+        if isinstance(assets, dict):
+            return sum(self.size_of(a) for a in assets.values())
+        if isinstance(assets, list):
+            return sum(self.size_of(a) for a in assets)
+        return assets.get_width() * assets.get_height() * assets.get_bytesize()
+
+    def preload(self, keys=None):
+        for key in keys if keys is not None else self.files:
+            self[key]
+
+    def unload(self):
+        self.loaded = {}
+        self.stats = {}
+
+    def report(self):
+        lines = []
+        for key, (elapsed, size) in sorted(self.stats.items(), key=lambda s: -s[1][0]):
+            lines.append('{:20s} {:8.2f} ms {:8.1f} KiB'.format(key, elapsed*1000, size/1024))
+        total_time = sum(elapsed for elapsed, _ in self.stats.values())
+        total_size = sum(size for _, size in self.stats.values())
+        lines.append('{:20s} {:8.2f} ms {:8.1f} KiB ({}/{} keys loaded)'.format(
+            'total', total_time*1000, total_size/1024, len(self.loaded), len(self.files),
+        ))
+        return '\n'.join(lines)
+
+
+ASSETS = AssetManager(ASSET_FILES)
+
+
+def load_font():
+    global GAME_FONT
+    GAME_FONT = pygame.font.Font('assets/font/PixelMiners-KKal.otf', 32)
+
+
+# Rendered (antialiased) text keyed by (text, colour, font). Labels such as
+# the score or the menu options stay the same for many frames, so they are
+# only rasterised again when their value changes. The least recently used
+# entries are dropped once there are more than `maxsize`.
+class TextCache:
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, text, color, font=None):
+        if font is None:
+            font = GAME_FONT
+        key = text, color, font
+        surface = self.cache.get(key)
+        if surface is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return surface
+
+        self.misses += 1
+        surface = font.render(text, True, color)
+        self.cache[key] = surface
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return surface
+
+    def clear(self):
+        self.cache.clear()
+
+    def report(self):
+        total = self.hits + self.misses
+        return 'text cache: {} hits, {} misses ({:.1%} hit rate), {} entries'.format(
+            self.hits, self.misses, self.hits/total if total else 0, len(self.cache),
+        )
+
+
+TEXT_CACHE = TextCache()
+
+
 DEFAULT_SINGLEPLAYER_CONTROLS = {
     'up': pygame.K_UP,
     'down': pygame.K_DOWN,
@@ -138,7 +267,51 @@ UP_KEY = pygame.K_UP
 DOWN_KEY = pygame.K_DOWN
 
 
-GAME_FONT = pygame.font.Font('assets/font/PixelMiners-KKal.otf', 32) 
+LEVEL_BACKGROUND = (140, 140, 140)
+
+
+# The simulation always advances by this many seconds per step, however
+# long frames actually take.
+TIME_STEP = 1/30
+# Width and height of the board, in cells, unless a game asks for another
+BOARD_SIZE = (13, 13)
+# Largest part of the board shown at once, in pixels. Bigger boards scroll.
+MAX_VIEW = (1050, 750)
+# Smallest window, so the menus (drawn from y=500 down) always fit
+MIN_WINDOW = (650, 780)
+# Upper bound of steps run in a single frame, so a long stall doesn't turn
+# into a burst of simulation the machine can't catch up with.
+MAX_STEPS_PER_FRAME = 5
+
+
+GAME_FONT = None
+
+
+class KeyboardInput:
+    def get_pressed(self):
+        return pygame.key.get_pressed()
+
+
+# Input source with no window behind it: keys are pressed and released
+# programmatically (scripts, load tests, automated matches).
+class InjectedInput:
+    def __init__(self):
+        self.held = set()
+
+    def press(self, key):
+        self.held.add(key)
+
+    def release(self, key):
+        self.held.discard(key)
+
+    def release_all(self):
+        self.held.clear()
+
+    def get_pressed(self):
+        return self
+
+    def __getitem__(self, key):
+        return key in self.held
 
 
 def list_colliding_coordinates(x, y):
@@ -164,38 +337,75 @@ class Block(Enum):
     POWERUP_BOMBUP = 11
 
     def draw(self, canvas, x, y, lvl):
-        assets_indexes = {
-            Block.GRASS: 'grass',
-            Block.WALL: 'wall',
-            Block.BOX: 'box',
-            Block.GOAL_OPEN: 'goal_open',
-            Block.GOAL_CLOSED: 'goal_closed',
-            Block.BOX_POWERUP_LIFE: 'box',
-            Block.BOX_POWERUP_BLAST: 'box',
-            Block.BOX_POWERUP_BOMBUP: 'box',
-            Block.BOX_GOAL: 'box',
-            Block.POWERUP_LIFE: 'powerup_life',
-            Block.POWERUP_BLAST: 'powerup_blast',
-            Block.POWERUP_BOMBUP: 'powerup_bombup',
-        }
-        img = ASSETS[assets_indexes[self]]
-        if self in [Block.POWERUP_LIFE, Block.POWERUP_BLAST, Block.POWERUP_BOMBUP]:
+        img = ASSETS[BLOCK_ASSETS[self]]
+        if self in POWERUP_BLOCKS:
             canvas.draw(ASSETS['grass'], (x,y))
         canvas.draw(img, (x, y))
 
 
+BLOCK_ASSETS = {
+    Block.GRASS: 'grass',
+    Block.WALL: 'wall',
+    Block.BOX: 'box',
+    Block.GOAL_OPEN: 'goal_open',
+    Block.GOAL_CLOSED: 'goal_closed',
+    Block.BOX_POWERUP_LIFE: 'box',
+    Block.BOX_POWERUP_BLAST: 'box',
+    Block.BOX_POWERUP_BOMBUP: 'box',
+    Block.BOX_GOAL: 'box',
+    Block.POWERUP_LIFE: 'powerup_life',
+    Block.POWERUP_BLAST: 'powerup_blast',
+    Block.POWERUP_BOMBUP: 'powerup_bombup',
+}
+
+
+POWERUP_BLOCKS = frozenset([Block.POWERUP_LIFE, Block.POWERUP_BLAST, Block.POWERUP_BOMBUP])
+
+
+# Tile property bits, looked up by block value in TILE_FLAGS
+TILE_SOLID = 1        # Stops players, enemies and flames
+TILE_EXPLODABLE = 2   # Destroyed by flames (boxes)
+TILE_PLACEABLE = 4    # A bomb may be placed on it
+TILE_POWERUP = 8      # Picked up when walked over
+TILE_GOAL = 16        # Ends the level when walked into
+
+
+BLOCKS = list(Block)
+
+
+TILE_FLAGS = [0]*len(BLOCKS)
+for _block in [Block.WALL]:
+    TILE_FLAGS[_block.value] = TILE_SOLID
+for _block in [Block.BOX, Block.BOX_GOAL, Block.BOX_POWERUP_LIFE, Block.BOX_POWERUP_BLAST, Block.BOX_POWERUP_BOMBUP]:
+    TILE_FLAGS[_block.value] = TILE_SOLID | TILE_EXPLODABLE
+for _block in [Block.GRASS, Block.GOAL_CLOSED]:
+    TILE_FLAGS[_block.value] = TILE_PLACEABLE
+for _block in POWERUP_BLOCKS:
+    TILE_FLAGS[_block.value] = TILE_POWERUP
+TILE_FLAGS[Block.GOAL_OPEN.value] = TILE_GOAL
+
+
+# Placed with Level.new_bomb(), which has it go off at `deadline`, a time
+# of the level's scheduler
 class Bomb:
-    def __init__(self, x, y, placer, radius=2, timer=3):
+    __slots__ = ['pos', 'deadline', 'radius', 'placer', 'chaining']
+
+    # Seconds from being placed to going off
+    FUSE = 3
+
+    def __init__(self, x, y, placer, radius, deadline):
         self.pos = (x, y)
-        self.timer = timer
+        self.deadline = deadline
         self.radius = radius
         self.placer = placer
         self.chaining = False
-    
-    def loop(self, lvl, time):
-        self.timer -= time
-        if self.timer <= 0:
-            self.detonate(lvl)
+
+    # Bombs that went off are reused for new ones, so all of it is saved
+    def snapshot(self):
+        return self.pos, self.deadline, self.radius, self.placer, self.chaining
+
+    def restore(self, state):
+        self.pos, self.deadline, self.radius, self.placer, self.chaining = state
     
     def collides(self, x, y):
         xl, xh, yl, yh = list_colliding_coordinates(x, y)
@@ -208,98 +418,76 @@ class Bomb:
     
     def detonate(self, lvl):
         x, y = self.pos
-        flames_list = lvl.flames
-        flame = CenterFlame(lvl, x, y, flames_list, self.radius)
-        flames_list.append(flame)
-        lvl.bombs[self.pos] = None
+        lvl.remove_bomb(self)
+        lvl.explode(x, y, self.radius)
+        lvl.spare_bombs.append(self)
 
-    def draw(self, canvas):
+    def draw(self, canvas, now):
         if self.chaining:
             canvas.draw(ASSETS['bomb_chaining'], self.pos)
         else:
-            current_frame = int((3-self.timer)//0.3)
+            current_frame = max(0, int((self.FUSE - (self.deadline - now))//0.3))
             canvas.draw(ASSETS['bomb'][current_frame], self.pos)
 
 
+# Flames are made by Level.explode(), which also does what they do to the
+# board and bombs they land on, and burn out at `deadline`. They are
+# reused once they burn out, so snapshots hold all of their state.
 class Flame:
-    def __init__(self, lvl, x, y, timer=0.5):
+    __slots__ = ['pos', 'deadline']
+
+    def __init__(self, x, y, deadline):
         self.pos = [x, y]
-        self.timer = timer
-        self.should_spawn = not self.affects_environment(lvl)
+        self.deadline = deadline
+
+    def snapshot(self):
+        return self.pos[0], self.pos[1], self.deadline
+
+    def restore(self, state):
+        self.pos[0], self.pos[1], self.deadline = state
 
-        if lvl.bombs.get(tuple(self.pos), None) != None:
-            bomb = lvl.bombs[tuple(self.pos)]
-            bomb.chaining = True
-            if bomb.timer > 0.25:
-                bomb.timer = 0.25
-    
-    def loop(self, lvl, time):
-        self.timer -= time
-        if self.timer <= 0:
-            lvl.flames.remove(self)
-
-    def affects_environment(self, lvl):
-        x = self.pos[0]
-        y = self.pos[1]
-        matrix = lvl.matrix.matrix
-        if not (0 <= x <= len(matrix[0]) and 0 <= y <= len(matrix)):
-            return False
-        block = lvl.matrix.explode_block(x, y)
-        return block in [
-          Block.BOX, Block.BOX_GOAL, Block.BOX_POWERUP_BOMBUP, Block.BOX_POWERUP_BLAST, Block.BOX_POWERUP_LIFE,
-          Block.WALL,
-        ]
-    
     def collides(self, x, y):
         return self.pos[0] - 0.6 <= x <= self.pos[0] + 0.6 and self.pos[1] - 0.6 <= y <= self.pos[1] + 0.6
     
     # Abstract method to be defined in children classes
-    def draw(self, canvas):
+    def draw(self, canvas, now):
         pass
 
 
 class CenterFlame(Flame):
-    def __init__(self, lvl, x, y, flames_list, radius, timer=0.5):
-        super().__init__(lvl, x, y, timer)
-        
-        if radius > 1 and self.should_spawn:
-            l = HorizontalFlame(lvl, x-1, y, flames_list, radius-1, timer, False)
-            r = HorizontalFlame(lvl, x+1, y, flames_list, radius-1, timer, True)
-            u = VerticalFlame(lvl, x, y-1, flames_list, radius-1, timer, False)
-            d = VerticalFlame(lvl, x, y+1, flames_list, radius-1, timer, True)
-            new_flames = [l, r, u, d]
-            flames_list += [f for f in new_flames if f.should_spawn]
+    __slots__ = []
 
-    def draw(self, canvas):
-        current_frame = self.timer//0.1
+    def draw(self, canvas, now):
+        current_frame = (self.deadline - now)//0.1
         if current_frame > 2:
             current_frame = 4-current_frame
         current_frame = int(current_frame)
         canvas.draw(ASSETS['flame_center'][current_frame], self.pos)
 
 
+# `radius` is how much further the flame would have reached from here, so
+# 1 for the end of a ray
 class HorizontalFlame(Flame):
-    def __init__(self, lvl, x, y, flames_list, radius, timer, left_to_right):
-        super().__init__(lvl, x, y, timer)
+    __slots__ = ['radius', 'left_to_right']
+
+    def __init__(self, x, y, radius, deadline, left_to_right):
+        super().__init__(x, y, deadline)
         self.radius = radius 
         self.left_to_right = left_to_right
 
-        if radius > 1 and self.should_spawn:
-            if left_to_right:
-                nx = x+1
-            else:
-                nx = x-1
-            flame = HorizontalFlame(lvl, nx, y, flames_list, radius-1, timer, left_to_right)
-            if flame.should_spawn:
-                flames_list.append(flame)
+    def snapshot(self):
+        return self.pos[0], self.pos[1], self.deadline, self.radius, self.left_to_right
 
-    def draw(self, canvas):
+    def restore(self, state):
+        self.pos[0], self.pos[1], self.deadline, self.radius, self.left_to_right = state
+
+    def draw(self, canvas, now):
         if self.radius == 1:
             flame = 'flame_right_end' if self.left_to_right else 'flame_left_end'
         else:
             flame = 'flame_right' if self.left_to_right else 'flame_left'
 
-        current_frame = self.timer//0.1
+        current_frame = (self.deadline - now)//0.1
         if current_frame > 2:
             current_frame = 4-current_frame
         current_frame = int(current_frame)
@@ -307,27 +495,26 @@ class HorizontalFlame(Flame):
 
 
 class VerticalFlame(Flame):
-    def __init__(self, lvl, x, y, flames_list, radius, timer, up_to_down):
-        super().__init__(lvl, x, y, timer)
+    __slots__ = ['radius', 'up_to_down']
+
+    def __init__(self, x, y, radius, deadline, up_to_down):
+        super().__init__(x, y, deadline)
         self.radius = radius 
         self.up_to_down = up_to_down
 
-        if radius > 1 and self.should_spawn:
-            if up_to_down:
-                ny = y+1
-            else:
-                ny = y-1
-            flame = VerticalFlame(lvl, x, ny, flames_list, radius-1, timer, up_to_down)
-            if flame.should_spawn:
-                flames_list.append(flame)
+    def snapshot(self):
+        return self.pos[0], self.pos[1], self.deadline, self.radius, self.up_to_down
 
-    def draw(self, canvas):
+    def restore(self, state):
+        self.pos[0], self.pos[1], self.deadline, self.radius, self.up_to_down = state
+
+    def draw(self, canvas, now):
         if self.radius == 1:
             flame = 'flame_down_end' if self.up_to_down else 'flame_up_end'
         else:
             flame = 'flame_down' if self.up_to_down else 'flame_up'
 
-        current_frame = self.timer//0.1
+        current_frame = (self.deadline - now)//0.1
         if current_frame > 2:
             current_frame = 4-current_frame
         current_frame = int(current_frame)
@@ -338,6 +525,11 @@ class Enemy:
     # Enemy velocity in blocks per second
     VELOCITY = 1.60
 
+    __slots__ = [
+      'game', 'pos', 'direction', 'alive', 'score_worth', 'time_to_disappear', 'clock',
+      'eyes_closed', 'blink_tick', 'seconds_since_eyes_closed',
+    ]
+
     def __init__(self, game, x, y, direction):
         self.game = game
         self.pos = [x, y]
@@ -351,6 +543,18 @@ class Enemy:
         self.blink_tick = 0
         self.seconds_since_eyes_closed = 0
 
+    def snapshot(self):
+        return (
+          self.pos[0], self.pos[1], self.direction, self.alive, self.time_to_disappear,
+          self.clock, self.eyes_closed, self.blink_tick, self.seconds_since_eyes_closed,
+        )
+
+    def restore(self, state):
+        (
+          self.pos[0], self.pos[1], self.direction, self.alive, self.time_to_disappear,
+          self.clock, self.eyes_closed, self.blink_tick, self.seconds_since_eyes_closed,
+        ) = state
+
     def loop(self, lvl, time):
         self.clock += time
         self.blink_tick += time
@@ -359,13 +563,14 @@ class Enemy:
         if self.alive:
             self.check_has_to_change_direction_due_to_bomb(lvl)
             self.move(lvl, self.VELOCITY*time)
-            for f in lvl.flames:
+            lvl.enemy_index.move(self, self.pos)
+            for f in lvl.flames_near(*self.pos):
                 if f.collides(*self.pos):
                     self.die(lvl)
         else:
             self.time_to_disappear -= time
             if self.time_to_disappear <= 0:
-                lvl.enemies.remove(self)
+                lvl.remove_enemy(self)
 
     def die(self, lvl):
         self.alive = False
@@ -402,8 +607,15 @@ class Enemy:
         else:
             self.direction = 'idle'
 
+    # Enemies of a level with a flow field go the way it points, and only
+    # wander at random when they can't get to any player
     def maybe_try_change_direction(self, lvl):
         x, y = int(self.pos[0]), int(self.pos[1])
+        if lvl.flow is not None:
+            direction = lvl.flow.direction(x, y)
+            if direction is not None:
+                self.direction = direction
+                return
         if self.direction == 'up':
             weights = [87, 3, 7, 3]
         elif self.direction == 'down':
@@ -418,16 +630,12 @@ class Enemy:
         # [UP, RIGHT, DOWN, LEFT]
         available = [True, True, True, True]
         for i, pos in enumerate([(x, y-1), (x+1, y), (x, y+1), (x-1, y)]):
-            for bomb in lvl.bombs.values():
-                if bomb.collides(*pos):
-                    available[i] = False
-                    break
-            available[i] = available[i] and not (
+            available[i] = pos not in lvl.bombs and not (
                 lvl.matrix.is_solid(*pos) 
             )
         total = sum([w for w, a in zip(weights, available) if a])
         weights = [w/total if a else 0 for w, a in zip(weights, available)]
-        rnd = random.random()
+        rnd = self.game.rng.random()
         aq = 0
         
         for w, direction in zip(weights, ['up', 'right', 'down', 'left']):
@@ -483,7 +691,7 @@ class Enemy:
         if self.blink_tick >= 0.1:
             self.blink_tick -= 0.1
             if self.seconds_since_eyes_closed >= 0.4:
-                if random.random() <= 1.5**(4*self.seconds_since_eyes_closed)/100:
+                if self.game.rng.random() <= 1.5**(4*self.seconds_since_eyes_closed)/100:
                     self.eyes_closed = True
                     self.seconds_since_eyes_closed = 0
 
@@ -498,15 +706,271 @@ class Enemy:
             canvas.draw(ASSETS['enemy_dead'][current_frame], self.pos)
 
 
+ENEMY_DIRECTIONS = ['up', 'right', 'down', 'left', 'idle']
+
+
+# Simulates many enemies at once with NumPy. Positions, directions, timers
+# and blink state are kept in parallel arrays and every step is done for
+# all the enemies together, following the same rules as Enemy: moving along
+# the grid, picking a new direction (with the same weights) whenever a grid
+# point is reached, and turning back or stopping in front of bombs.
+class EnemySwarm:
+    VELOCITY = Enemy.VELOCITY
+    # Levels with at least this many enemies use a swarm by default
+    MIN_ENEMIES = 64
+
+    UP, RIGHT, DOWN, LEFT, IDLE = range(5)
+    # [UP, RIGHT, DOWN, LEFT] weights by current direction
+    WEIGHTS = [
+        [87, 3, 7, 3],
+        [3, 87, 3, 7],
+        [7, 3, 87, 3],
+        [3, 7, 3, 87],
+        [25, 25, 25, 25],
+    ]
+    # Sign of the movement along its axis, by direction
+    SIGN = [-1, 1, 1, -1, 0]
+    # Per-enemy state, one array each
+    ARRAYS = [
+      'x', 'y', 'direction', 'alive', 'score_worth', 'time_to_disappear',
+      'clock', 'eyes_closed', 'blink_tick', 'seconds_since_eyes_closed',
+    ]
+
+    def __init__(self, game, enemies, seed=None):
+        self.game = game
+        self.rng = np.random.default_rng(seed)
+        self.weights = np.array(self.WEIGHTS, dtype=float)
+        self.sign = np.array(self.SIGN, dtype=float)
+
+        self.x = np.array([e.pos[0] for e in enemies], dtype=float)
+        self.y = np.array([e.pos[1] for e in enemies], dtype=float)
+        self.direction = np.array([ENEMY_DIRECTIONS.index(e.direction) for e in enemies], dtype=np.int8)
+        self.alive = np.array([e.alive for e in enemies], dtype=bool)
+        self.score_worth = np.array([e.score_worth for e in enemies], dtype=int)
+        self.time_to_disappear = np.array([
+          e.time_to_disappear if e.time_to_disappear is not None else 0 for e in enemies
+        ], dtype=float)
+        self.clock = np.array([e.clock for e in enemies], dtype=float)
+        self.eyes_closed = np.array([e.eyes_closed for e in enemies], dtype=bool)
+        self.blink_tick = np.array([e.blink_tick for e in enemies], dtype=float)
+        self.seconds_since_eyes_closed = np.array([e.seconds_since_eyes_closed for e in enemies], dtype=float)
+
+    def __len__(self):
+        return len(self.x)
+
+    def snapshot(self):
+        return [getattr(self, name).copy() for name in self.ARRAYS], self.rng.bit_generator.state
+
+    def restore(self, state):
+        arrays, rng_state = state
+        for name, array in zip(self.ARRAYS, arrays):
+            setattr(self, name, array.copy())
+        self.rng.bit_generator.state = rng_state
+
+    def loop(self, lvl, time):
+        dying = ~self.alive
+        self.clock += time
+        self.blink_tick += time
+        self.seconds_since_eyes_closed += time
+        self.loop_eyes()
+
+        alive = np.flatnonzero(self.alive)
+        if alive.size:
+            matrix = lvl.matrix
+            shape = matrix.height, matrix.width
+            bombs = np.zeros(shape, dtype=bool)
+            for bx, by in lvl.bombs:
+                bombs[by, bx] = True
+            blocked = np.frombuffer(matrix.mask(TILE_SOLID), dtype=np.uint8).reshape(shape) != 0
+            blocked |= bombs
+
+            field = lvl.flow.grid() if lvl.flow is not None else None
+            self.check_has_to_change_direction_due_to_bomb(alive, bombs)
+            self.move(alive, self.VELOCITY*time, blocked, field)
+            self.check_flames(lvl, alive)
+
+        if dying.any():
+            self.time_to_disappear[dying] -= time
+            gone = dying & (self.time_to_disappear <= 0)
+            if gone.any():
+                self.keep(~gone)
+
+    def loop_eyes(self):
+        since = self.seconds_since_eyes_closed
+        self.eyes_closed[since >= 0.2] = False
+        ticking = self.blink_tick >= 0.1
+        self.blink_tick[ticking] -= 0.1
+        may_close = ticking & (since >= 0.4)
+        if may_close.any():
+            rnd = self.rng.random(len(since))
+            close = may_close & (rnd <= 1.5**(4*since)/100)
+            self.eyes_closed[close] = True
+            since[close] = 0
+
+    # Same as Enemy.check_has_to_change_direction_due_to_bomb: a bomb right in
+    # front makes the enemy turn back, or stop if there is one behind as well.
+    def check_has_to_change_direction_due_to_bomb(self, idx, bombs):
+        d = self.direction[idx]
+        moving = d != self.IDLE
+        idx, d = idx[moving], d[moving]
+        if not idx.size:
+            return
+        x, y = self.x[idx], self.y[idx]
+        horizontal = (d == self.LEFT) | (d == self.RIGHT)
+        forward = self.sign[d] > 0
+        along = np.where(horizontal, x, y)
+        across = np.where(horizontal, y, x)
+        front = np.where(forward, np.ceil(along), np.floor(along))
+        back = np.where(forward, np.floor(along), np.ceil(along))
+        # Bombs are on grid points, so an enemy off the grid line can't meet one
+        on_line = across == np.floor(across)
+        h, w = bombs.shape
+        across = across.astype(int)
+
+        def bomb_at(a):
+            a = a.astype(int)
+            bx = np.clip(np.where(horizontal, a, across), 0, w-1)
+            by = np.clip(np.where(horizontal, across, a), 0, h-1)
+            return on_line & bombs[by, bx]
+
+        in_front = bomb_at(front)
+        behind = bomb_at(back)
+        reverse = in_front & ~behind
+        self.direction[idx[reverse]] = (d[reverse] + 2) % 4
+        self.direction[idx[in_front & behind]] = self.IDLE
+
+    # Same as Enemy.maybe_try_change_direction, for the enemies in `idx`.
+    # `field` is the level's flow field as a grid, if it has one.
+    def maybe_try_change_direction(self, idx, blocked, field=None):
+        if not idx.size:
+            return
+        h, w = blocked.shape
+        x = self.x[idx].astype(int)
+        y = self.y[idx].astype(int)
+        # [UP, RIGHT, DOWN, LEFT]
+        nx = np.stack([x, x+1, x, x-1], axis=1)
+        ny = np.stack([y-1, y, y+1, y], axis=1)
+        outside = (nx < 0) | (nx >= w) | (ny < 0) | (ny >= h)
+        available = ~(blocked[np.clip(ny, 0, h-1), np.clip(nx, 0, w-1)] | outside)
+
+        if field is not None:
+            # First of the closest cells around, in the same order as FlowField.direction
+            dist = np.where(available, field[np.clip(ny, 0, h-1), np.clip(nx, 0, w-1)], -1)
+            dist[dist < 0] = field.size
+            best = dist.argmin(axis=1)
+            chasing = dist[np.arange(len(idx)), best] < field.size
+            self.direction[idx[chasing]] = best[chasing]
+            idx, available = idx[~chasing], available[~chasing]
+            if not idx.size:
+                return
+
+        weights = self.weights[self.direction[idx]] * available
+        total = weights.sum(axis=1, keepdims=True)
+        weights = np.divide(weights, total, out=np.zeros_like(weights), where=total > 0)
+        rnd = self.rng.random(len(idx))
+        chosen = rnd[:, None] < np.cumsum(weights, axis=1)
+        self.direction[idx] = np.where(chosen.any(axis=1), chosen.argmax(axis=1), self.IDLE)
+
+    # Same as Enemy.move: enemies that reach a grid point stop there, pick a
+    # new direction and keep going with the distance they have left.
+    def move(self, idx, distance, blocked, field=None):
+        remaining = np.full(len(idx), distance)
+        while idx.size:
+            x, y = self.x[idx], self.y[idx]
+            rx, ry = np.rint(x), np.rint(y)
+            at_grid = ((rx == x) & (ry == y)) | (self.direction[idx] == self.IDLE)
+            self.maybe_try_change_direction(idx[at_grid], blocked, field)
+
+            d = self.direction[idx]
+            moving = d != self.IDLE
+            idx, d, remaining = idx[moving], d[moving], remaining[moving]
+            x, y, rx, ry = x[moving], y[moving], rx[moving], ry[moving]
+
+            horizontal = (d == self.LEFT) | (d == self.RIGHT)
+            sign = self.sign[d]
+            along = np.where(horizontal, x, y)
+            grid = np.where(horizontal, rx, ry)
+            gap = (grid - along)*sign
+            snap = (gap > 0) & (gap <= remaining)
+
+            moved = np.where(snap, grid, along + sign*remaining)
+            self.x[idx] = np.where(horizontal, moved, x)
+            self.y[idx] = np.where(horizontal, y, moved)
+
+            remaining = np.where(sign < 0, remaining - along + grid, remaining - grid + along)[snap]
+            idx = idx[snap]
+            self.maybe_try_change_direction(idx, blocked, field)
+
+    # Same as the flame check in Enemy.loop (including dying once for every
+    # flame touching the enemy, which is what the score is based on).
+    def check_flames(self, lvl, idx):
+        if not lvl.flames:
+            return
+        h, w = lvl.matrix.height, lvl.matrix.width
+        flames = np.zeros((h, w), dtype=int)
+        for f in lvl.flames:
+            flames[f.pos[1], f.pos[0]] += 1
+
+        x, y = self.x[idx], self.y[idx]
+        rx, ry = np.rint(x).astype(int), np.rint(y).astype(int)
+        hits = np.zeros(len(idx), dtype=int)
+        for fx in [rx-1, rx, rx+1]:
+            for fy in [ry-1, ry, ry+1]:
+                inside = (0 <= fx) & (fx < w) & (0 <= fy) & (fy < h)
+                touching = inside & (fx - 0.6 <= x) & (x <= fx + 0.6) & (fy - 0.6 <= y) & (y <= fy + 0.6)
+                hits += np.where(touching, flames[np.clip(fy, 0, h-1), np.clip(fx, 0, w-1)], 0)
+
+        killed = hits > 0
+        if killed.any():
+            dead = idx[killed]
+            self.alive[dead] = False
+            self.time_to_disappear[dead] = 1
+            self.game.score += int((self.score_worth[dead]*hits[killed]).sum())
+            if len(self) == 1:
+                lvl.matrix.open_doors()
+
+    def keep(self, mask):
+        for name in self.ARRAYS:
+            setattr(self, name, getattr(self, name)[mask])
+
+    def collides(self, x, y):
+        if not len(self):
+            return False
+        return bool((
+          self.alive & (np.abs(x - self.x) <= 0.6) & (np.abs(y - self.y) <= 0.6)
+        ).any())
+
+    def draw(self, canvas):
+        x0, y0, x1, y1 = canvas.visible_cells()
+        in_view = np.flatnonzero((self.x >= x0-1) & (self.x < x1+1) & (self.y >= y0-1) & (self.y < y1+1))
+        for i in in_view:
+            pos = self.x[i], self.y[i]
+            if self.alive[i]:
+                current_frame = int((self.clock[i]%0.4)//0.2)
+                if self.eyes_closed[i]:
+                    current_frame += 2
+                direction = ENEMY_DIRECTIONS[self.direction[i]]
+                canvas.draw(ASSETS['enemy'][direction][current_frame], pos)
+            else:
+                current_frame = int((1-self.time_to_disappear[i])//0.2)
+                canvas.draw(ASSETS['enemy_dead'][current_frame], pos)
+
+
 class Player:
     # Player velocity in blocks per second
     VELOCITY = 2.0
 
-    def __init__(self, game, x, y, sprite='p1', controls=DEFAULT_SINGLEPLAYER_CONTROLS, max_bombs=1, bomb_blast_radius=2):
+    __slots__ = [
+      'pos', 'sprite', 'direction', 'controls', 'input', 'max_bombs', 'game', 'alive',
+      'time_since_dead', 'bomb_blast_radius', 'trying_to_place_bomb_timer',
+    ]
+
+    def __init__(self, game, x, y, sprite='p1', controls=DEFAULT_SINGLEPLAYER_CONTROLS, max_bombs=1, bomb_blast_radius=2, input=None):
         self.pos = [x, y]
         self.sprite = sprite
         self.direction = 'down'
         self.controls = controls
+        self.input = input if input is not None else game.input
         self.max_bombs = max_bombs
         self.game = game
         self.alive = True
@@ -514,14 +978,25 @@ class Player:
         self.bomb_blast_radius = bomb_blast_radius
         self.trying_to_place_bomb_timer = 0
 
+    def snapshot(self):
+        return (
+          self.pos[0], self.pos[1], self.direction, self.alive, self.time_since_dead,
+          self.max_bombs, self.bomb_blast_radius, self.trying_to_place_bomb_timer,
+        )
+
+    def restore(self, state):
+        (
+          self.pos[0], self.pos[1], self.direction, self.alive, self.time_since_dead,
+          self.max_bombs, self.bomb_blast_radius, self.trying_to_place_bomb_timer,
+        ) = state
+
     def loop(self, lvl, time):
         if self.alive:
-            for f in lvl.flames:
+            for f in lvl.flames_near(*self.pos):
                 if f.collides(*self.pos):
                     self.die()
-            for e in lvl.enemies:
-                if e.alive and e.collides(*self.pos):
-                    self.die()
+            if lvl.enemy_collides(*self.pos):
+                self.die()
             self.check_key_move(lvl, time)
             
             self.trying_to_place_bomb_timer -= time
@@ -577,7 +1052,7 @@ class Player:
 
     def check_key_move(self, lvl, time):
         new_pos = self.pos[:]
-        pressed = pygame.key.get_pressed()
+        pressed = self.input.get_pressed()
         distance = self.VELOCITY * time
 
         if pressed[self.controls['up']]:
@@ -629,18 +1104,16 @@ class Player:
                 else:
                     new_pos[1] += dif
         
-        for bomb in lvl.bombs.values():
+        for bomb in lvl.bombs_colliding(*new_pos):
             if (
-              bomb.collides(*new_pos) 
-              and not bomb.collides_closer(*self.pos) 
+              not bomb.collides_closer(*self.pos) 
               and calculate_distance(bomb.pos, new_pos) < calculate_distance(bomb.pos, self.pos)
             ):
                 return
         self.pos = new_pos
         lvl.matrix.check_obtains_powerups(self)
         if lvl.matrix.check_enters_goal(*self.pos):
-            if  self.game.start_next_level_timer == None and self.game.restart_level_timer == None:
-                self.game.start_next_level_timer = 0.25
+            self.game.level_complete()
 
     def handle_key(self, key, lvl):
         if self.alive:
@@ -652,110 +1125,814 @@ class Player:
                         self.trying_to_place_bomb_timer = 0.2
 
 
+# A computer player. It takes the place of the keyboard as the input of
+# the player it controls (players[index] of the level), holding the keys
+# its search decides on, so the game can't tell it from a person. The
+# search is a breadth-first walk of the board that avoids flames and the
+# blasts the level's DangerMap says are coming, and from what it reaches
+# picks where to go: out of danger, to the goal or a powerup, or to a cell
+# to drop a bomb from (only if there's a way out of its blast), or else
+# towards the nearest opponent. It runs a little at a time within the
+# budget Bots gives it, and the bot keeps to its last plan meanwhile.
+class Bot(InjectedInput):
+    # Work, in cells looked at, between checks of the clock
+    BATCH = 32
+    # Seconds for a player to walk one cell
+    STEP_TIME = 1/Player.VELOCITY
+    # Seconds a player is within reach of a flame on a cell it walks
+    # through, either side of reaching its middle
+    PASSING = 0.3
+    # How long flames last (see Level.explode), plus the step they show
+    # up late by, and slack for a plan worked out on an older state
+    FLAME_TIME = 0.5 + TIME_STEP
+    MARGIN = 0.2
+    # Worth of what a bomb dropped somewhere would blow up
+    BOX_WORTH = 1
+    ENEMY_WORTH = 2
+    OPPONENT_WORTH = 3
+    # Cells (in steps on open ground) an enemy is given a wide berth of
+    ENEMY_REACH = 2
+    # How close to the middle of a cell counts as in it. More than a step
+    # of walking, as rounding can leave a player that far short of a
+    # middle it can't then get any closer to.
+    CENTRED = 1.5*Player.VELOCITY*TIME_STEP
+
+    def __init__(self, index):
+        super().__init__()
+        self.index = index
+        self.level = None
+        self.search = None
+        # Seconds the longest recent stretch of the search between yields
+        # took, and the work done since the last yield
+        self.stretch = 0
+        self.work = 0
+        # Cells to walk through, by position, whether to drop a bomb at the
+        # last one and the way out of its blast afterwards
+        self.path = []
+        self.steps = {}
+        self.bomb = False
+        self.escape = []
+
+    def forget(self):
+        self.search = None
+        self.path = []
+        self.steps = {}
+        self.bomb = False
+        self.escape = []
+
+    def follow(self, path, bomb=False, escape=None):
+        self.path = path
+        self.steps = {cell: k for k, cell in enumerate(path)}
+        self.bomb = bomb
+        self.escape = escape if escape is not None else []
+
+    # Searches until the search is over or thread_time() might pass
+    # `deadline`, going by how long the longest recent stretch of it took.
+    # A search that is over starts the bot on its plan. A new search goes
+    # by `sight` if it's of this level (see Bots), or else by one of its
+    # own.
+    def think(self, lvl, deadline, sight=None):
+        if lvl is not self.level:
+            self.level = lvl
+            self.forget()
+        player = lvl.players[self.index]
+        if not player.alive:
+            return
+        if self.search is None:
+            if sight is None or sight.level is not lvl:
+                sight = BotSight(lvl)
+            self.search = self.plan(lvl, player, sight)
+        now = time.thread_time()
+        if now + 2*self.stretch >= deadline:
+            # Most likely a stretch that the machine held up, so it's
+            # given less weight every step it stops the search
+            self.stretch /= 2
+            return
+        try:
+            # Room is left for a stretch twice as long as the longest
+            # recent one, so the deadline holds when they get longer
+            while now + 2*self.stretch < deadline:
+                next(self.search)
+                then = time.thread_time()
+                self.stretch = max(then - now, self.stretch)
+                now = then
+        except StopIteration as done:
+            self.search = None
+            if done.value is not None:
+                self.follow(*done.value)
+        # Steps long past count for less and less
+        self.stretch *= 0.9
+
+    # The cell the player is in, as far as paths go: the one it's mostly
+    # in, or the one it's stepping into if it's stepping off a bomb (which
+    # it couldn't go back onto)
+    @staticmethod
+    def cell_of(lvl, player):
+        px, py = player.pos
+        x, y = round(px), round(py)
+        bomb = lvl.bombs.get((x, y))
+        if bomb is not None and not bomb.collides_closer(px, py):
+            if abs(px - x) > 0.45:
+                x += 1 if px > x else -1
+            if abs(py - y) > 0.45:
+                y += 1 if py > y else -1
+        return x, y
+
+    # Keys to hold this step to get along the path
+    def keys(self, lvl, player):
+        controls = player.controls
+        px, py = player.pos
+        cell = self.cell_of(lvl, player)
+        k = self.steps.get(cell)
+        if k is None:
+            self.follow([])
+            return set()
+        if k + 1 < len(self.path):
+            tx, ty = self.path[k + 1]
+        else:
+            tx, ty = cell
+            if abs(px - tx) < self.CENTRED and abs(py - ty) < self.CENTRED:
+                keys = set()
+                if self.bomb and lvl.placed_bombs(player) < player.max_bombs:
+                    keys.add(controls['place_bomb'])
+                    self.follow(self.escape)
+                    self.search = None
+                else:
+                    self.follow([])
+                return keys
+        # Turning corners is left to the player's own corner sliding, once
+        # it's in the row or column of its cell
+        dx, dy = tx - px, ty - py
+        if tx != cell[0] and round(py) != cell[1]:
+            dx, dy = 0, cell[1] - py
+        elif ty != cell[1] and round(px) != cell[0]:
+            dx, dy = cell[0] - px, 0
+        if abs(dx) >= abs(dy):
+            return {controls['right' if dx > 0 else 'left']}
+        return {controls['down' if dy > 0 else 'up']}
+
+    # Holds the keys for this step. Keys pressed go to the game, and
+    # `on_key(key, kind)` is told of each change, with the kinds of
+    # Replay (PRESS or RELEASE), for the game to be recorded.
+    def act(self, game, on_key=None):
+        lvl = game.level
+        player = lvl.players[self.index]
+        keys = self.keys(lvl, player) if player.alive and lvl is self.level else set()
+        for key in list(self.held - keys):
+            self.release(key)
+            if on_key is not None:
+                on_key(key, Replay.RELEASE)
+        for key in keys - self.held:
+            self.press(key)
+            if on_key is not None:
+                on_key(key, Replay.PRESS)
+            game.handle_key(key)
+
+    # Whether a player reaching the middle of cell i at time t (and
+    # staying there if `stay`) would be in a flame. `bomb` is the cells
+    # and time of the blast of a bomb that isn't there yet.
+    def unsafe(self, i, t, danger, burning, stay=False, bomb=None):
+        start = t - self.PASSING - self.MARGIN
+        end = math.inf if stay else t + self.PASSING + self.MARGIN
+        blast = danger[i]
+        if bomb is not None and i in bomb[0]:
+            blast = min(blast, bomb[1])
+        if blast != math.inf and blast <= end and start <= blast + self.FLAME_TIME + self.MARGIN:
+            return True
+        return burning.get(i, -math.inf) >= start
+
+    # Counts `work` towards the next yield of the search, and says whether
+    # it's time for it
+    def worked(self, work=1):
+        self.work += work
+        if self.work < self.BATCH:
+            return False
+        self.work = 0
+        return True
+
+    # Breadth-first from `start`, reached `steps` cells in at time `now`,
+    # through cells not `blocked` and safe to walk through when they're
+    # reached. Each cell goes into `reached` as (cell, steps, time), and its
+    # parent into `parents`.
+    def walk(self, start, steps, now, blocked, danger, burning, reached, parents, max_steps=None, bomb=None):
+        w = self.level.matrix.width
+        parents[start] = None
+        reached.append((start, steps, now))
+        frontier = [start]
+        first = steps
+        while frontier:
+            steps += 1
+            if max_steps is not None and steps > max_steps:
+                return
+            t = now + (steps - first)*self.STEP_TIME
+            after = []
+            for i in frontier:
+                x = i % w
+                for j in (i - w, i + w, i - 1 if x else -1, i + 1 if x < w - 1 else -1):
+                    if j < 0 or j >= len(blocked) or blocked[j] or j in parents:
+                        continue
+                    if self.unsafe(j, t, danger, burning, bomb=bomb):
+                        continue
+                    parents[j] = i
+                    reached.append((j, steps, t))
+                    after.append(j)
+                if self.worked(4):
+                    yield
+            frontier = after
+
+    @staticmethod
+    def path_to(i, parents, w):
+        path = []
+        while i is not None:
+            path.append((i % w, i // w))
+            i = parents[i]
+        return path[::-1]
+
+    # Worth of a bomb of `radius` dropped at (x, y): what its flames reach
+    # and the boxes that stop them
+    def bomb_worth(self, lvl, x, y, radius, targets):
+        matrix = lvl.matrix
+        worth = targets.get((x, y), 0)
+        for ray, (dx, dy) in enumerate(BlockMatrix.RAYS):
+            reach = min(matrix.free_run(x, y, ray), radius - 1)
+            for k in range(1, reach + 1):
+                worth += targets.get((x + dx*k, y + dy*k), 0)
+            bx, by = x + dx*(reach + 1), y + dy*(reach + 1)
+            if reach < radius - 1 and matrix.in_bounds(bx, by):
+                if TILE_FLAGS[matrix.tiles[by*matrix.width + bx]] & TILE_EXPLODABLE:
+                    worth += self.BOX_WORTH
+        return worth
+
+    # Of the `candidates` (cell, steps, time) in `reached`, the one a bomb
+    # is worth the most from, for the steps to get there, that there's a
+    # way out of the blast from. Returns the arguments for follow(), or
+    # None if there is none.
+    def bomb_spot(self, lvl, player, candidates, parents, blocked, danger, burning, targets):
+        w = lvl.matrix.width
+        radius = player.bomb_blast_radius
+        ranked = []
+        for i, steps, t in candidates:
+            if self.worked(4*radius):
+                yield
+            if TILE_FLAGS[lvl.matrix.tiles[i]] & TILE_PLACEABLE:
+                worth = self.bomb_worth(lvl, i % w, i // w, radius, targets)
+                if worth:
+                    ranked.append((-worth/(steps + 2), steps, i, t))
+        ranked.sort()
+        for _, steps, i, t in ranked:
+            if self.worked(4*radius):
+                yield
+            bomb = Bomb(i % w, i // w, player, radius, t + Bomb.FUSE)
+            bomb = set(lvl.danger.blast(bomb)[0]), bomb.deadline
+            way_out, out_parents = [], {}
+            yield from self.walk(
+              i, steps, t, blocked, danger, burning, way_out, out_parents,
+              max_steps=steps + int(Bomb.FUSE/self.STEP_TIME), bomb=bomb,
+            )
+            for j, _, tj in way_out:
+                if self.worked():
+                    yield
+                if j not in bomb[0] and not self.unsafe(j, tj, danger, burning, stay=True):
+                    return self.path_to(i, parents, w), True, self.path_to(j, out_parents, w)
+        return None
+
+    # The search, going by `sight` (a BotSight of the level). Returns the
+    # arguments for follow(), or None to keep on with the plan there is.
+    def plan(self, lvl, player, sight):
+        while not sight.advance():
+            yield
+        w = lvl.matrix.width
+        now = sight.now
+        danger, burning, blocked, near = sight.danger, sight.burning, sight.blocked, sight.near
+        enemies = sight.enemies
+        opponents = [cell for p, cell in sight.players if p is not player]
+        targets = dict(sight.targets)
+        for cell in opponents:
+            targets[cell] = targets.get(cell, 0) + self.OPPONENT_WORTH
+
+        sx, sy = self.cell_of(lvl, player)
+        start = sy*w + sx
+        reached, parents = [], {}
+        yield from self.walk(start, 0, now, blocked, danger, burning, reached, parents)
+        may_bomb = lvl.placed_bombs(player) < player.max_bombs
+
+        def safe(i, t):
+            return i not in near and not self.unsafe(i, t, danger, burning, stay=True)
+
+        # Out of harm's way first, bombing an enemy that's too close on the
+        # way if it's worth it: the nearest cell that stays safe
+        if not safe(start, now):
+            if may_bomb and start in near and not self.unsafe(start, now, danger, burning, stay=True):
+                spot = yield from self.bomb_spot(lvl, player, reached[:1], parents, blocked, danger, burning, targets)
+                if spot is not None:
+                    return spot
+            for i, steps, t in reached:
+                if self.worked():
+                    yield
+                if safe(i, t):
+                    return self.path_to(i, parents, w), False, None
+            return None
+
+        # Then the goal and powerups, nearest first
+        tiles = lvl.matrix.tiles
+        for i, steps, t in reached:
+            if self.worked():
+                yield
+            if TILE_FLAGS[tiles[i]] & (TILE_GOAL | TILE_POWERUP) and safe(i, t):
+                return self.path_to(i, parents, w), False, None
+
+        # Then somewhere to drop a bomb from
+        if may_bomb:
+            spot = yield from self.bomb_spot(lvl, player, reached, parents, blocked, danger, burning, targets)
+            if spot is not None:
+                return spot
+
+        # Or closer to someone to blow up
+        chase = opponents or enemies
+        closest = None
+        for i, steps, t in reached if chase else []:
+            if self.worked(1 + len(chase)//2):
+                yield
+            if safe(i, t):
+                d = min(abs(i % w - x) + abs(i // w - y) for x, y in chase)
+                if closest is None or d < closest[0]:
+                    closest = d, i
+        if closest is not None:
+            return self.path_to(closest[1], parents, w), False, None
+        # Or just to the middle of its cell, out of reach of the cells around
+        return [(sx, sy)], False, None
+
+
+# What bots go by at one step of a level, worked out once for all of them
+# and a little at a time: when each cell will next be hit by a blast, the
+# flames burning, the cells that can't be walked into, how close cells are
+# to enemies, and the enemies and players to blow up.
+class BotSight:
+    def __init__(self, lvl):
+        self.level = lvl
+        self.now = lvl.scheduler.now
+        self.ready = False
+        self.building = self.build()
+
+    # Does the next bit of the work. Returns whether it's all done.
+    def advance(self):
+        if not self.ready:
+            next(self.building, None)
+        return self.ready
+
+    def build(self):
+        lvl = self.level
+        matrix = lvl.matrix
+        w = matrix.width
+        self.danger = lvl.danger.blast_times()
+        yield
+        burning = self.burning = {}
+        for f in lvl.flames:
+            i = f.pos[1]*w + f.pos[0]
+            burning[i] = max(burning.get(i, -math.inf), f.deadline)
+        # A wall falling in sudden death lands within a second, for good
+        if matrix.falling is not None:
+            fx, fy = matrix.falling
+            burning[fy*w + fx] = math.inf
+        blocked = self.blocked = bytearray(matrix.mask(TILE_SOLID))
+        for bx, by in lvl.bombs:
+            blocked[by*w + bx] = 1
+        yield
+
+        # Enemies are worth bombing like other players. The cells next to
+        # them are kept clear of, and those a step further are left for
+        # more open ground.
+        enemies = [e.pos for e in lvl.enemies if e.alive]
+        if lvl.swarm is not None:
+            s = lvl.swarm
+            enemies += [(x, y) for x, y, alive in zip(s.x.tolist(), s.y.tolist(), s.alive.tolist()) if alive]
+        self.enemies = [(round(x), round(y)) for x, y in enemies]
+        targets = self.targets = {}
+        near = self.near = {}
+        reach = Bot.ENEMY_REACH
+        for k, cell in enumerate(self.enemies):
+            if k % 8 == 7:
+                yield
+            targets[cell] = targets.get(cell, 0) + Bot.ENEMY_WORTH
+            for dx in range(-reach, reach + 1):
+                for dy in range(-reach + abs(dx), reach - abs(dx) + 1):
+                    x, y = cell[0] + dx, cell[1] + dy
+                    if matrix.in_bounds(x, y):
+                        d = abs(dx) + abs(dy)
+                        near[y*w + x] = min(near.get(y*w + x, d), d)
+                        if d <= 1:
+                            blocked[y*w + x] = 1
+        self.players = [(p, (round(p.pos[0]), round(p.pos[1]))) for p in lvl.players if p.alive]
+        self.ready = True
+
+
+# Runs bots before every step of a game, sharing out `budget` seconds of
+# CPU time (of the thread, so time the machine spends elsewhere isn't
+# counted) a step between them, keys held included. A bot that doesn't use
+# up its share leaves the rest to the next, and they take turns at going
+# first. The bots share a BotSight of every step. The garbage collector is
+# held off while they run, as a collection is charged to whatever happens
+# to be allocating and can take longer than the whole budget. It runs
+# during the game's step instead.
+class Bots:
+    BUDGET = 0.002
+    # Share of the budget given to thinking. The rest is slack for a
+    # stretch of the search that runs long.
+    THINKING = 0.85
+
+    def __init__(self, bots, budget=BUDGET):
+        self.bots = bots
+        self.budget = budget
+        self.turn = 0
+        self.sight = None
+        # Seconds kept back from thinking: how far past the time given to
+        # it the longest recent step went, the keys held included
+        self.reserve = 0
+
+    # Makes the bots the inputs of their players, which is done again for
+    # every step since games make new players for new levels
+    def attach(self, game):
+        players = game.level.players
+        for bot in self.bots:
+            players[bot.index].input = bot
+
+    # Whether `key` is one of the keys of a player controlled by a bot
+    def controls(self, game, key):
+        players = game.level.players
+        return any(key in players[bot.index].controls.values() for bot in self.bots)
+
+    def step(self, game, on_key=None):
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self.think_and_act(game, on_key)
+        finally:
+            if collecting:
+                gc.enable()
+
+    def think_and_act(self, game, on_key):
+        start = time.thread_time()
+        lvl = game.level
+        bots = self.bots[self.turn:] + self.bots[:self.turn]
+        self.turn = (self.turn + 1) % len(self.bots)
+        self.attach(game)
+        sight = self.sight
+        if sight is None or sight.level is not lvl or sight.now != lvl.scheduler.now:
+            sight = self.sight = BotSight(lvl)
+        thinking = max(self.budget*self.THINKING - self.reserve, 0)
+        for k, bot in enumerate(bots):
+            if time.thread_time() < start + thinking:
+                bot.think(lvl, start + thinking*(k + 1)/len(bots), sight)
+        acting = time.thread_time()
+        for bot in self.bots:
+            bot.act(game, on_key)
+        # Like Bot.stretch, a slow step counts for less and less
+        late = time.thread_time() - min(acting, start + thinking)
+        self.reserve = max(late, self.reserve*0.98)
+
+    # As a controller for HeadlessContext.run()
+    def __call__(self, ctx):
+        self.step(ctx.game)
+
+
+# Every change to any board gets a new version number from here, so two
+# boards (or one board at two times) with the same version have the same
+# tiles.
+TILE_VERSIONS = itertools.count(1)
+# Makes the next stage of classic games while the countdown to it runs
+LEVEL_WORKER = ThreadPoolExecutor(max_workers=1, thread_name_prefix='level')
+
+
+# The board is stored row by row in a bytearray of block values. Tile
+# properties come from TILE_FLAGS, and mask() gives whole-board masks of
+# them at once.
 class BlockMatrix:
-    def __init__(self, matrix=None, goal=None):
+    # Directions of the rays of an explosion, in the order they're walked:
+    # left, right, up and down
+    RAYS = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+    CHUNK = 8
+    # Chunks kept once they're out of view, least recently drawn dropped
+    # first. Has to be more than fit on the screen at once.
+    MAX_CHUNKS = 64
+    # Distance fields kept, least recently asked for dropped first
+    MAX_FIELDS = 32
+
+    # With no matrix, the board is grass surrounded by walls, with pillars
+    # on every other cell, `size` cells wide and high
+    def __init__(self, matrix=None, goal=None, size=BOARD_SIZE):
         self.sudden_death_fallen_blocks = (0, 0)
         self.falling = None
         self.falling_direction = 'right'
-        self.move_until = 9
-        self.exploding = []
+        # End times of the boxes being blown up, by position, and the
+        # position and end time of the goal being opened
+        self.exploding = {}
         self.door_opening = None
         self.goal_open = False
+        # The scheduler and DangerMap of the level played on this board
+        self.scheduler = None
+        self.danger = None
+        # Pre-rendered squares of CHUNK x CHUNK tiles by chunk coordinates,
+        # built when they first come into view. Only the cells in
+        # changed_tiles are redrawn on them afterwards.
+        self.chunks = OrderedDict()
+        self.chunk_scale = None
+        self.changed_tiles = set()
         if matrix is None:
-            self.matrix = [
-                [1 for _ in range(13)],
-                [i == 0 or i == 12 for i in range(13)],
-                [(i+1) % 2 for i in range(13)],
-                [i == 0 or i == 12 for i in range(13)],
-                [(i+1) % 2 for i in range(13)],
-                [i == 0 or i == 12 for i in range(13)],
-                [(i+1) % 2 for i in range(13)],
-                [i == 0 or i == 12 for i in range(13)],
-                [(i+1) % 2 for i in range(13)],
-                [i == 0 or i == 12 for i in range(13)],
-                [(i+1) % 2 for i in range(13)],
-                [i == 0 or i == 12 for i in range(13)],
-                [1 for _ in range(13)],
+            width, height = size
+            matrix = [
+              [
+                Block.WALL if Level.is_wall(x, y, width, height) else Block.GRASS
+                for x in range(width)
+              ]
+              for y in range(height)
             ]
 
-            self.matrix = [[Block(i) for i in row] for row in self.matrix]
-        else:
-            self.matrix = matrix
+        self.width = len(matrix[0])
+        self.height = len(matrix)
+        self.tiles = bytearray(block.value for row in matrix for block in row)
+        self.version = next(TILE_VERSIONS)
+        # (version, bytes of the tiles) of the last snapshot, shared by
+        # every snapshot taken until the tiles change
+        self.saved_tiles = None
+        # For each of the RAYS, how many cells in a row that aren't solid
+        # there are next to each cell in that direction. Rows and columns
+        # where a tile became or stopped being solid are counted again
+        # when next asked for.
+        self.runs = [[0]*(self.width*self.height) for _ in self.RAYS]
+        self.dirty_rows = set(range(self.height))
+        self.dirty_cols = set(range(self.width))
+        # Fields from distances() by (x, y, blocking), kept up to date as
+        # tiles change
+        self.fields = OrderedDict()
 
         if goal is not None:
             x, y = goal
-            self.matrix[y][x] = Block.BOX_GOAL
+            self.set_block(x, y, Block.BOX_GOAL)
+
+    # Rows of blocks, built on every access. Prefer get_block() and mask().
+    @property
+    def matrix(self):
+        w = self.width
+        return [[BLOCKS[v] for v in self.tiles[y*w:(y+1)*w]] for y in range(self.height)]
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def get_block(self, x, y):
+        return BLOCKS[self.tiles[y*self.width + x]]
+
+    def set_block(self, x, y, block):
+        i = y*self.width + x
+        old, new = TILE_FLAGS[self.tiles[i]], TILE_FLAGS[block.value]
+        if (old ^ new) & TILE_SOLID:
+            self.dirty_rows.add(y)
+            self.dirty_cols.add(x)
+        if (old ^ new) & (TILE_SOLID | TILE_EXPLODABLE) and self.danger is not None:
+            self.danger.tile_changed(x, y)
+        self.tiles[i] = block.value
+        self.version = next(TILE_VERSIONS)
+        self.changed_tiles.add((x, y))
+        if self.fields and old != new:
+            self.update_fields(i, old, new)
+
+    # Steps from (x, y) to every cell, row by row like the tiles, going
+    # through cells with none of the `blocking` flags. -1 where it can't
+    # get. The field is kept and updated as tiles change, so it's cheap
+    # to ask again (the list is shared: don't change it).
+    def distances(self, x, y, blocking=TILE_SOLID):
+        key = x, y, blocking
+        field = self.fields.get(key)
+        if field is not None:
+            self.fields.move_to_end(key)
+            return field
+        field = [-1]*len(self.tiles)
+        start = y*self.width + x
+        field[start] = 0
+        self.spread(field, [start], self.mask(blocking))
+        self.fields[key] = field
+        while len(self.fields) > self.MAX_FIELDS:
+            self.fields.popitem(last=False)
+        return field
+
+    # Breadth-first from the cells in `frontier`, lowering the distances
+    # of the cells around them that aren't `blocked`
+    def spread(self, field, frontier, blocked):
+        w, n = self.width, len(field)
+        while frontier:
+            reached = []
+            for i in frontier:
+                d = field[i] + 1
+                x = i % w
+                for j in (i - w, i + w, i - 1 if x else -1, i + 1 if x < w - 1 else -1):
+                    if 0 <= j < n and not blocked[j] and not 0 <= field[j] <= d:
+                        field[j] = d
+                        reached.append(j)
+            frontier = reached
+
+    # A cell that opens up (a box blown up) can only bring cells closer,
+    # so the fields spread from it. One that closes drops the fields it
+    # matters to, to be worked out again when asked for.
+    def update_fields(self, i, old, new):
+        w = self.width
+        for key, field in list(self.fields.items()):
+            blocking = key[2]
+            if old & blocking and not new & blocking:
+                x = i % w
+                around = [
+                  field[j] for j in (i - w, i + w, i - 1 if x else -1, i + 1 if x < w - 1 else -1)
+                  if 0 <= j < len(field) and field[j] >= 0
+                ]
+                if around and not 0 <= field[i] <= min(around) + 1:
+                    field[i] = min(around) + 1
+                    self.spread(field, [i], self.mask(blocking))
+            elif new & blocking and not old & blocking:
+                del self.fields[key]
+
+    # Cells that aren't solid right after (x, y) in the direction of
+    # RAYS[ray], up to the first solid one or the edge of the board
+    def free_run(self, x, y, ray):
+        if self.dirty_rows or self.dirty_cols:
+            self.count_runs()
+        return self.runs[ray][y*self.width + x]
+
+    def count_runs(self):
+        w, h = self.width, self.height
+        left, right, up, down = self.runs
+        solid = self.mask(TILE_SOLID)
+        for y in self.dirty_rows:
+            row = y*w
+            run = 0
+            for i in range(row, row + w):
+                left[i] = run
+                run = 0 if solid[i] else run + 1
+            run = 0
+            for i in range(row + w - 1, row - 1, -1):
+                right[i] = run
+                run = 0 if solid[i] else run + 1
+        for x in self.dirty_cols:
+            run = 0
+            for i in range(x, x + w*h, w):
+                up[i] = run
+                run = 0 if solid[i] else run + 1
+            run = 0
+            for i in range(x + w*(h-1), x - 1, -w):
+                down[i] = run
+                run = 0 if solid[i] else run + 1
+        self.dirty_rows.clear()
+        self.dirty_cols.clear()
+
+    def snapshot(self):
+        if self.saved_tiles is None or self.saved_tiles[0] != self.version:
+            self.saved_tiles = self.version, bytes(self.tiles)
+        return (
+          self.saved_tiles, dict(self.exploding), self.door_opening,
+          list(self.falling) if self.falling is not None else None,
+          self.falling_direction, self.sudden_death_fallen_blocks, self.goal_open,
+        )
+
+    # Tiles are only copied back if they changed since the snapshot, and
+    # only the ones that differ are redrawn.
+    def restore(self, state):
+        (
+          saved_tiles, exploding, door_opening, falling,
+          self.falling_direction, self.sudden_death_fallen_blocks, self.goal_open,
+        ) = state
+        version, tiles = saved_tiles
+        if version != self.version:
+            w = self.width
+            for i, (now, then) in enumerate(zip(self.tiles, tiles)):
+                if now != then:
+                    x, y = i % w, i // w
+                    self.changed_tiles.add((x, y))
+                    if (TILE_FLAGS[now] ^ TILE_FLAGS[then]) & TILE_SOLID:
+                        self.dirty_rows.add(y)
+                        self.dirty_cols.add(x)
+            self.tiles[:] = tiles
+            self.version = version
+            self.saved_tiles = saved_tiles
+            self.fields.clear()
+        self.exploding = dict(exploding)
+        self.door_opening = door_opening
+        self.falling = list(falling) if falling is not None else None
+
+    # Whole-board mask, row by row: 1 where a tile has any of the given
+    # TILE_* flags, 0 elsewhere.
+    def mask(self, flags):
+        return self.tiles.translate(mask_table(flags))
 
     def open_doors(self):
         self.goal_open = True
-        for y, row in enumerate(self.matrix):
-            for x, cell in enumerate(row):
-                if cell == Block.GOAL_CLOSED:
-                    self.door_opening = [(x, y), 0.5]
-                    self.matrix[y][x] = Block.GOAL_OPEN
-                    return
-
+        i = self.tiles.find(Block.GOAL_CLOSED.value)
+        if i != -1:
+            x, y = i % self.width, i // self.width
+            end = self.scheduler.now + 0.5
+            self.door_opening = (x, y), end
+            self.scheduler.at(end, self.door_opened, end)
+            self.set_block(x, y, Block.GOAL_OPEN)
+
+    def door_opened(self, end):
+        if self.door_opening is not None and self.door_opening[1] == end:
+            self.door_opening = None
+
+    # update_chunks() is to be called first, once for all of the canvases
+    # the board is drawn on
     def draw(self, canvas, lvl):
-        for i, row in enumerate(self.matrix):
-            for j, block in enumerate(row):
-                block.draw(canvas, j, i, lvl)
+        c = self.CHUNK
+        x0, y0, x1, y1 = canvas.visible_cells()
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.width), min(y1, self.height)
+        for cy in range(y0//c, (y1 - 1)//c + 1):
+            for cx in range(x0//c, (x1 - 1)//c + 1):
+                chunk = self.chunks.get((cx, cy))
+                if chunk is None:
+                    chunk = self.chunks[cx, cy] = self.build_chunk(cx, cy, lvl)
+                    canvas.mark((cx*c, cy*c), chunk.get_size())
+                else:
+                    self.chunks.move_to_end((cx, cy))
+                canvas.draw(chunk, (cx*c, cy*c), track=False)
+        while len(self.chunks) > self.MAX_CHUNKS:
+            self.chunks.popitem(last=False)
 
+        now = lvl.scheduler.now
         if self.door_opening != None:
-            pos, timer = self.door_opening
-            current_frame = int(timer//0.1)
+            pos, end = self.door_opening
+            current_frame = int((end - now)//0.1)
             current_frame = ASSETS['goal_opening'][current_frame]
             canvas.draw(current_frame, pos)
         if self.falling != None:
             timer = self.sudden_death_fallen_blocks[1]
             current_frame = ASSETS['materializing_wall'][int(timer*7)]
             canvas.delay_draw(current_frame, self.falling)
-        for x, y, e_time in self.exploding:
-            current_frame = int((0.375-e_time)//0.0625)
+        for (x, y), end in self.exploding.items():
+            current_frame = max(0, int((0.375-(end - now))//0.0625))
             current_frame = ASSETS['exploding_box'][current_frame]
             canvas.draw(current_frame, (x, y))
 
-    def loop(self, time):
-        if self.door_opening != None:
-            self.door_opening[1] -= time
-            if self.door_opening[1] <= 0:
-                self.door_opening = None
-        for i, (x, y, e_time) in enumerate(self.exploding):
-            e_time -= time 
-            if e_time <= 0:
-                del self.exploding[i]
-                continue
-            self.exploding[i] = (x, y, e_time)
+    def build_chunk(self, cx, cy, lvl):
+        c, scale = self.CHUNK, self.chunk_scale
+        x0, y0 = cx*c, cy*c
+        w, h = min(c, self.width - x0), min(c, self.height - y0)
+        chunk = pygame.Surface((w*scale, h*scale)).convert()
+        chunk.fill(LEVEL_BACKGROUND)
+        chunk_canvas = LevelCanvas(chunk, (0, 0), scale)
+        for y in range(h):
+            for x in range(w):
+                self.get_block(x0 + x, y0 + y).draw(chunk_canvas, x, y, lvl)
+        return chunk
+
+    def update_chunks(self, canvases, lvl):
+        scale = canvases[0].scale
+        if self.chunk_scale != scale:
+            self.chunks.clear()
+            self.chunk_scale = scale
+        c = self.CHUNK
+        for x, y in self.changed_tiles:
+            chunk = self.chunks.get((x//c, y//c))
+            if chunk is not None:
+                lx, ly = x % c, y % c
+                chunk.fill(LEVEL_BACKGROUND, (lx*scale, ly*scale, scale, scale))
+                self.get_block(x, y).draw(LevelCanvas(chunk, (0, 0), scale), lx, ly, lvl)
+            for canvas in canvases:
+                canvas.mark((x, y), (scale, scale))
+        self.changed_tiles.clear()
+
+    # Shows the box at (x, y) blowing up for a moment
+    def start_exploding(self, x, y):
+        end = self.scheduler.now + 0.375
+        self.exploding[x, y] = end
+        self.scheduler.at(end, self.stop_exploding, (x, y), end)
+
+    def stop_exploding(self, pos, end):
+        if self.exploding.get(pos) == end:
+            del self.exploding[pos]
 
     def explode_block(self, x, y):
-        block = self.matrix[y][x]
+        block = self.get_block(x, y)
         
-        if block in [Block.POWERUP_BLAST, Block.POWERUP_BOMBUP, Block.POWERUP_LIFE]:
-            self.matrix[y][x] = Block.GRASS
+        if block in POWERUP_BLOCKS:
+            self.set_block(x, y, Block.GRASS)
         elif block == Block.BOX:
-            self.exploding.append((x, y, 0.375))
-            self.matrix[y][x] = Block.GRASS
+            self.start_exploding(x, y)
+            self.set_block(x, y, Block.GRASS)
         elif block == Block.BOX_GOAL:
-            self.exploding.append((x, y, 0.375))
+            self.start_exploding(x, y)
             if self.goal_open:
-                self.matrix[y][x] = Block.GOAL_OPEN
+                self.set_block(x, y, Block.GOAL_OPEN)
             else:
-                self.matrix[y][x] = Block.GOAL_CLOSED
+                self.set_block(x, y, Block.GOAL_CLOSED)
         elif block == Block.BOX_POWERUP_BOMBUP:
-            self.exploding.append((x, y, 0.375))
-            self.matrix[y][x] = Block.POWERUP_BOMBUP
+            self.start_exploding(x, y)
+            self.set_block(x, y, Block.POWERUP_BOMBUP)
         elif block == Block.BOX_POWERUP_BLAST:
-            self.exploding.append((x, y, 0.375))
-            self.matrix[y][x] = Block.POWERUP_BLAST
+            self.start_exploding(x, y)
+            self.set_block(x, y, Block.POWERUP_BLAST)
         elif block == Block.BOX_POWERUP_LIFE:
-            self.exploding.append((x, y, 0.375))
-            self.matrix[y][x] = Block.POWERUP_LIFE
+            self.start_exploding(x, y)
+            self.set_block(x, y, Block.POWERUP_LIFE)
         return block
 
     def is_solid(self, x, y):
-        return self.matrix[y][x] in [
-          Block.WALL, Block.BOX, Block.BOX_GOAL, Block.BOX_POWERUP_BLAST, 
-          Block.BOX_POWERUP_BOMBUP, Block.BOX_POWERUP_LIFE
-        ]
+        return TILE_FLAGS[self.tiles[y*self.width + x]] & TILE_SOLID != 0
     
     def drop_wall(self, x, y):
         self.falling = [x, y]
@@ -765,56 +1942,56 @@ class BlockMatrix:
             self.drop_wall(1, 1)
         else:
             px, py = self.falling
-            self.matrix[py][px] = Block.WALL
+            self.set_block(px, py, Block.WALL)
             for _ in range(4):
                 if self.falling_direction == 'right':
-                    for i in range(px, 13):
-                        if self.matrix[py][i] != Block.WALL:
+                    for i in range(px, self.width):
+                        if self.get_block(i, py) != Block.WALL:
                             self.drop_wall(i, py)
                             return
                     self.falling_direction = 'down'
                 elif self.falling_direction == 'down':
-                    for i in range(py, 13):
-                        if self.matrix[i][px] != Block.WALL:
+                    for i in range(py, self.height):
+                        if self.get_block(px, i) != Block.WALL:
                             self.drop_wall(px, i)
                             return
                     self.falling_direction = 'left'
                 elif self.falling_direction == 'left':
                     for i in range(px, -1, -1):
-                        if self.matrix[py][i] != Block.WALL:
+                        if self.get_block(i, py) != Block.WALL:
                             self.drop_wall(i, py)
                             return
                     self.falling_direction = 'up'
                 elif self.falling_direction == 'up':
                     for i in range(py, -1, -1):
-                        if self.matrix[i][px] != Block.WALL:
+                        if self.get_block(px, i) != Block.WALL:
                             self.drop_wall(px, i)
                             return
                     self.falling_direction = 'right_j'
                 if self.falling_direction == 'right_j':
-                    for i in range(px, 13):
-                        if self.matrix[py][i] != Block.WALL:
+                    for i in range(px, self.width):
+                        if self.get_block(i, py) != Block.WALL:
                             self.drop_wall(i, py)
                             return
                     px += 1
                     self.falling_direction = 'down_j'
                 elif self.falling_direction == 'down_j':
-                    for i in range(py, 13):
-                        if self.matrix[i][px] != Block.WALL:
+                    for i in range(py, self.height):
+                        if self.get_block(px, i) != Block.WALL:
                             self.drop_wall(px, i)
                             return
                     py += 1
                     self.falling_direction = 'left_j'
                 elif self.falling_direction == 'left_j':
                     for i in range(px, -1, -1):
-                        if self.matrix[py][i] != Block.WALL:
+                        if self.get_block(i, py) != Block.WALL:
                             self.drop_wall(i, py)
                             return
                     px -= 1
                     self.falling_direction = 'up_j'
                 elif self.falling_direction == 'up_j':
                     for i in range(py, -1, -1):
-                        if self.matrix[i][px] != Block.WALL:
+                        if self.get_block(px, i) != Block.WALL:
                             self.drop_wall(px, i)
                             return
                     self.falling_direction = 'right'
@@ -839,30 +2016,33 @@ class BlockMatrix:
                 elif -1 <= px - wx <= 1 and -1 <= py - wy <= 1:
                     player.pos[0] = round(player.pos[0])
                     player.pos[1] = round(player.pos[1])
-            for flame in game.level.flames:
-                if flame.pos == self.falling:
-                    flame.timer = 0
             if self.falling != None:
-                if tuple(self.falling) in game.level.bombs:
-                    del game.level.bombs[tuple(self.falling)]
+                for flame in game.level.flames_near(*self.falling, reach=0):
+                    if flame.pos == self.falling:
+                        game.level.put_out(flame)
+            if self.falling != None:
+                bomb = game.level.bombs.get(tuple(self.falling))
+                if bomb is not None:
+                    game.level.remove_bomb(bomb)
             self.drop_next_wall()
         self.sudden_death_fallen_blocks = fallen, current
 
     def is_goal(self, x, y):
-        return self.matrix[y][x] == Block.GOAL_OPEN
+        return self.tiles[y*self.width + x] == Block.GOAL_OPEN.value
 
     def check_obtains_powerups(self, player):
         x, y = player.pos
         rx, ry = int(round(x)), int(round(y))
         if -0.25 <= x - rx <= 0.25 and -0.25 <= y - ry <= 0.25:
-            if self.matrix[ry][rx] == Block.POWERUP_BOMBUP:
-                self.matrix[ry][rx] = Block.GRASS
+            block = self.get_block(rx, ry)
+            if block == Block.POWERUP_BOMBUP:
+                self.set_block(rx, ry, Block.GRASS)
                 player.max_bombs += 1
-            elif self.matrix[ry][rx] == Block.POWERUP_BLAST:
-                self.matrix[ry][rx] = Block.GRASS
+            elif block == Block.POWERUP_BLAST:
+                self.set_block(rx, ry, Block.GRASS)
                 player.bomb_blast_radius += 1
-            elif self.matrix[ry][rx] == Block.POWERUP_LIFE:
-                self.matrix[ry][rx] = Block.GRASS
+            elif block == Block.POWERUP_LIFE:
+                self.set_block(rx, ry, Block.GRASS)
                 player.game.lives += 1
 
     def check_enters_goal(self, x, y):
@@ -870,24 +2050,168 @@ class BlockMatrix:
         return self.is_goal(x, y) 
 
     def check_bomb_placeable(self, x, y):
-        return self.matrix[y][x] in [Block.GRASS, Block.GOAL_CLOSED]
+        return TILE_FLAGS[self.tiles[y*self.width + x]] & TILE_PLACEABLE != 0
 
     def check_collides(self, x, y):
         xl, xh, yl, yh = list_colliding_coordinates(x, y)
-        return self.is_solid(xl, yl) or self.is_solid(xl, yh) or self.is_solid(xh, yl) or self.is_solid(xh, yh)
+        tiles, w = self.tiles, self.width
+        return (
+          TILE_FLAGS[tiles[yl*w + xl]] | TILE_FLAGS[tiles[yh*w + xl]]
+          | TILE_FLAGS[tiles[yl*w + xh]] | TILE_FLAGS[tiles[yh*w + xh]]
+        ) & TILE_SOLID != 0
 
 
+MASK_TABLES = {}
+
+
+# bytes.translate() table mapping each block value to 1 if it has any of
+# the given flags and to 0 otherwise.
+def mask_table(flags):
+    table = MASK_TABLES.get(flags)
+    if table is None:
+        table = bytes(
+          1 if v < len(TILE_FLAGS) and TILE_FLAGS[v] & flags else 0 for v in range(256)
+        )
+        MASK_TABLES[flags] = table
+    return table
+
+
+# Draws level objects, given in cells, on the area of the screen that
+# starts at `pos` and is `view` pixels big (the rest of the screen by
+# default). The camera is the level pixel shown at the top left corner of
+# that area. Whatever falls outside of it is skipped or clipped.
 class LevelCanvas:
-    def __init__(self, screen, pos, scale=50):
+    # Fraction of the view, around its centre, that what the camera
+    # follows can move in without the camera moving
+    DEAD_ZONE = 0.25
+    # Pixels between the views of a split screen
+    SPLIT_GAP = 4
+
+    def __init__(self, screen, pos, scale=50, renderer=None, view=None):
         self.screen = screen
         self.pos = pos
         self.scale = scale
+        self.renderer = renderer
         self.delayed = []
+        if view is None and screen is not None:
+            view = screen.get_width() - pos[0], screen.get_height() - pos[1]
+        self.view = view
+        self.camera = None
+        # Canvases side by side on this one's area, one per point followed,
+        # while the points are too far apart to be shown together
+        self.split = None
+
+    # The canvases to draw a board of `size` cells on, each with the
+    # points (level positions) it is to follow: this one, for all of them,
+    # if they fit in its view together wherever the dead zone lets the
+    # camera be, or else a view of its own for each. They're split a little
+    # earlier than they're put back together, so the screen doesn't flick
+    # between the two.
+    def views(self, points, size):
+        fraction = 1 - self.DEAD_ZONE if self.split is None else 1 - 2*self.DEAD_ZONE
+        fits = len(points) == 1 or all(
+          size[axis]*self.scale <= self.view[axis]
+          or (max(p[axis] for p in points) - min(p[axis] for p in points) + 1)*self.scale
+          <= self.view[axis]*fraction
+          for axis in (0, 1)
+        )
+        if fits:
+            if self.split is not None:
+                self.split = None
+                self.camera = None
+                self.mark_view()
+            return [(self, points)]
+
+        if self.split is None or len(self.split) != len(points):
+            n = len(points)
+            width = (self.view[0] - self.SPLIT_GAP*(n - 1))//n
+            self.split = [
+              LevelCanvas(
+                self.screen, (self.pos[0] + k*(width + self.SPLIT_GAP), self.pos[1]),
+                self.scale, self.renderer, (width, self.view[1]),
+              )
+              for k in range(n)
+            ]
+            self.mark_view()
+        return [(canvas, [p]) for canvas, p in zip(self.split, points)]
+
+    # Moves the camera so that it keeps the centre of `points` (level
+    # positions) in the middle of the view, without showing what's past
+    # the edges of a board of `size` cells. Boards smaller than the view
+    # are centred in it.
+    def follow(self, points, size):
+        cx = (sum(p[0] for p in points)/len(points) + 0.5)*self.scale
+        cy = (sum(p[1] for p in points)/len(points) + 0.5)*self.scale
+        camera = [
+          self.follow_axis(cx, 0, size[0]*self.scale),
+          self.follow_axis(cy, 1, size[1]*self.scale),
+        ]
+        if camera != self.camera:
+            self.camera = camera
+            self.mark_view()
+
+    def follow_axis(self, target, axis, length):
+        view = self.view[axis]
+        if length <= view:
+            return -((view - length)//2)
+        if self.camera is None:
+            camera = target - view/2
+        else:
+            camera = self.camera[axis]
+            low = camera + view*(1 - self.DEAD_ZONE)/2
+            high = camera + view*(1 + self.DEAD_ZONE)/2
+            if target < low:
+                camera -= low - target
+            elif target > high:
+                camera += target - high
+        return int(round(min(max(camera, 0), length - view)))
+
+    # Cells at least partly in view, as x0, y0 (included), x1, y1 (excluded)
+    def visible_cells(self):
+        camx, camy = self.camera or (0, 0)
+        s = self.scale
+        return camx//s, camy//s, -(-(camx + self.view[0])//s), -(-(camy + self.view[1])//s)
+
+    # Whether something at pos, at most `margin` cells bigger than a cell
+    # in any direction, may be in view
+    def in_view(self, pos, margin=1):
+        x0, y0, x1, y1 = self.visible_cells()
+        return x0 - margin <= pos[0] < x1 + margin and y0 - margin <= pos[1] < y1 + margin
+
+    def mark_view(self):
+        if self.renderer is not None:
+            self.renderer.mark((self.pos, self.view))
     
-    def draw(self, img, pos):
-        x = pos[0]*self.scale + self.pos[0]
-        y = pos[1]*self.scale + self.pos[1]
-        self.screen.blit(img, (x, y))
+    # Untracked draws (track=False) are for content that is known not to
+    # have changed since the last frame, so it isn't pushed to the display.
+    def draw(self, img, pos, track=True):
+        camx, camy = self.camera or (0, 0)
+        x = pos[0]*self.scale - camx
+        y = pos[1]*self.scale - camy
+        w, h = img.get_size()
+        vw, vh = self.view
+        if x >= vw or y >= vh or x + w <= 0 or y + h <= 0:
+            return
+        if x < 0 or y < 0 or x + w > vw or y + h > vh:
+            area = pygame.Rect(x, y, w, h).clip((0, 0, vw, vh))
+            rect = self.screen.blit(
+              img, (area.x + self.pos[0], area.y + self.pos[1]), area.move(-x, -y),
+            )
+        else:
+            rect = self.screen.blit(img, (x + self.pos[0], y + self.pos[1]))
+        if track and self.renderer is not None:
+            self.renderer.mark(rect)
+
+    # Marks an area given in level coordinates (and a size in pixels) as
+    # changed.
+    def mark(self, pos, size):
+        if self.renderer is not None:
+            camx, camy = self.camera or (0, 0)
+            x = pos[0]*self.scale - camx + self.pos[0]
+            y = pos[1]*self.scale - camy + self.pos[1]
+            rect = pygame.Rect(x, y, size[0], size[1]).clip((self.pos, self.view))
+            if rect.width and rect.height:
+                self.renderer.mark(rect)
 
     def draw_delayed(self):
         for img, pos in self.delayed:
@@ -900,47 +2224,641 @@ class LevelCanvas:
         self.delayed.append((img, pos))
 
 
+# Buckets entities by the board cell nearest to their position, so that
+# collision checks only look at the entities around a position instead of
+# every entity in the level.
+class SpatialIndex:
+    # Below this many entities, handing all of them to the caller is
+    # cheaper than looking up the cells one by one.
+    SCAN_LIMIT = 8
+
+    def __init__(self, entities=()):
+        self.cells = {}
+        self.cell_of = {}
+        for entity in entities:
+            self.add(entity, entity.pos)
+
+    def add(self, entity, pos):
+        cell = round(pos[0]), round(pos[1])
+        self.cell_of[entity] = cell
+        bucket = self.cells.get(cell)
+        if bucket is None:
+            self.cells[cell] = [entity]
+        else:
+            bucket.append(entity)
+
+    # add() for many entities whose positions are whole cells already
+    def add_all(self, entities):
+        cells, cell_of = self.cells, self.cell_of
+        for entity in entities:
+            cell = entity.pos[0], entity.pos[1]
+            cell_of[entity] = cell
+            bucket = cells.get(cell)
+            if bucket is None:
+                cells[cell] = [entity]
+            else:
+                bucket.append(entity)
+
+    def remove(self, entity):
+        cell = self.cell_of.pop(entity)
+        bucket = self.cells[cell]
+        bucket.remove(entity)
+        if not bucket:
+            del self.cells[cell]
+
+    def move(self, entity, pos):
+        if self.cell_of[entity] != (round(pos[0]), round(pos[1])):
+            self.remove(entity)
+            self.add(entity, pos)
+
+    # Entities in the cells at most `reach` cells away from (x, y)'s (and
+    # possibly a few more, so callers still have to check collisions). Flames
+    # and enemies collide at less than one cell of distance, so the default
+    # covers every possible collision.
+    def near(self, x, y, reach=1):
+        if len(self.cell_of) <= self.SCAN_LIMIT:
+            return self.cell_of.keys()
+        cx, cy = round(x), round(y)
+        if reach == 0:
+            return self.cells.get((cx, cy), [])
+        found = []
+        for i in range(cx-reach, cx+reach+1):
+            for j in range(cy-reach, cy+reach+1):
+                bucket = self.cells.get((i, j))
+                if bucket:
+                    found += bucket
+        return found
+
+    def __len__(self):
+        return len(self.cell_of)
+
+
+# Calls actions at given times of a clock that moves on with every step of
+# a level. Pending calls are kept in a heap, so a step costs as much as the
+# calls that fall due in it, however many are waiting. Calls due at the
+# same time are made in the order they were scheduled.
+class Scheduler:
+    def __init__(self):
+        self.now = 0.0
+        self.heap = []
+        self.scheduled = 0
+
+    # Calls action(*args) once the clock reaches `when`. Calls can't be
+    # taken back, so actions check whether they're still wanted (usually
+    # that a deadline they were given is still the one set).
+    def at(self, when, action, *args):
+        heapq.heappush(self.heap, (when, self.scheduled, action, args))
+        self.scheduled += 1
+
+    def advance(self, time):
+        self.now += time
+        heap = self.heap
+        while heap and heap[0][0] <= self.now:
+            _, _, action, args = heapq.heappop(heap)
+            action(*args)
+
+    def snapshot(self):
+        return self.now, list(self.heap), self.scheduled
+
+    def restore(self, state):
+        self.now, heap, self.scheduled = state
+        self.heap = list(heap)
+
+
+# Steps from every cell to the nearest living player, going around solid
+# tiles and bombs, for enemies that chase the players. There's one per
+# level, shared by all its enemies, and it's only worked out again when a
+# player moves to another cell, a bomb is placed or goes off, or the tiles
+# change, so it costs the same for a handful of enemies as for hundreds.
+class FlowField:
+    # [UP, RIGHT, DOWN, LEFT], the order enemies pick directions in
+    STEPS = [((0, -1), 'up'), ((1, 0), 'right'), ((0, 1), 'down'), ((-1, 0), 'left')]
+
+    def __init__(self):
+        # (player cells, tiles version, bombs) the field was worked out for
+        self.key = None
+        self.width = None
+        self.height = None
+        self.field = None
+        self.blocked = None
+        self.array = None
+
+    def update(self, lvl):
+        m = lvl.matrix
+        sources = tuple((round(p.pos[0]), round(p.pos[1])) for p in lvl.players if p.alive)
+        key = sources, m.version, tuple(lvl.bombs)
+        if key == self.key:
+            return
+        self.key = key
+        self.width, self.height = w, h = m.width, m.height
+        self.blocked = blocked = bytearray(m.mask(TILE_SOLID))
+        for bx, by in lvl.bombs:
+            blocked[by*w + bx] = 1
+        self.field = field = [-1]*(w*h)
+        frontier = []
+        for x, y in sources:
+            if 0 <= x < w and 0 <= y < h and field[y*w + x] != 0:
+                field[y*w + x] = 0
+                frontier.append(y*w + x)
+        m.spread(field, frontier, blocked)
+        self.array = None
+
+    # Way to go from (x, y) to get closer to a player, or None if there's
+    # no way to any of them
+    def direction(self, x, y):
+        w, h, field, blocked = self.width, self.height, self.field, self.blocked
+        best = None
+        for (dx, dy), direction in self.STEPS:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < w and 0 <= ny < h:
+                i = ny*w + nx
+                if not blocked[i] and field[i] >= 0 and (best is None or field[i] < best[0]):
+                    best = field[i], direction
+        return best[1] if best is not None else None
+
+    # The field as a height by width array, for EnemySwarm
+    def grid(self):
+        if self.array is None:
+            self.array = np.array(self.field, dtype=np.int32).reshape(self.height, self.width)
+        return self.array
+
+
+# When each cell will next be hit by flames from the bombs on the board,
+# as the time of the level's scheduler the bomb that does it falls due
+# (the flames show up on the first step at or after it), math.inf where
+# none will. A bomb in the blast of another goes off CHAIN_DELAY after
+# it, if that's sooner than its own fuse, and the boxes a bomb breaks no
+# longer stop the blasts of the bombs that go off after it. Bombs due at
+# the very same time go off in an order this can't see, so each of them
+# is taken to go off after the others, which can have a blast reach a
+# little farther than it will.
+# Kept by the level as bombs are placed, hurried and taken away and as
+# tiles change, and only worked out when asked for, for the bombs and
+# cells it changed for: looking a cell up is then a list index.
+class DangerMap:
+    # Same as in Level.burn
+    CHAIN_DELAY = 0.25
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.width = matrix.width
+        self.times = [math.inf]*(matrix.width*matrix.height)
+        # By position: the bombs, the cells they blow up and the boxes
+        # they break with the tiles as they are, the cells they blow up
+        # once the boxes broken before they go off are out of the way, and
+        # the time they go off at
+        self.bombs = {}
+        self.reaches = {}
+        self.blasts = {}
+        self.due = {}
+        # Positions of the bombs whose blast reaches each cell
+        self.covering = {}
+        # Bombs whose blast has to be worked out again, and whether the
+        # times they go off at do
+        self.stale = set()
+        self.retime = False
+        # Cells whose time has to be worked out again
+        self.stale_cells = set()
+
+    def add(self, bomb):
+        self.bombs[bomb.pos] = bomb
+        self.blasts[bomb.pos] = []
+        self.stale.add(bomb.pos)
+
+    def remove(self, bomb):
+        pos = bomb.pos
+        del self.bombs[pos]
+        self.stale.discard(pos)
+        self.due.pop(pos, None)
+        self.reaches.pop(pos, None)
+        for i in self.blasts.pop(pos):
+            self.covering[i].discard(pos)
+            self.stale_cells.add(i)
+        self.retime = True
+
+    # The bomb's fuse got shorter
+    def hurry(self, bomb):
+        self.retime = True
+
+    # Bombs in the same row or column, close enough for the tile at (x, y)
+    # becoming or stopping being solid (or breakable) to change how far
+    # their blast goes
+    def tile_changed(self, x, y):
+        for (bx, by), bomb in self.bombs.items():
+            if (bx == x and abs(by - y) < bomb.radius) or (by == y and abs(bx - x) < bomb.radius):
+                self.stale.add((bx, by))
+
+    def reset(self, bombs):
+        self.__init__(self.matrix)
+        for bomb in bombs:
+            self.add(bomb)
+
+    # Same cells as Level.explode covers with flames, and the boxes its
+    # rays stop at and break, with the cells in `broken` (boxes broken
+    # before) taken for open ground
+    def blast(self, bomb, broken=()):
+        matrix, w = self.matrix, self.width
+        x, y = bomb.pos
+        cells = [y*w + x]
+        breaks = []
+        if bomb.radius > 1 and not matrix.is_solid(x, y):
+            for ray, (dx, dy) in enumerate(BlockMatrix.RAYS):
+                step = dy*w + dx
+                cx, cy, i, left = x, y, cells[0], bomb.radius - 1
+                while True:
+                    reach = min(matrix.free_run(cx, cy, ray), left)
+                    cells += range(i + step, i + step*(reach + 1), step)
+                    left -= reach
+                    cx, cy, i = cx + dx*(reach + 1), cy + dy*(reach + 1), i + step*(reach + 1)
+                    if not left or not matrix.in_bounds(cx, cy):
+                        break
+                    left -= 1
+                    if i in broken:
+                        cells.append(i)
+                    else:
+                        if TILE_FLAGS[matrix.tiles[i]] & TILE_EXPLODABLE:
+                            breaks.append(i)
+                        break
+        return cells, breaks
+
+    # Each bomb goes off at its own deadline or CHAIN_DELAY after the
+    # first bomb whose blast reaches it, whichever is sooner, so the times
+    # are found like shortest paths from the bombs' deadlines. Bombs are
+    # taken in the order they go off, each with the boxes broken by the
+    # ones before it out of its way.
+    def time_bombs(self):
+        w = self.width
+        due = {pos: bomb.deadline for pos, bomb in self.bombs.items()}
+        heap = [(t, pos) for pos, t in due.items()]
+        heapq.heapify(heap)
+        broken = set()
+        gone = set()
+        while heap:
+            t = heap[0][0]
+            group = {}
+            while heap and heap[0][0] == t:
+                pos = heapq.heappop(heap)[1]
+                if pos not in gone:
+                    gone.add(pos)
+                    group[pos] = self.reaches[pos]
+            if len(group) > 1:
+                self.go_off_together(group, broken)
+            for pos, (cells, breaks) in group.items():
+                if broken and not broken.isdisjoint(breaks):
+                    group[pos] = cells, breaks = self.blast(self.bombs[pos], broken)
+            for pos, (cells, breaks) in group.items():
+                broken.update(breaks)
+                self.cover(pos, cells)
+                for i in cells:
+                    other = i % w, i // w
+                    if other in due and t + self.CHAIN_DELAY < due[other]:
+                        due[other] = t + self.CHAIN_DELAY
+                        heapq.heappush(heap, (due[other], other))
+        for pos, t in due.items():
+            if self.due.get(pos) != t:
+                self.stale_cells.update(self.blasts[pos])
+        self.due = due
+
+    # The blasts of the bombs in `group` (cells and breaks by position),
+    # which go off at the same time, in whatever order the scheduler takes
+    # them: each is worked out as if it went off after the others, with
+    # the boxes any of the others' flames reach out of its way, as well as
+    # those `broken` before
+    def go_off_together(self, group, broken):
+        # The bombs whose flames reach each box
+        reaching = {}
+        for pos, (cells, breaks) in group.items():
+            for i in breaks:
+                reaching.setdefault(i, set()).add(pos)
+        changed = True
+        while changed:
+            changed = False
+            for pos, (cells, breaks) in group.items():
+                if any(i in broken or reaching[i] != {pos} for i in breaks):
+                    others = broken.union(i for i, by in reaching.items() if by != {pos})
+                    group[pos] = cells, breaks = self.blast(self.bombs[pos], others)
+                    for i in breaks + [i for i in cells if i in reaching]:
+                        reaching.setdefault(i, set()).add(pos)
+                    changed = True
+
+    # Has the bomb at `pos` blow up `cells`
+    def cover(self, pos, cells):
+        old = self.blasts[pos]
+        if cells == old:
+            return
+        for i in old:
+            self.covering[i].discard(pos)
+        for i in cells:
+            self.covering.setdefault(i, set()).add(pos)
+        self.stale_cells.update(old)
+        self.stale_cells.update(cells)
+        self.blasts[pos] = cells
+
+    def update(self):
+        for pos in self.stale:
+            self.reaches[pos] = self.blast(self.bombs[pos])
+            self.retime = True
+        self.stale.clear()
+        if self.retime:
+            self.time_bombs()
+            self.retime = False
+        due, times = self.due, self.times
+        for i in self.stale_cells:
+            times[i] = min([due[pos] for pos in self.covering.get(i, ())], default=math.inf)
+        self.stale_cells.clear()
+
+    # The time of every cell, row by row like the tiles (the list is
+    # shared: don't change it)
+    def blast_times(self):
+        if self.stale or self.retime or self.stale_cells:
+            self.update()
+        return self.times
+
+
 class Level:
-    def __init__(self, canvas, matrix, players, enemies=[]):
+    # `swarm` chooses whether enemies are simulated together by an
+    # EnemySwarm (which needs NumPy) or one by one. By default a swarm is
+    # used for levels with many enemies.
+    # `rng` seeds the swarm, and defaults to the game's.
+    def __init__(self, canvas, matrix, players, enemies=[], swarm=None, rng=None):
         self.canvas = canvas
         self.matrix = matrix
         self.players = players
         self.bombs = {}
-        self.flames = []
+        # Used as an ordered set, for flames to be taken out of it quickly
+        self.flames = {}
+        self.scheduler = Scheduler()
+        matrix.scheduler = self.scheduler
+        self.danger = DangerMap(matrix)
+        matrix.danger = self.danger
+        self.swarm = None
+        if swarm is None:
+            swarm = len(enemies) >= EnemySwarm.MIN_ENEMIES
+        if swarm and enemies and np is not None:
+            game = enemies[0].game
+            if rng is None:
+                rng = game.rng
+            self.swarm = EnemySwarm(game, enemies, rng.getrandbits(64))
+            enemies = []
         self.enemies = enemies
-
+        self.flame_index = SpatialIndex()
+        self.enemy_index = SpatialIndex(enemies)
+        # FlowField the enemies follow to the players, if they chase them
+        self.flow = None
+        # Flames that burnt out and bombs that went off, by class, kept to
+        # be made into new ones rather than left to the garbage collector
+        self.spare_flames = {CenterFlame: [], HorizontalFlame: [], VerticalFlame: []}
+        self.spare_bombs = []
+
+    # Only what's in view of the camera, which follows the players still
+    # alive, is drawn. Players too far apart to be seen together are each
+    # followed on a view of their own (see LevelCanvas.views).
     def draw(self):
-        self.matrix.draw(self.canvas, self)
+        alive = [p.pos for p in self.players if p.alive]
+        size = (self.matrix.width, self.matrix.height)
+        views = self.canvas.views(alive or [p.pos for p in self.players], size)
+        for canvas, points in views:
+            canvas.follow(points, size)
+        self.matrix.update_chunks([canvas for canvas, _ in views], self)
+        for canvas, _ in views:
+            self.draw_view(canvas)
+
+    def draw_view(self, canvas):
+        now = self.scheduler.now
+        self.matrix.draw(canvas, self)
         for flame in self.flames:
-            flame.draw(self.canvas)
+            if canvas.in_view(flame.pos):
+                flame.draw(canvas, now)
         for bomb in self.bombs.values():
-            bomb.draw(self.canvas)
+            if canvas.in_view(bomb.pos):
+                bomb.draw(canvas, now)
         for player in self.players:
-            player.draw(self.canvas)    
+            if canvas.in_view(player.pos):
+                player.draw(canvas)
         for enemy in self.enemies:
-            enemy.draw(self.canvas)
+            if canvas.in_view(enemy.pos):
+                enemy.draw(canvas)
+        if self.swarm is not None:
+            self.swarm.draw(canvas)
 
-        self.canvas.draw_delayed()
+        canvas.draw_delayed()
 
+    # Bombs, flames, box explosions and the goal opening all run on the
+    # scheduler
     def loop(self, time):
-        self.matrix.loop(time)
-        for flame in self.flames:
-            flame.loop(self, time)
-        for bomb in self.bombs.values():
-            bomb.loop(self, time)
-        # Remove items that have a None value
-        for k in list(self.bombs.keys()):
-            if self.bombs[k] == None:
-                del self.bombs[k]
+        self.scheduler.advance(time)
         for player in self.players:
             player.loop(self, time)    
+        if self.flow is not None:
+            self.flow.update(self)
         for enemy in self.enemies:
             enemy.loop(self, time)
+        if self.swarm is not None:
+            self.swarm.loop(self, time)
 
     def handle_key(self, key):
         for player in self.players:
             player.handle_key(key, self)
 
+    # The state of the level, to go back to with restore(). Entities are
+    # kept by reference along with the few fields of theirs that change,
+    # and the tiles are shared with earlier snapshots while unchanged, so
+    # this is cheap enough to call every step.
+    def snapshot(self):
+        return (
+          self.matrix.snapshot(),
+          self.scheduler.snapshot(),
+          [(b, b.snapshot()) for b in self.bombs.values()],
+          [(f, f.snapshot()) for f in self.flames],
+          [(e, e.snapshot()) for e in self.enemies],
+          [p.snapshot() for p in self.players],
+          self.swarm.snapshot() if self.swarm is not None else None,
+        )
+
+    def restore(self, state):
+        matrix, scheduler, bombs, flames, enemies, players, swarm = state
+        self.matrix.restore(matrix)
+        self.scheduler.restore(scheduler)
+        self.bombs = {}
+        for b, s in bombs:
+            b.restore(s)
+            self.bombs[b.pos] = b
+        for f, s in flames:
+            f.restore(s)
+        self.flames = dict.fromkeys(f for f, _ in flames)
+        for e, s in enemies:
+            e.restore(s)
+        self.enemies = [e for e, _ in enemies]
+        for p, s in zip(self.players, players):
+            p.restore(s)
+        if swarm is not None:
+            self.swarm.restore(swarm)
+        self.flame_index = SpatialIndex(self.flames)
+        self.enemy_index = SpatialIndex(self.enemies)
+        # Some spares may be back in play
+        self.spare_flames = {kind: [] for kind in self.spare_flames}
+        self.spare_bombs = []
+        self.danger.reset(self.bombs.values())
+
+    # Digest of everything the simulation depends on. Two levels with the
+    # same checksum are in the same state, bit for bit (float reprs are
+    # exact), which is what replays and desync checks compare.
+    def checksum(self):
+        m = self.matrix
+        players = self.players
+        state = [
+          bytes(m.tiles), m.exploding, m.door_opening, m.falling, m.falling_direction,
+          m.sudden_death_fallen_blocks, m.goal_open, self.scheduler.now,
+          [
+            (p.pos, p.direction, p.alive, p.time_since_dead, p.max_bombs,
+             p.bomb_blast_radius, p.trying_to_place_bomb_timer)
+            for p in players
+          ],
+          [
+            (b.pos, b.deadline, b.radius, b.chaining, players.index(b.placer) if b.placer in players else None)
+            for b in self.bombs.values()
+          ],
+          [(type(f).__name__, f.pos, f.deadline, getattr(f, 'radius', None)) for f in self.flames],
+          [
+            (e.pos, e.direction, e.alive, e.time_to_disappear, e.clock, e.eyes_closed,
+             e.blink_tick, e.seconds_since_eyes_closed)
+            for e in self.enemies
+          ],
+        ]
+        if self.swarm is not None:
+            s = self.swarm
+            state.append([
+              a.tobytes() for a in [
+                s.x, s.y, s.direction, s.alive, s.time_to_disappear, s.clock,
+                s.eyes_closed, s.blink_tick, s.seconds_since_eyes_closed,
+              ]
+            ])
+            state.append(repr(s.rng.bit_generator.state))
+        return hashlib.sha1(repr(state).encode()).hexdigest()
+
+    # Flames that all burn out at `deadline`
+    def add_flames(self, flames, deadline):
+        self.flames.update(dict.fromkeys(flames))
+        self.flame_index.add_all(flames)
+        self.scheduler.at(deadline, self.burn_out, flames, deadline)
+
+    def burn_out(self, flames, deadline):
+        for flame in flames:
+            # Put out early, or burnt out and reused since
+            if flame.deadline != deadline or flame not in self.flames:
+                continue
+            del self.flames[flame]
+            self.flame_index.remove(flame)
+            self.spare_flames[type(flame)].append(flame)
+
+    # Has a flame burn out on the next step
+    def put_out(self, flame):
+        flame.deadline = self.scheduler.now
+        self.scheduler.at(flame.deadline, self.burn_out, [flame], flame.deadline)
+
+    # Breaks the tile at (x, y) and hurries a bomb there. Returns whether
+    # the tile was solid, which stops the flame.
+    def burn(self, x, y):
+        matrix = self.matrix
+        flags = TILE_FLAGS[matrix.tiles[y*matrix.width + x]]
+        # Most flames land on plain grass, which nothing happens to
+        if flags & (TILE_EXPLODABLE | TILE_POWERUP):
+            matrix.explode_block(x, y)
+        bomb = self.bombs.get((x, y))
+        if bomb is not None:
+            bomb.chaining = True
+            hurried = self.scheduler.now + 0.25
+            if bomb.deadline > hurried:
+                bomb.deadline = hurried
+                self.scheduler.at(hurried, self.bomb_due, bomb, hurried)
+                self.danger.hurry(bomb)
+        return flags & TILE_SOLID != 0
+
+    # Sets off an explosion reaching `radius` - 1 cells out from (x, y).
+    # Each ray covers the free cells ahead of it, as counted by
+    # matrix.free_run(), and burns the solid tile that stops it without
+    # covering it. Flames are listed farthest first and the center last.
+    def explode(self, x, y, radius, timer=0.5):
+        matrix = self.matrix
+        deadline = self.scheduler.now + timer
+        flames = []
+        firsts = []
+        if not self.burn(x, y) and radius > 1:
+            for ray, (dx, dy) in enumerate(BlockMatrix.RAYS):
+                free = matrix.free_run(x, y, ray)
+                reach = min(free, radius - 1)
+                ray_flames = []
+                for k in range(1, reach + 1):
+                    fx, fy = x + dx*k, y + dy*k
+                    self.burn(fx, fy)
+                    if dy == 0:
+                        ray_flames.append(self.new_flame(HorizontalFlame, fx, fy, radius - k, deadline, dx > 0))
+                    else:
+                        ray_flames.append(self.new_flame(VerticalFlame, fx, fy, radius - k, deadline, dy > 0))
+                if reach < radius - 1 and matrix.in_bounds(x + dx*(reach + 1), y + dy*(reach + 1)):
+                    self.burn(x + dx*(reach + 1), y + dy*(reach + 1))
+                if ray_flames:
+                    firsts.append(ray_flames[0])
+                    flames += reversed(ray_flames[1:])
+        flames += firsts
+        flames.append(self.new_flame(CenterFlame, x, y, deadline))
+        self.add_flames(flames, deadline)
+
+    # A flame of the given class, a spare one if there is any
+    def new_flame(self, kind, *args):
+        spare = self.spare_flames[kind]
+        if spare:
+            flame = spare.pop()
+            flame.__init__(*args)
+            return flame
+        return kind(*args)
+
+    # A bomb going off after `timer` seconds, a spare one if there is any
+    def new_bomb(self, x, y, placer, radius, timer=Bomb.FUSE):
+        deadline = self.scheduler.now + timer
+        if self.spare_bombs:
+            bomb = self.spare_bombs.pop()
+            bomb.__init__(x, y, placer, radius, deadline)
+        else:
+            bomb = Bomb(x, y, placer, radius, deadline)
+        self.scheduler.at(deadline, self.bomb_due, bomb, deadline)
+        return bomb
+
+    def bomb_due(self, bomb, deadline):
+        # Not if it was hurried by a flame, or taken by a falling wall
+        if bomb.deadline == deadline and self.bombs.get(bomb.pos) is bomb:
+            bomb.detonate(self)
+
+    def remove_enemy(self, enemy):
+        self.enemies.remove(enemy)
+        self.enemy_index.remove(enemy)
+
+    def flames_near(self, x, y, reach=1):
+        return self.flame_index.near(x, y, reach)
+
+    def enemies_near(self, x, y):
+        return self.enemy_index.near(x, y)
+
+    def enemy_collides(self, x, y):
+        if self.swarm is not None and self.swarm.collides(x, y):
+            return True
+        for e in self.enemy_index.near(x, y):
+            if e.alive and e.collides(x, y):
+                return True
+        return False
+
+    # Bombs on the cells a body at (x, y) overlaps
+    def bombs_colliding(self, x, y):
+        if not self.bombs:
+            return []
+        xl, xh, yl, yh = list_colliding_coordinates(x, y)
+        bombs = []
+        for cell in {(xl, yl), (xl, yh), (xh, yl), (xh, yh)}:
+            bomb = self.bombs.get(cell)
+            if bomb is not None:
+                bombs.append(bomb)
+        return bombs
+
     def try_place_bomb(self, x, y, placer):
         pos = round(x), round(y)
         may_place = (
@@ -951,9 +2869,16 @@ class Level:
         )
 
         if may_place:
-            self.bombs[pos] = Bomb(*pos, placer, placer.bomb_blast_radius)
+            bomb = self.new_bomb(*pos, placer, placer.bomb_blast_radius)
+            self.bombs[pos] = bomb
+            self.danger.add(bomb)
         return may_place
 
+    # Takes a bomb off the board, as it goes off or a wall falls on it
+    def remove_bomb(self, bomb):
+        del self.bombs[bomb.pos]
+        self.danger.remove(bomb)
+
     def placed_bombs(self, player):
         count = 0
         for bomb in self.bombs.values():
@@ -961,16 +2886,54 @@ class Level:
                 count += 1
         return count
     
-    NUMBER_OF_TILES = 13*13
-    NUMBER_OF_RANDOMIZABLE_TILES_SP = NUMBER_OF_TILES - 77
-    NUMBER_OF_RANDOMIZABLE_TILES_MP = NUMBER_OF_TILES - 79
+    # Steps of open ground enemies are kept away from the player's start
+    ENEMY_SPAWN_DISTANCE = 5
+
+    # Grass cells around the players' starting positions
+    SPAWN_TILES_SP = 3
+    SPAWN_TILES_MP = 6
 
+    # The border and the pillars on every other cell inside it
     @staticmethod
-    def generate_singleplayer(game, canvas, enemies_limits=[3, 4], boxes_limits=[15, 35], max_bombs=1, bomb_blast_radius=2):
-        enemies_n = random.randrange(enemies_limits[0], enemies_limits[1]+1)
-        boxes_n = random.randrange(boxes_limits[0], boxes_limits[1]+1)
-        # Doesn't include grass in spawn area
-        grass_n = Level.NUMBER_OF_RANDOMIZABLE_TILES_SP - enemies_n - boxes_n
+    def is_wall(x, y, width, height):
+        return x == 0 or x == width-1 or y == 0 or y == height-1 or (x % 2 == 0 and y % 2 == 0)
+
+    # Sides have to be odd for the pillars to line up with the border
+    @staticmethod
+    def check_size(width, height):
+        if width < 5 or height < 5 or width % 2 == 0 or height % 2 == 0:
+            raise ValueError('board sides must be odd and at least 5, not {}x{}'.format(width, height))
+
+    # Cells that are filled at random: all but walls and spawn areas
+    @staticmethod
+    def randomizable_tiles(width, height, spawn_tiles):
+        pillars = ((width-3)//2) * ((height-3)//2)
+        return (width-2)*(height-2) - pillars - spawn_tiles
+
+    # Limits are given for a board of the default size. On other boards
+    # they grow or shrink with the number of cells filled at random.
+    @staticmethod
+    def scale_limits(limits, width, height, spawn_tiles):
+        ratio = Level.randomizable_tiles(width, height, spawn_tiles) / Level.randomizable_tiles(*BOARD_SIZE, spawn_tiles)
+        if ratio == 1:
+            return limits
+        return [max(1, round(limit*ratio)) for limit in limits]
+
+    # Random choices come from `rng`, by default the game's. With an RNG of
+    # its own nothing else in the game is touched, so this can run on
+    # another thread.
+    @staticmethod
+    def generate_singleplayer(game, canvas, enemies_limits=[3, 4], boxes_limits=[15, 35], max_bombs=1, bomb_blast_radius=2, size=BOARD_SIZE, rng=None):
+        if rng is None:
+            rng = game.rng
+        width, height = size
+        Level.check_size(width, height)
+        enemies_limits = Level.scale_limits(enemies_limits, width, height, Level.SPAWN_TILES_SP)
+        boxes_limits = Level.scale_limits(boxes_limits, width, height, Level.SPAWN_TILES_SP)
+        enemies_n = rng.randrange(enemies_limits[0], enemies_limits[1]+1)
+        boxes_n = rng.randrange(boxes_limits[0], boxes_limits[1]+1)
+        # Doesn't include grass in spawn area, the goal and the powerup
+        grass_n = Level.randomizable_tiles(width, height, Level.SPAWN_TILES_SP) - enemies_n - boxes_n - 2
 
         # 0: Grass
         # 1: Boxes
@@ -979,16 +2942,14 @@ class Level:
         # 4: Powerups
         elements = [0]*grass_n + [1]*boxes_n + [2] + [3]*enemies_n + [4]
         enemies = []
-        random.shuffle(elements)
+        rng.shuffle(elements)
 
-        matrix = [[None]*13 for _ in range(13)]
+        matrix = [[None]*width for _ in range(height)]
         players = [Player(game, 1, 1, max_bombs=max_bombs, bomb_blast_radius=bomb_blast_radius)]
         
-        for x in range(0, 13):
-            for y in range(0, 13): 
-                if x == 0 or x == 12 or y == 0 or y == 12:
-                    matrix[y][x] = Block.WALL
-                elif x % 2 == 0 and y % 2 == 0:
+        for x in range(0, width):
+            for y in range(0, height): 
+                if Level.is_wall(x, y, width, height):
                     matrix[y][x] = Block.WALL
                 elif x in [1, 2] and y in [1, 2]:
                     matrix[y][x] = Block.GRASS
@@ -1002,23 +2963,51 @@ class Level:
                         matrix[y][x] = Block.BOX_GOAL
                     elif rnd_element == 3:
                         matrix[y][x] = Block.GRASS
-                        direction = random.choice(['up', 'down', 'left', 'right'])
+                        direction = rng.choice(['up', 'down', 'left', 'right'])
                         enemies.append(Enemy(game, x, y, direction))
                     elif rnd_element == 4:
-                        powerup = random.choice([
+                        powerup = rng.choice([
                           Block.BOX_POWERUP_BLAST, Block.BOX_POWERUP_BOMBUP, Block.BOX_POWERUP_LIFE
                         ])
                         matrix[y][x] = powerup
         
         matrix = BlockMatrix(matrix)
-        return Level(canvas, matrix, players, enemies)
+        Level.move_enemies_away(matrix, enemies, rng)
+        return Level(canvas, matrix, players, enemies, rng=rng)
 
+    # Moves the enemies that could walk up to (1, 1), where the player
+    # starts, in fewer than ENEMY_SPAWN_DISTANCE steps without a box being
+    # blown up first, to grass that is far enough or walled off by boxes.
+    # Levels where there is no such grass left are left as they are.
     @staticmethod
-    def generate_multiplayer(game, canvas, boxes_limits=[35, 55], powerups_limits=[5, 8]):
-        boxes_n = random.randrange(boxes_limits[0], boxes_limits[1]+1)
-        powerups_n = random.randrange(powerups_limits[0], powerups_limits[1]+1)
+    def move_enemies_away(matrix, enemies, rng):
+        field = matrix.distances(1, 1)
+        w = matrix.width
+        fair = lambda i: not 0 <= field[i] < Level.ENEMY_SPAWN_DISTANCE
+        close = [e for e in enemies if not fair(e.pos[1]*w + e.pos[0])]
+        if not close:
+            return
+        taken = {e.pos[1]*w + e.pos[0] for e in enemies}
+        grass = [
+          i for i, tile in enumerate(matrix.tiles)
+          if tile == Block.GRASS.value and fair(i) and i not in taken
+        ]
+        for enemy in close:
+            if not grass:
+                break
+            i = grass.pop(rng.randrange(len(grass)))
+            enemy.pos = [i % w, i // w]
+
+    @staticmethod
+    def generate_multiplayer(game, canvas, boxes_limits=[35, 55], powerups_limits=[5, 8], size=BOARD_SIZE):
+        width, height = size
+        Level.check_size(width, height)
+        boxes_limits = Level.scale_limits(boxes_limits, width, height, Level.SPAWN_TILES_MP)
+        powerups_limits = Level.scale_limits(powerups_limits, width, height, Level.SPAWN_TILES_MP)
+        boxes_n = game.rng.randrange(boxes_limits[0], boxes_limits[1]+1)
+        powerups_n = game.rng.randrange(powerups_limits[0], powerups_limits[1]+1)
         # Doesn't include grass in spawn areas
-        grass_n = Level.NUMBER_OF_RANDOMIZABLE_TILES_MP - boxes_n - powerups_n
+        grass_n = Level.randomizable_tiles(width, height, Level.SPAWN_TILES_MP) - boxes_n - powerups_n
 
         # 0: Grass
         # 1: Boxes
@@ -1026,18 +3015,19 @@ class Level:
         # 3: Enemies
         # 4: Powerups
         elements = [0]*grass_n + [1]*boxes_n + [4]*powerups_n
-        random.shuffle(elements)
+        game.rng.shuffle(elements)
 
-        matrix = [[None]*13 for _ in range(13)]
-        players = [Player(game, 1, 1, 'p1', DEFAULT_P1CONTROLS), Player(game, 11, 11, 'p2', DEFAULT_P2CONTROLS)]
+        matrix = [[None]*width for _ in range(height)]
+        players = [
+          Player(game, 1, 1, 'p1', DEFAULT_P1CONTROLS),
+          Player(game, width-2, height-2, 'p2', DEFAULT_P2CONTROLS),
+        ]
         
-        for x in range(0, 13):
-            for y in range(0, 13): 
-                if x == 0 or x == 12 or y == 0 or y == 12:
-                    matrix[y][x] = Block.WALL
-                elif x % 2 == 0 and y % 2 == 0:
+        for x in range(0, width):
+            for y in range(0, height): 
+                if Level.is_wall(x, y, width, height):
                     matrix[y][x] = Block.WALL
-                elif (x in [1, 2] and y in [1, 2]) or (x in [10, 11] and y in [10, 11]):
+                elif (x in [1, 2] and y in [1, 2]) or (x in [width-3, width-2] and y in [height-3, height-2]):
                     matrix[y][x] = Block.GRASS
                 else:
                     rnd_element = elements.pop()
@@ -1046,7 +3036,7 @@ class Level:
                     elif rnd_element == 1:
                         matrix[y][x] = Block.BOX
                     elif rnd_element == 4:
-                        powerup = random.choice([
+                        powerup = game.rng.choice([
                           Block.BOX_POWERUP_BLAST, Block.BOX_POWERUP_BOMBUP,
                         ])
                         matrix[y][x] = powerup
@@ -1056,10 +3046,26 @@ class Level:
 
 
 class Game:
-    def __init__(self, context, screen, initial_time=200):
+    # Fields that change as the game runs, saved by snapshot() besides
+    # the level and the RNG. Subclasses add theirs.
+    STATE = ['time', 'ticks']
+
+    # Every random choice in a game (level generation, enemies) comes from
+    # its own RNG, so the same seed and the same inputs (with a fixed time
+    # step) always give the same game.
+    def __init__(self, context, screen, initial_time=200, seed=None, board_size=BOARD_SIZE):
+        if seed is None:
+            seed = random.getrandbits(64)
+        self.seed = seed
+        self.board_size = tuple(board_size)
+        self.rng = random.Random(seed)
         self.context = context
         self.screen = screen
+        self.input = context.input
+        self.renderer = context.renderer
         self.initial_time = initial_time
+        # Simulation steps run so far
+        self.ticks = 0
 
         self.time = None
         self.level = None 
@@ -1069,7 +3075,32 @@ class Game:
     def initialize_level(self):
         pass
 
+    # Everything needed to put the game back as it is now with restore(),
+    # for lookahead, undo or rollback. Inputs and menus belong to the
+    # context and are not part of it.
+    def snapshot(self):
+        return (
+          self.level, self.level.snapshot(), self.rng.getstate(),
+          tuple(getattr(self, name) for name in self.STATE),
+        )
+
+    # Within a level, the renderer has nothing to redraw on top of what
+    # it does every frame: the tiles that differ are marked by
+    # BlockMatrix.restore(), sprites are drawn (and marked) from scratch
+    # and the game bar is marked when what it shows changes. Only a
+    # different level altogether is pushed whole.
+    def restore(self, state):
+        level, level_state, rng_state, fields = state
+        if self.renderer is not None and level is not self.level:
+            self.renderer.invalidate()
+        self.level = level
+        level.restore(level_state)
+        self.rng.setstate(rng_state)
+        for name, value in zip(self.STATE, fields):
+            setattr(self, name, value)
+
     def loop(self, time):
+        self.ticks += 1
         self.time -= time
         self.update_gamebar(time)
         self.level.loop(time)
@@ -1082,6 +3113,12 @@ class Game:
     def draw_gamebar(self):
         pass
 
+    # The game bar is only pushed to the display when one of its labels
+    # changed since the last frame.
+    def mark_gamebar(self, *labels):
+        if self.renderer is not None:
+            self.renderer.mark_changed('gamebar', labels, (0, 0, self.screen.get_width(), 130))
+
     # Abstract method to be defined in children classes
     def update_gamebar(self, time):
         pass
@@ -1091,7 +3128,12 @@ class Game:
 
 
 class ClassicGame(Game):
-    def __init__(self, context, screen, initial_time=200, lives=3):
+    STATE = Game.STATE + [
+      'score', 'stage', 'lives', 'max_bombs', 'bomb_blast_radius',
+      'restart_level_timer', 'start_next_level_timer', 'next_level_seed',
+    ]
+
+    def __init__(self, context, screen, initial_time=200, lives=3, seed=None, board_size=BOARD_SIZE):
         self.score = 0
         self.stage = 1
         self.lives = lives
@@ -1100,33 +3142,80 @@ class ClassicGame(Game):
 
         self.restart_level_timer = None
         self.start_next_level_timer = None
-        super().__init__(context, screen, initial_time)
+        # Every stage is made from a seed of its own, drawn from the game's
+        # RNG when the countdown to it starts (see prepare_level)
+        self.next_level_seed = None
+        # (seed, stage, future) of the level being made on LEVEL_WORKER
+        self.prefetched = None
+        super().__init__(context, screen, initial_time, seed, board_size)
         
     def initialize_level(self):
         self.restart_level_timer = None
         self.start_next_level_timer = None
         self.time = self.initial_time
 
-        canvas = LevelCanvas(self.screen, (0, 130))
-        e, b = self.calculate_difficulty()
-        self.level = Level.generate_singleplayer(self, canvas, 
-          max_bombs=self.max_bombs, bomb_blast_radius=self.bomb_blast_radius,
-          enemies_limits=e, boxes_limits=b
+        if self.next_level_seed is None:
+            self.next_level_seed = self.rng.getrandbits(64)
+        level = None
+        if self.prefetched is not None:
+            seed, stage, future = self.prefetched
+            self.prefetched = None
+            if seed == self.next_level_seed and stage == self.stage:
+                level = future.result()
+        if level is None:
+            level = self.generate_level(self.next_level_seed, self.stage)
+        self.next_level_seed = None
+
+        # Powerups picked up until the level ended carry on
+        player = level.players[0]
+        player.max_bombs = self.max_bombs
+        player.bomb_blast_radius = self.bomb_blast_radius
+        self.level = level
+
+    # Only depends on its arguments, so it gives the same level on any
+    # thread and at any time
+    def generate_level(self, seed, stage):
+        canvas = LevelCanvas(self.screen, (0, 130), renderer=self.renderer)
+        e, b = self.calculate_difficulty(stage)
+        return Level.generate_singleplayer(self, canvas,
+          enemies_limits=e, boxes_limits=b, size=self.board_size, rng=random.Random(seed),
         )
 
-    def calculate_difficulty(self):
-        if self.stage == 1:
+    # Called as the countdown to the next level (or to trying this one
+    # again) starts. The level is made in the background, so it's ready
+    # by the time it's needed instead of holding up the frame it starts on.
+    def prepare_level(self, stage):
+        self.next_level_seed = self.rng.getrandbits(64)
+        if stage == self.stage and self.lives == 0:
+            return
+        future = LEVEL_WORKER.submit(self.generate_level, self.next_level_seed, stage)
+        self.prefetched = self.next_level_seed, stage, future
+
+    def calculate_difficulty(self, stage=None):
+        if stage is None:
+            stage = self.stage
+        if stage == 1:
             return [2, 3], [15, 20]
-        if self.stage == 2:
+        if stage == 2:
             return [3, 4], [15, 30]
-        if self.stage == 3:
+        if stage == 3:
             return [3, 5], [23, 35]
-        if self.stage <= 5:
+        if stage <= 5:
             return [4, 5], [30, 40]
-        if self.stage <= 10:
+        if stage <= 10:
             return [5, 7], [35, 45]
         return [5, 10], [40, 60]
 
+    def level_complete(self):
+        if self.start_next_level_timer == None and self.restart_level_timer == None:
+            self.start_next_level_timer = 0.25
+            self.prepare_level(self.stage + 1)
+
+    def level_failed(self):
+        if self.restart_level_timer == None and self.start_next_level_timer == None:
+            self.restart_level_timer = 2.5
+            self.prepare_level(self.stage)
+
     def trigger_level_failed(self):
         if self.lives > 0:
             self.lives -= 1
@@ -1154,50 +3243,63 @@ class ClassicGame(Game):
     def draw_gamebar(self):
         if self.time <= 0: 
             timer = 'TIME\'S UP'
-            timer = GAME_FONT.render(timer, True, (200, 0, 0))
+            timer = TEXT_CACHE.render(timer, (200, 0, 0))
         else:
             timer = 'TIME:  {:03d}'.format(int(self.time))
-            timer = GAME_FONT.render(timer, True, (30, 30, 30))
+            timer = TEXT_CACHE.render(timer, (30, 30, 30))
         
         score = 'SCORE:  {:04d}'.format(self.score)
-        score = GAME_FONT.render(score, True, (30, 30, 30))
+        score = TEXT_CACHE.render(score, (30, 30, 30))
 
         stage = 'STAGE:  {:02d}'.format(self.stage)
-        stage = GAME_FONT.render(stage, True, (30, 30, 30))
+        stage = TEXT_CACHE.render(stage, (30, 30, 30))
         
         lives = 'LIVES:  {:02d}'.format(self.lives)
-        lives = GAME_FONT.render(lives, True, (30, 30, 30))
+        lives = TEXT_CACHE.render(lives, (30, 30, 30))
+
+        self.mark_gamebar(self.time <= 0, int(self.time), self.score, self.stage, self.lives)
 
         self.screen.blit(stage, score.get_rect(left=30, centery=35))
-        self.screen.blit(timer, lives.get_rect(right=610, centery=35))
+        self.screen.blit(timer, lives.get_rect(right=self.screen.get_width()-40, centery=35))
         self.screen.blit(score, score.get_rect(left=30, centery=95))
-        self.screen.blit(lives, lives.get_rect(right=610, centery=95))
+        self.screen.blit(lives, lives.get_rect(right=self.screen.get_width()-40, centery=95))
 
     def update_gamebar(self, time):
         if self.time <= 0: 
-            if self.restart_level_timer == None and self.start_next_level_timer == None:
-                self.restart_level_timer = 2.5
+            self.level_failed()
 
     def player_died(self, player):
-        if self.restart_level_timer == None and self.start_next_level_timer == None:
-            self.restart_level_timer = 2.5
+        self.level_failed()
+
+
+# Classic mode where the enemies go after the player, along the level's
+# FlowField, instead of wandering about
+class ChaseGame(ClassicGame):
+    def generate_level(self, seed, stage):
+        level = super().generate_level(seed, stage)
+        level.flow = FlowField()
+        return level
 
 
 class DuelGame(Game):
-    def __init__(self, context, screen, initial_time=90):
+    STATE = Game.STATE + [
+      'loser', 'no_winner', 'end_level_timer', 'sudden_death', 'p1_wins', 'p2_wins',
+    ]
+
+    def __init__(self, context, screen, initial_time=90, seed=None, board_size=BOARD_SIZE):
         self.loser = None
         self.no_winner = False
         self.end_level_timer = None
         self.sudden_death = False
         self.p1_wins = 0
         self.p2_wins = 0
-        super().__init__(context, screen, initial_time)
+        super().__init__(context, screen, initial_time, seed, board_size)
         
     def initialize_level(self):
         self.time = self.initial_time
 
-        canvas = LevelCanvas(self.screen, (0, 130))
-        self.level = Level.generate_multiplayer(self, canvas)
+        canvas = LevelCanvas(self.screen, (0, 130), renderer=self.renderer)
+        self.level = Level.generate_multiplayer(self, canvas, size=self.board_size)
 
     def trigger_level_over(self):
         if self.no_winner:
@@ -1211,6 +3313,7 @@ class DuelGame(Game):
 
     def play_again(self):
         self.loser = None
+        self.no_winner = False
         self.end_level_timer = None 
         self.sudden_death = None
         self.initialize_level()
@@ -1231,18 +3334,20 @@ class DuelGame(Game):
     def draw_gamebar(self):
         if self.sudden_death: 
             timer = 'SUDDEN DEATH'
-            timer = GAME_FONT.render(timer, True, (200, 0, 0))
+            timer = TEXT_CACHE.render(timer, (200, 0, 0))
         else:
             timer = 'TIME:  {:02d}'.format(int(self.time))
-            timer = GAME_FONT.render(timer, True, (30, 30, 30))
+            timer = TEXT_CACHE.render(timer, (30, 30, 30))
 
         p1_wins = 'P1 WINS:  {:02d}'.format(int(self.p1_wins))
-        p1_wins = GAME_FONT.render(p1_wins, True, (29, 112, 250))
+        p1_wins = TEXT_CACHE.render(p1_wins, (29, 112, 250))
         p2_wins = 'P2 WINS:  {:02d}'.format(int(self.p2_wins))
-        p2_wins = GAME_FONT.render(p2_wins, True, (240, 30, 0))
+        p2_wins = TEXT_CACHE.render(p2_wins, (240, 30, 0))
+
+        self.mark_gamebar(self.sudden_death, int(self.time), self.p1_wins, self.p2_wins)
 
         self.screen.blit(p1_wins, p1_wins.get_rect(left=30, centery=35))
-        self.screen.blit(timer, timer.get_rect(right=610, centery=35))
+        self.screen.blit(timer, timer.get_rect(right=self.screen.get_width()-40, centery=35))
         self.screen.blit(p2_wins, p2_wins.get_rect(left=30, centery=95))        
 
     def player_died(self, player):
@@ -1262,7 +3367,7 @@ class MenuOption:
 
     def draw(self, y, sel):
         cursor = ASSETS['menu_pointer']
-        label = GAME_FONT.render(self.label, True, (255, 255, 255))
+        label = TEXT_CACHE.render(self.label, (255, 255, 255))
 
         if sel:
             self.screen.blit(cursor, cursor.get_rect(left=110, centery=y))
@@ -1281,6 +3386,7 @@ class Menu:
         self.options = {
           'main': [
             MenuOption(screen, 'Classic Mode', self.context.new_classic_game), 
+            MenuOption(screen, 'Chase Mode', self.context.new_chase_game),
             MenuOption(screen, '2P Duel Mode', self.context.new_duel_game),
             MenuOption(screen, 'Quit Game', self.context.quit),
           ],
@@ -1317,26 +3423,31 @@ class Menu:
     def draw(self):
         if self.mode == 'main' or self.mode == 'pause':
             title_screen = ASSETS['title_screen']
-            self.screen.blit(title_screen, title_screen.get_rect(centerx=325, top=25))
+            self.screen.blit(title_screen, title_screen.get_rect(centerx=self.screen.get_width()//2, top=25))
         elif self.mode == 'gameover':
-            gameover_label = GAME_FONT.render('Game Over', True, (255, 255, 255))
+            gameover_label = TEXT_CACHE.render('Game Over', (255, 255, 255))
             score = 'SCORE: {:04d}'.format(self.score)
-            score = GAME_FONT.render(score, True, (255, 255, 255))
+            score = TEXT_CACHE.render(score, (255, 255, 255))
             stage = 'STAGE: {:02d}'.format(self.stage)
-            stage = GAME_FONT.render(stage, True, (255, 255, 255))
+            stage = TEXT_CACHE.render(stage, (255, 255, 255))
 
             self.screen.blit(gameover_label, gameover_label.get_rect(left=80, top=190))
             self.screen.blit(score, gameover_label.get_rect(left=80, top=250))
             self.screen.blit(stage, gameover_label.get_rect(left=80, top=300))
         elif self.mode == 'mp_gameover_winsp1':
-            gameover_label = GAME_FONT.render('Player one wins!', True, (0, 200, 255))
+            gameover_label = TEXT_CACHE.render('Player one wins!', (0, 200, 255))
             self.screen.blit(gameover_label, gameover_label.get_rect(left=80, top=300))
         elif self.mode == 'mp_gameover_winsp2':
-            gameover_label = GAME_FONT.render('Player two wins!', True, (255, 30, 0))
+            gameover_label = TEXT_CACHE.render('Player two wins!', (255, 30, 0))
             self.screen.blit(gameover_label, gameover_label.get_rect(left=80, top=300))
         elif self.mode == 'mp_gameover_draw':
-            gameover_label = GAME_FONT.render('Draw.', True, (255, 219, 18))
+            gameover_label = TEXT_CACHE.render('Draw.', (255, 219, 18))
             self.screen.blit(gameover_label, gameover_label.get_rect(left=80, top=300))
+
+        if self.context.renderer is not None:
+            self.context.renderer.mark_changed(
+              'menu', (self.mode, self.selected, self.score, self.stage), self.screen.get_rect()
+            )
             
         y = 500
         for i, option in enumerate(self.options[self.mode]):
@@ -1360,69 +3471,582 @@ class Menu:
                 self.selected += 1
 
 
+# Keeps track of the screen areas that changed during a frame and pushes
+# only those to the display. The whole screen is still redrawn in memory
+# every frame; what is saved is the (much slower) copy to the display.
+class Renderer:
+    DEBUG_COLOR = (255, 0, 255)
+
+    def __init__(self, screen, debug=False):
+        self.screen = screen
+        self.debug = debug
+        self.dirty = []
+        self.previous = []
+        self.full_update = True
+        self.labels = {}
+
+        self.frames = 0
+        self.rects_pushed = 0
+        self.pixels_pushed = 0
+        self.last_pixels_pushed = 0
+
+    def mark(self, rect):
+        self.dirty.append(pygame.Rect(rect))
+
+    # Marks rect as changed when `state` differs from the one last given
+    # for `key`, e.g. the values shown on the game bar.
+    def mark_changed(self, key, state, rect):
+        if self.labels.get(key) != state:
+            self.labels[key] = state
+            self.mark(rect)
+
+    # The next frame will be pushed whole (e.g. switching to/from the menu)
+    def invalidate(self):
+        self.full_update = True
+        self.labels = {}
+
+    def present(self):
+        screen_rect = self.screen.get_rect()
+        if self.full_update:
+            rects = [screen_rect]
+        else:
+            # Areas drawn on the previous frame have to be pushed again,
+            # otherwise whatever moved away from them would be left behind.
+            rects = [r.clip(screen_rect) for r in self.previous + self.dirty]
+            rects = [r for r in rects if r.width and r.height]
+
+        if self.debug:
+            for rect in self.dirty:
+                pygame.draw.rect(self.screen, self.DEBUG_COLOR, rect, 1)
+
+        if self.full_update:
+            pygame.display.flip()
+        else:
+            pygame.display.update(rects)
+
+        self.frames += 1
+        self.last_pixels_pushed = sum(r.width*r.height for r in rects)
+        self.pixels_pushed += self.last_pixels_pushed
+        self.rects_pushed += len(rects)
+        self.previous = self.dirty
+        self.dirty = []
+        self.full_update = False
+
+    def report(self):
+        if self.frames == 0:
+            return 'no frames rendered'
+        screen_pixels = self.screen.get_width()*self.screen.get_height()
+        per_frame = self.pixels_pushed/self.frames
+        return '{} frames, {:.1f} rects and {:.0f} pixels ({:.1%} of the screen) pushed per frame'.format(
+            self.frames, self.rects_pushed/self.frames, per_frame, per_frame/screen_pixels,
+        )
+
+
+# The board (or as much of it as fits in MAX_VIEW) below a 130 pixel high
+# game bar, and no smaller than MIN_WINDOW
+def window_size(board_size):
+    return (
+      max(MIN_WINDOW[0], min(board_size[0]*50, MAX_VIEW[0])),
+      max(MIN_WINDOW[1], min(board_size[1]*50, MAX_VIEW[1]) + 130),
+    )
+
+
 class Context:
-    def __init__(self):
-        self.size = 650, 780
+    # With `bot`, the last player of every game (player two in duels) is
+    # played by a Bot
+    def __init__(self, debug_dirty_rects=False, record_path=None, board_size=BOARD_SIZE, bot=False):
+        pygame.init()
+        self.board_size = board_size
+        self.bot = bot
+        self.bots = None
+        self.size = window_size(board_size)
         self.speed = [2, 2]
         self.running = True
+        self.input = KeyboardInput()
+        load_font()
         pygame.display.set_caption('Bomberman')
         pygame.display.set_icon(ASSETS['icon'])
         self.screen = pygame.display.set_mode(self.size)
+        self.renderer = Renderer(self.screen, debug_dirty_rects)
         self.clock = pygame.time.Clock()
+        self.accumulator = 0
+        self.record_path = record_path
+        self.recorder = None
         self.game = None
         self.menu = Menu(self.screen, self)
 
-    def new_classic_game(self):
+    def start_game(self, game):
         self.menu.is_open = False
-        self.game = ClassicGame(self, self.screen)
+        self.game = game
+        if self.bot:
+            self.bots = Bots([Bot(len(game.level.players) - 1)])
+            self.bots.attach(game)
+        if self.record_path is not None:
+            self.recorder = ReplayRecorder(game, self.record_path)
+
+    def new_classic_game(self):
+        self.start_game(ClassicGame(self, self.screen, board_size=self.board_size))
+
+    def new_chase_game(self):
+        self.start_game(ChaseGame(self, self.screen, board_size=self.board_size))
 
     def new_duel_game(self):
-        self.menu.is_open = False
-        self.game = DuelGame(self, self.screen)
+        self.start_game(DuelGame(self, self.screen, board_size=self.board_size))
 
     def resume_game(self):
         if self.game != None:
             self.menu.is_open = False
 
     def restart_game(self):
-        self.menu.is_open = False
-        if type(self.game) is ClassicGame:
-            self.game = ClassicGame(self, self.screen)
+        if type(self.game) is ChaseGame:
+            self.new_chase_game()
+        elif type(self.game) is ClassicGame:
+            self.new_classic_game()
         else:
-            self.game = DuelGame(self, self.screen)
+            self.new_duel_game()
 
     def play_again(self):
         self.menu.is_open = False
+        if self.recorder is not None:
+            self.recorder.play_again()
         self.game.play_again()
 
     def quit(self):
         self.running = False
 
+    # Keys of players played by bots are left to them, other than in menus
+    def handle_event(self, event):
+        if event.type == pygame.QUIT:
+            self.quit()
+        if event.type not in (pygame.KEYDOWN, pygame.KEYUP):
+            return
+        botted = self.bots is not None and self.bots.controls(self.game, event.key)
+        if event.type == pygame.KEYDOWN:
+            if self.menu.is_open:
+                if self.recorder is not None and not botted:
+                    self.recorder.key(event.key, Replay.HOLD)
+                self.menu.handle_key(event.key)
+            elif event.key == PAUSE_KEY:
+                self.menu.open('pause')
+            elif not botted:
+                if self.recorder is not None:
+                    self.recorder.key(event.key, Replay.PRESS)
+                self.game.handle_key(event.key)
+        if event.type == pygame.KEYUP and self.recorder is not None and not botted:
+            self.recorder.key(event.key, Replay.RELEASE)
+
+    # Runs as many fixed steps of the game as the time elapsed allows
+    def step_game(self):
+        self.accumulator += self.clock.get_time()/1000
+        steps = 0
+        while self.accumulator >= TIME_STEP and not self.menu.is_open:
+            if steps == MAX_STEPS_PER_FRAME:
+                self.accumulator = 0
+                break
+            if self.bots is not None:
+                self.bots.step(self.game, self.recorder.key if self.recorder is not None else None)
+            self.game.loop(TIME_STEP)
+            self.accumulator -= TIME_STEP
+            steps += 1
+            if self.recorder is not None:
+                self.recorder.tick()
+        if self.menu.is_open and self.recorder is not None:
+            self.recorder.save()
+
     def loop(self):
+        showing_menu = None
         while self.running:
             self.clock.tick(30)
             for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    self.quit()
-                if event.type == pygame.KEYDOWN:
-                    if self.menu.is_open:
-                        self.menu.handle_key(event.key)
-                    elif event.key == PAUSE_KEY:
-                        self.menu.open('pause')
-                    else:
-                        self.game.handle_key(event.key)
+                self.handle_event(event)
+
+            if showing_menu != self.menu.is_open:
+                showing_menu = self.menu.is_open
+                self.renderer.invalidate()
 
             if self.menu.is_open:
+                self.accumulator = 0
                 self.screen.fill((0, 0, 0))
                 self.menu.draw()
             else:
-                self.screen.fill((140, 140, 140))
-                self.game.loop(self.clock.get_time()/1000)
+                self.screen.fill(LEVEL_BACKGROUND)
+                self.step_game()
                 self.game.draw()
             
-            pygame.display.flip()
+            self.renderer.present()
+            if self.renderer.debug and self.renderer.frames % 30 == 0:
+                pygame.display.set_caption('Bomberman - {} px pushed'.format(self.renderer.last_pixels_pushed))
+        if self.recorder is not None:
+            self.recorder.save()
+        if self.renderer.debug:
+            print(self.renderer.report())
+            print(TEXT_CACHE.report())
         pygame.display.quit()
         pygame.quit()
         sys.exit()
 
-Context().loop()
+
+# Stands in for Menu when there is no display. Games open menus to
+# signal that they are over, so this only records which one was opened.
+class HeadlessMenu:
+    def __init__(self):
+        self.is_open = False
+        self.mode = None
+        self.score = None
+        self.stage = None
+
+    def open(self, mode, score=None, stage=None):
+        self.score = score
+        self.stage = stage
+        self.mode = mode
+        self.is_open = True
+
+
+# Runs a game with no window, no assets and no keyboard. Inputs are
+# injected with press()/release() and time advances by a fixed step on
+# each tick(), so the simulation runs as fast as the CPU allows.
+class HeadlessContext:
+    def __init__(self, game_class=ClassicGame, time_step=TIME_STEP, **game_args):
+        self.input = InjectedInput()
+        self.menu = HeadlessMenu()
+        self.renderer = None
+        self.time_step = time_step
+        self.ticks = 0
+        self.game = game_class(self, None, **game_args)
+
+    def press(self, key):
+        if not self.input[key]:
+            self.input.press(key)
+            if not self.menu.is_open:
+                self.game.handle_key(key)
+
+    def release(self, key):
+        self.input.release(key)
+
+    def play_again(self):
+        self.menu.is_open = False
+        self.game.play_again()
+
+    def tick(self):
+        self.game.loop(self.time_step)
+        self.ticks += 1
+
+    # Ticks until the game opens a menu (game over, end of a duel round)
+    # or max_ticks is reached. `controller`, if given, is called before
+    # every tick with this context so it can press and release keys.
+    def run(self, max_ticks=None, controller=None):
+        while not self.menu.is_open:
+            if max_ticks is not None and self.ticks >= max_ticks:
+                break
+            if controller is not None:
+                controller(self)
+            self.tick()
+        return self.menu.mode
+
+
+# A game as its seed plus the keys pressed and released by each player,
+# with the simulation step at which they happened. Since games are
+# deterministic (see Game), that is enough to play it again exactly.
+#
+# Binary layout (integers are unsigned LEB128 varints unless noted):
+#     'BMRP', version (byte), mode (byte), seed (8 bytes, little endian),
+#     steps per second, board width, board height, total steps,
+#     number of events, events,
+#     number of checkpoints, checkpoints
+# Each event is the steps since the previous event followed by one byte:
+# kind (2 bits) | player (3 bits) | action (3 bits). Checkpoints are the
+# step followed by the first 4 bytes of Level.checksum() at that step, so
+# playback can tell where it stopped matching the recording.
+class Replay:
+    MAGIC = b'BMRP'
+    VERSION = 5
+    MODES = ['classic', 'duel', 'chase']
+    GAME_CLASSES = {'classic': ClassicGame, 'duel': DuelGame, 'chase': ChaseGame}
+    ACTIONS = ['up', 'down', 'left', 'right', 'place_bomb']
+    # A key pressed during the game, a key pressed while a menu was open
+    # (it is held but has no other effect), a key released, and the duel
+    # being played again.
+    PRESS, HOLD, RELEASE, PLAY_AGAIN = range(4)
+    CHECKPOINT_INTERVAL = 150
+
+    def __init__(self, mode, seed, time_step=TIME_STEP, board_size=BOARD_SIZE):
+        self.mode = mode
+        self.seed = seed
+        self.time_step = time_step
+        self.board_size = tuple(board_size)
+        self.ticks = 0
+        # (tick, kind, player, action)
+        self.events = []
+        # (tick, checksum prefix)
+        self.checkpoints = []
+
+    @staticmethod
+    def game_class(mode):
+        return Replay.GAME_CLASSES[mode]
+
+    # Subclasses (like rlenv's) count as the mode they're made from
+    @staticmethod
+    def mode_of(game):
+        if isinstance(game, ChaseGame):
+            return 'chase'
+        return 'classic' if isinstance(game, ClassicGame) else 'duel'
+
+    def to_bytes(self):
+        data = bytearray(self.MAGIC)
+        data.append(self.VERSION)
+        data.append(self.MODES.index(self.mode))
+        data += self.seed.to_bytes(8, 'little')
+        write_varint(data, round(1/self.time_step))
+        write_varint(data, self.board_size[0])
+        write_varint(data, self.board_size[1])
+        write_varint(data, self.ticks)
+        write_varint(data, len(self.events))
+        last = 0
+        for tick, kind, player, action in self.events:
+            write_varint(data, tick - last)
+            data.append(kind << 6 | player << 3 | action)
+            last = tick
+        write_varint(data, len(self.checkpoints))
+        for tick, digest in self.checkpoints:
+            write_varint(data, tick)
+            data += digest
+        return bytes(data)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if data[:4] != cls.MAGIC or data[4] != cls.VERSION:
+            raise ValueError('not a version {} replay'.format(cls.VERSION))
+        mode = cls.MODES[data[5]]
+        seed = int.from_bytes(data[6:14], 'little')
+        i = 14
+        steps_per_second, i = read_varint(data, i)
+        width, i = read_varint(data, i)
+        height, i = read_varint(data, i)
+        replay = cls(mode, seed, 1/steps_per_second, (width, height))
+        replay.ticks, i = read_varint(data, i)
+        n, i = read_varint(data, i)
+        tick = 0
+        for _ in range(n):
+            delta, i = read_varint(data, i)
+            tick += delta
+            byte = data[i]
+            i += 1
+            replay.events.append((tick, byte >> 6, byte >> 3 & 7, byte & 7))
+        n, i = read_varint(data, i)
+        for _ in range(n):
+            tick, i = read_varint(data, i)
+            replay.checkpoints.append((tick, bytes(data[i:i+4])))
+            i += 4
+        return replay
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
+def write_varint(data, n):
+    while n >= 0x80:
+        data.append(n & 0x7f | 0x80)
+        n >>= 7
+    data.append(n)
+
+
+def read_varint(data, i):
+    n = shift = 0
+    while True:
+        byte = data[i]
+        i += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, i
+        shift += 7
+
+
+# Turns the key events of a game into a Replay and writes it to `path`
+class ReplayRecorder:
+    def __init__(self, game, path):
+        self.game = game
+        self.path = path
+        self.replay = Replay(Replay.mode_of(game), game.seed, board_size=game.board_size)
+        # Keys already held when the game starts
+        for player, p in enumerate(game.level.players):
+            pressed = p.input.get_pressed()
+            for action, name in enumerate(Replay.ACTIONS):
+                if pressed[p.controls[name]]:
+                    self.replay.events.append((0, Replay.HOLD, player, action))
+
+    # Keys that aren't bound to any player are not recorded
+    def key(self, key, kind):
+        for player, p in enumerate(self.game.level.players):
+            for action, name in enumerate(Replay.ACTIONS):
+                if p.controls[name] == key:
+                    self.replay.events.append((self.game.ticks, kind, player, action))
+
+    def play_again(self):
+        self.replay.events.append((self.game.ticks, Replay.PLAY_AGAIN, 0, 0))
+
+    def tick(self):
+        if self.game.ticks % Replay.CHECKPOINT_INTERVAL == 0:
+            digest = bytes.fromhex(self.game.level.checksum()[:8])
+            self.replay.checkpoints.append((self.game.ticks, digest))
+
+    def save(self):
+        self.replay.ticks = self.game.ticks
+        self.replay.save(self.path)
+
+
+def apply_replay_event(ctx, event):
+    _, kind, player, action = event
+    if kind == Replay.PLAY_AGAIN:
+        ctx.play_again()
+        return
+    key = ctx.game.level.players[player].controls[Replay.ACTIONS[action]]
+    if kind == Replay.PRESS:
+        ctx.press(key)
+    elif kind == Replay.HOLD:
+        ctx.input.press(key)
+    else:
+        ctx.release(key)
+
+
+# Plays a replay back as fast as possible, without rendering. Returns the
+# context it ran in, the duration of every step (to find lag spikes) and
+# the first step whose state didn't match the recording, if any.
+def run_replay(replay):
+    ctx = HeadlessContext(
+      Replay.game_class(replay.mode), replay.time_step, seed=replay.seed, board_size=replay.board_size,
+    )
+    checkpoints = dict(replay.checkpoints)
+    events = replay.events
+    i = 0
+    durations = []
+    desync = None
+    while ctx.game.ticks < replay.ticks:
+        while i < len(events) and events[i][0] <= ctx.game.ticks:
+            apply_replay_event(ctx, events[i])
+            i += 1
+        start = time.perf_counter()
+        ctx.tick()
+        durations.append(time.perf_counter() - start)
+        digest = checkpoints.get(ctx.game.ticks)
+        if digest is not None and desync is None:
+            if bytes.fromhex(ctx.game.level.checksum()[:8]) != digest:
+                desync = ctx.game.ticks
+    return ctx, durations, desync
+
+
+# Shows a replay in a window, in real time
+class ReplayViewer(Context):
+    def __init__(self, replay, debug_dirty_rects=False):
+        super().__init__(debug_dirty_rects, board_size=replay.board_size)
+        self.replay = replay
+        self.next_event = 0
+        self.input = InjectedInput()
+        game_class = Replay.game_class(replay.mode)
+        self.start_game(game_class(self, self.screen, seed=replay.seed, board_size=replay.board_size))
+
+    def press(self, key):
+        if not self.input[key]:
+            self.input.press(key)
+            self.game.handle_key(key)
+
+    def release(self, key):
+        self.input.release(key)
+
+    def play_again(self):
+        self.menu.is_open = False
+        self.game.play_again()
+
+    def handle_event(self, event):
+        if event.type == pygame.QUIT:
+            self.quit()
+        elif event.type == pygame.KEYDOWN and event.key == PAUSE_KEY:
+            self.quit()
+
+    def step_game(self):
+        self.accumulator += self.clock.get_time()/1000
+        while self.accumulator >= TIME_STEP and self.game.ticks < self.replay.ticks:
+            events = self.replay.events
+            while self.next_event < len(events) and events[self.next_event][0] <= self.game.ticks:
+                apply_replay_event(self, events[self.next_event])
+                self.next_event += 1
+            self.game.loop(TIME_STEP)
+            self.accumulator -= TIME_STEP
+        # Menus opened by the game (end of a round) are skipped over
+        self.menu.is_open = False
+        if self.game.ticks >= self.replay.ticks:
+            self.quit()
+
+
+def play_replay(path, realtime=False, profile=False, slowest=10):
+    replay = Replay.load(path)
+    print('{} game on a {}x{} board, seed {}, {} steps ({:.1f} s), {} events'.format(
+        replay.mode, *replay.board_size, replay.seed, replay.ticks, replay.ticks*replay.time_step, len(replay.events),
+    ))
+    if realtime:
+        ReplayViewer(replay).loop()
+        return
+
+    if profile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    ctx, durations, desync = run_replay(replay)
+    elapsed = time.perf_counter() - start
+    if profile:
+        profiler.disable()
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
+    print('played back in {:.3f} s ({:.0f} steps/s)'.format(elapsed, len(durations)/elapsed if elapsed else 0))
+    if desync is None:
+        print('state matches the recording')
+    else:
+        print('DESYNC: state differs from the recording at step {}'.format(desync))
+    worst = sorted(range(len(durations)), key=lambda t: -durations[t])[:slowest]
+    print('slowest steps: ' + ', '.join(
+        '#{} {:.2f} ms'.format(t+1, durations[t]*1000) for t in sorted(worst)
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bomberman')
+    parser.add_argument(
+      '--debug-dirty-rects', action='store_true',
+      help='outline the screen areas pushed to the display on every frame',
+    )
+    parser.add_argument('--record', metavar='FILE', help='record the last game played to FILE')
+    parser.add_argument('--replay', metavar='FILE', help='play back a recorded game')
+    parser.add_argument(
+      '--realtime', action='store_true',
+      help='with --replay, show the game in a window instead of playing it back at full speed',
+    )
+    parser.add_argument('--profile', action='store_true', help='with --replay, profile the playback')
+    parser.add_argument(
+      '--bot', action='store_true',
+      help='the computer plays player two in duels, and the player in classic and chase mode',
+    )
+    parser.add_argument(
+      '--board', metavar='WxH', default='{}x{}'.format(*BOARD_SIZE),
+      help='board size in cells (odd numbers, at least 5)',
+    )
+    args = parser.parse_args()
+    if args.replay is not None:
+        play_replay(args.replay, args.realtime, args.profile)
+    else:
+        try:
+            board_size = tuple(int(n) for n in args.board.lower().split('x'))
+            Level.check_size(*board_size)
+        except (ValueError, TypeError) as e:
+            parser.error('--board: {}'.format(e))
+        Context(args.debug_dirty_rects, args.record, board_size, args.bot).loop()
+
+
+if __name__ == '__main__':
+    main()
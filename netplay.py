@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Duel over the network with rollback. Each peer runs the whole game and
+only inputs are sent. The opponent's input is predicted (it's assumed to
+stay the same) until it arrives, and when it turns out different the game
+is restored to the frame it was for and simulated again up to now. Local
+input is shown on the very next frame, whatever the round trip time.
+
+    python netplay.py host --port 7777
+    python netplay.py join 192.168.1.10 --port 7777
+    python netplay.py loopback --rtt 100 --loss 0.05 --seconds 120
+
+Each player uses the arrow keys and space. `loopback` plays two peers
+against each other over 127.0.0.1 with random inputs, injected latency and
+packet loss, and checks that they stay in sync.
+"""
+
+
+import argparse
+import heapq
+import os
+import random
+import socket
+import struct
+import time
+
+import pygame
+
+import bomberman
+from bomberman import (
+    DuelGame, HeadlessMenu, InjectedInput, Renderer, Replay, ASSETS,
+    DEFAULT_SINGLEPLAYER_CONTROLS, LEVEL_BACKGROUND, TIME_STEP,
+)
+
+
+# Per frame, the input of a player is a bit mask of these
+ACTIONS = Replay.ACTIONS
+BOMB = 1 << ACTIONS.index('place_bomb')
+
+HELLO, START, INPUT = range(3)
+INPUT_HEADER = struct.Struct('<BIIB')
+SYNC = struct.Struct('<I4s')
+
+
+def keyboard_mask(pressed, controls=DEFAULT_SINGLEPLAYER_CONTROLS):
+    mask = 0
+    for i, action in enumerate(ACTIONS):
+        if pressed[controls[action]]:
+            mask |= 1 << i
+    return mask
+
+
+# Holds the keys of each player's input mask and presses the bomb key of
+# those who weren't holding it on the previous frame
+def apply_inputs(context, game, masks, previous):
+    held = context.input.held
+    held.clear()
+    for player, mask, before in zip(game.level.players, masks, previous):
+        for i, action in enumerate(ACTIONS):
+            if mask & 1 << i:
+                held.add(player.controls[action])
+        if mask & ~before & BOMB:
+            game.handle_key(player.controls['place_bomb'])
+
+
+# What the game sees of the world: inputs are injected and menus (the end
+# of a round) are only recorded, so the simulation can be run again for
+# past frames.
+class NetContext:
+    def __init__(self, screen=None, renderer=None):
+        self.input = InjectedInput()
+        self.menu = HeadlessMenu()
+        self.renderer = renderer
+        self.screen = screen
+
+
+# Keeps a DuelGame in step with the peer's. `local` is the index of the
+# player whose inputs come from this side.
+class RollbackSession:
+    # How far the game may run ahead of the last input received from the
+    # peer. Past that it waits, as rolling back would get too expensive.
+    MAX_ROLLBACK = 15
+    # Frames between state checksums, which are compared with the peer's
+    SYNC_INTERVAL = 30
+    # Inputs sent again in every packet until the peer acknowledges them
+    MAX_REDUNDANCY = 64
+
+    def __init__(self, seed, local, screen=None, renderer=None):
+        self.context = NetContext(screen, renderer)
+        self.game = DuelGame(self.context, screen, seed=seed)
+        self.local = local
+        self.frame = 0
+        # Local inputs from frame local_first on, the older ones being
+        # neither acknowledged by the peer nor needed to roll back to
+        self.local_inputs = []
+        self.local_first = 0
+        self.remote_inputs = {}
+        # Frames up to which the peer's inputs have all arrived
+        self.remote_confirmed = 0
+        # Frames of ours the peer has acknowledged
+        self.acked = 0
+        # Remote input each frame was last simulated with
+        self.used_remote = {}
+        self.snapshots = {}
+        self.checksums = {}
+        # Last frame whose checksum was compared with the peer's
+        self.compared = 0
+        self.rollback_to = None
+        self.desync = None
+
+        self.rollbacks = 0
+        self.resimulated = 0
+        self.max_rollback = 0
+        self.stalls = 0
+
+    def masks(self, frame):
+        masks = [0, 0]
+        masks[self.local] = self.local_inputs[frame - self.local_first] if frame >= 0 else 0
+        masks[1 - self.local] = self.used_remote.get(frame, 0)
+        return masks
+
+    def simulate(self, frame):
+        game = self.game
+        self.snapshots[frame] = game.snapshot()
+        remote = self.remote_inputs.get(frame)
+        if remote is None:
+            remote = self.remote_inputs.get(self.remote_confirmed - 1, 0)
+        self.used_remote[frame] = remote
+
+        apply_inputs(self.context, game, self.masks(frame), self.masks(frame - 1))
+        game.loop(TIME_STEP)
+        if self.context.menu.is_open:
+            self.context.menu.is_open = False
+            game.play_again()
+        if frame % self.SYNC_INTERVAL == 0:
+            self.checksums[frame] = game.level.checksum()[:8]
+
+    # Runs the next frame with the given local input. Returns False, and
+    # doesn't take the input, when too far ahead of the peer.
+    def advance(self, local_mask):
+        if self.frame - self.remote_confirmed >= self.MAX_ROLLBACK:
+            self.stalls += 1
+            return False
+        self.local_inputs.append(local_mask)
+        if self.rollback_to is not None:
+            self.rollback()
+        self.simulate(self.frame)
+        self.frame += 1
+        self.forget()
+        return True
+
+    def rollback(self):
+        start, self.rollback_to = self.rollback_to, None
+        self.game.restore(self.snapshots[start])
+        for frame in range(start, self.frame):
+            self.simulate(frame)
+        self.rollbacks += 1
+        self.resimulated += self.frame - start
+        self.max_rollback = max(self.max_rollback, self.frame - start)
+
+    # Nothing before the last confirmed frame can be rolled back to, local
+    # inputs the peer has acknowledged aren't sent again, and checksums
+    # older than the last one compared (or sent) won't be looked at again
+    def forget(self):
+        oldest = self.remote_confirmed - 1
+        for frame in [f for f in self.snapshots if f < oldest]:
+            del self.snapshots[frame]
+            self.used_remote.pop(frame - 1, None)
+            self.remote_inputs.pop(frame - 1, None)
+
+        drop = min(oldest, self.acked, self.frame - 1) - self.local_first
+        if drop > 0:
+            del self.local_inputs[:drop]
+            self.local_first += drop
+
+        synced = min(self.compared, self.latest_sync()[0])
+        for frame in [f for f in self.checksums if f < synced]:
+            del self.checksums[frame]
+
+    def latest_sync(self):
+        frame = (min(self.remote_confirmed, self.frame) - 1)//self.SYNC_INTERVAL*self.SYNC_INTERVAL
+        return frame, self.checksums.get(frame)
+
+    def packet(self):
+        first = max(self.acked, self.frame - self.MAX_REDUNDANCY)
+        inputs = bytes(self.local_inputs[first - self.local_first:])
+        data = INPUT_HEADER.pack(INPUT, self.remote_confirmed, first, len(inputs)) + inputs
+        frame, digest = self.latest_sync()
+        if frame >= 0 and digest is not None:
+            data += SYNC.pack(frame, bytes.fromhex(digest))
+        return data
+
+    def receive(self, data):
+        kind, acked, first, n = INPUT_HEADER.unpack_from(data)
+        if kind != INPUT:
+            return
+        self.acked = max(self.acked, acked)
+        inputs = data[INPUT_HEADER.size:INPUT_HEADER.size+n]
+        for frame, mask in enumerate(inputs, first):
+            if frame in self.remote_inputs or frame < self.remote_confirmed:
+                continue
+            self.remote_inputs[frame] = mask
+            if frame < self.frame and self.used_remote.get(frame) != mask:
+                if self.rollback_to is None or frame < self.rollback_to:
+                    self.rollback_to = frame
+        while self.remote_confirmed in self.remote_inputs:
+            self.remote_confirmed += 1
+
+        rest = data[INPUT_HEADER.size+n:]
+        if len(rest) == SYNC.size:
+            frame, digest = SYNC.unpack(rest)
+            mine = self.checksums.get(frame)
+            if mine is not None and frame < min(self.remote_confirmed, self.frame):
+                self.compared = max(self.compared, frame)
+                if bytes.fromhex(mine) != digest and self.desync is None:
+                    self.desync = frame
+
+    def report(self):
+        return (
+            'frame {}, {} rollbacks ({} frames simulated again, {} at most), '
+            'waited for the peer {} times{}'.format(
+                self.frame, self.rollbacks, self.resimulated, self.max_rollback, self.stalls,
+                ', DESYNC at frame {}'.format(self.desync) if self.desync is not None else '',
+            )
+        )
+
+
+# A UDP socket that can hold outgoing packets back for `latency` (plus up
+# to `jitter`) seconds and drop a fraction `loss` of them, to try things out
+# over the loopback interface. `clock` gives the current time in seconds.
+class Transport:
+    def __init__(self, bind=('0.0.0.0', 0), peer=None, latency=0, jitter=0, loss=0, seed=None, clock=time.monotonic):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(bind)
+        self.socket.setblocking(False)
+        self.peer = peer
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.rng = random.Random(seed)
+        self.clock = clock
+        self.queue = []
+        self.sent = 0
+
+    @property
+    def address(self):
+        return self.socket.getsockname()
+
+    def send(self, data):
+        if self.peer is None or self.rng.random() < self.loss:
+            return
+        due = self.clock() + self.latency + self.rng.random()*self.jitter
+        heapq.heappush(self.queue, (due, self.sent, data))
+        self.sent += 1
+        self.flush()
+
+    def flush(self):
+        now = self.clock()
+        while self.queue and self.queue[0][0] <= now:
+            _, _, data = heapq.heappop(self.queue)
+            self.socket.sendto(data, self.peer)
+
+    # Datagrams received since the last call, with their senders
+    def receive(self):
+        self.flush()
+        received = []
+        while True:
+            try:
+                received.append(self.socket.recvfrom(2048))
+            except (BlockingIOError, InterruptedError):
+                return received
+
+
+# Agrees on a seed with the peer. The host waits for a HELLO and answers
+# every one of them with START and the seed, and the joining side repeats
+# HELLO until the START arrives.
+def handshake(transport, host, seed=None):
+    if host:
+        seed = seed if seed is not None else random.getrandbits(64)
+        while True:
+            for data, sender in transport.receive():
+                if data[0] == HELLO:
+                    transport.peer = sender
+                    transport.send(bytes([START]) + seed.to_bytes(8, 'little'))
+                    return seed
+            time.sleep(0.01)
+    while True:
+        transport.send(bytes([HELLO]))
+        for _ in range(10):
+            for data, sender in transport.receive():
+                if data[0] == START:
+                    return int.from_bytes(data[1:9], 'little')
+            time.sleep(0.01)
+
+
+def play(args):
+    pygame.init()
+    bomberman.load_font()
+    pygame.display.set_caption('Bomberman - {}'.format('host' if args.command == 'host' else 'guest'))
+    pygame.display.set_icon(ASSETS['icon'])
+    screen = pygame.display.set_mode((650, 780))
+
+    if args.command == 'host':
+        transport = Transport(('0.0.0.0', args.port), latency=args.latency/1000, loss=args.loss)
+    else:
+        transport = Transport(peer=(args.address, args.port), latency=args.latency/1000, loss=args.loss)
+    print('waiting for the other player...')
+    seed = handshake(transport, args.command == 'host')
+
+    session = RollbackSession(seed, 0 if args.command == 'host' else 1, screen, Renderer(screen))
+    clock = pygame.time.Clock()
+    running = True
+    while running:
+        clock.tick(30)
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+        for data, _ in transport.receive():
+            if data[0] == INPUT:
+                session.receive(data)
+            elif data[0] == HELLO:
+                transport.send(bytes([START]) + seed.to_bytes(8, 'little'))
+        session.advance(keyboard_mask(pygame.key.get_pressed()))
+        transport.send(session.packet())
+
+        screen.fill(LEVEL_BACKGROUND)
+        session.game.draw()
+        session.context.renderer.present()
+    print(session.report())
+    pygame.quit()
+
+
+# Random inputs held for a few frames each, as a stand-in for a player
+class RandomMasks:
+    def __init__(self, seed):
+        self.rng = random.Random(seed)
+        self.mask = 0
+        self.frames = 0
+
+    def __call__(self):
+        if self.frames <= 0:
+            self.mask = 1 << self.rng.randrange(5) if self.rng.random() < 0.8 else 0
+            self.frames = self.rng.randint(3, 30)
+        self.frames -= 1
+        bomb = BOMB if self.rng.random() < 0.03 else 0
+        return self.mask & ~BOMB | bomb
+
+
+def loopback(args):
+    now = [0.0]
+
+    def clock():
+        return now[0]
+
+    rng = random.Random(args.seed)
+    seed = rng.getrandbits(64)
+    one_way, jitter = args.rtt/2000, args.jitter/1000
+    a = Transport(('127.0.0.1', 0), latency=one_way, jitter=jitter, loss=args.loss, seed=rng.random(), clock=clock)
+    b = Transport(('127.0.0.1', 0), latency=one_way, jitter=jitter, loss=args.loss, seed=rng.random(), clock=clock)
+    a.peer, b.peer = b.address, a.address
+    peers = [
+        (RollbackSession(seed, 0), a, RandomMasks(rng.random())),
+        (RollbackSession(seed, 1), b, RandomMasks(rng.random())),
+    ]
+
+    # Every checksum each peer worked out, as sessions forget theirs once
+    # compared
+    checksums = [{}, {}]
+    frames = int(args.seconds/TIME_STEP)
+    start = time.perf_counter()
+    for frame in range(frames + 2*RollbackSession.MAX_ROLLBACK):
+        now[0] = frame*TIME_STEP
+        for (session, transport, player), seen in zip(peers, checksums):
+            for data, _ in transport.receive():
+                session.receive(data)
+            if frame < frames:
+                session.advance(player())
+            seen.update(session.checksums)
+            transport.send(session.packet())
+    elapsed = time.perf_counter() - start
+
+    (sa, _, _), (sb, _, _) = peers
+    ca, cb = checksums
+    common = [f for f in ca if f in cb and f < min(sa.remote_confirmed, sb.remote_confirmed)]
+    mismatched = [f for f in common if ca[f] != cb[f]]
+    print('{:.0f} s of play at {} ms RTT (+{} ms jitter), {:.0%} packet loss, in {:.2f} s'.format(
+        args.seconds, args.rtt, args.jitter, args.loss, elapsed,
+    ))
+    print('host:  ' + sa.report())
+    print('guest: ' + sb.report())
+    print('checked {} checksums, {} different'.format(len(common), len(mismatched)))
+    print('local input is shown 1 frame ({:.0f} ms) after it is read'.format(TIME_STEP*1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    host = sub.add_parser('host', help='wait for the other player to join')
+    join = sub.add_parser('join', help="join the other player's game")
+    join.add_argument('address')
+    for p in [host, join]:
+        p.add_argument('--port', type=int, default=7777)
+        p.add_argument('--latency', type=float, default=0, help='extra delay for sent packets, in ms')
+        p.add_argument('--loss', type=float, default=0, help='fraction of sent packets to drop')
+        p.set_defaults(run=play)
+
+    test = sub.add_parser('loopback', help='two simulated peers over 127.0.0.1')
+    test.add_argument('--rtt', type=float, default=100, help='round trip time, in ms')
+    test.add_argument('--jitter', type=float, default=10, help='extra random one-way delay, in ms')
+    test.add_argument('--loss', type=float, default=0.05)
+    test.add_argument('--seconds', type=float, default=120, help='game time to play')
+    test.add_argument('--seed', type=int, default=None)
+    test.set_defaults(run=loopback)
+
+    args = parser.parse_args()
+    if args.command == 'loopback':
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
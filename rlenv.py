@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batched reinforcement-learning environment over headless classic games.
+
+    env = BatchedEnv(64, seed=0)
+    obs = env.reset()
+    obs, rewards, dones, infos = env.step(actions)
+
+`actions` holds one action (see ACTIONS) per game. Games that end are
+started again right away, so `obs` is always the first observation of
+the next episode for them; the last one is in infos[i]['final_obs'].
+
+Observations are filled for all games at once from their tile bytes, and
+actions are turned into keys as one array. Running this file measures
+steps per second, against the same games stepped one environment at a
+time.
+"""
+
+
+import argparse
+import time
+
+import numpy as np
+
+from bomberman import (
+    HeadlessContext, ClassicGame, TIME_STEP,
+    TILE_FLAGS, TILE_SOLID, TILE_EXPLODABLE, TILE_POWERUP, TILE_GOAL,
+)
+
+
+ACTIONS = ['idle', 'up', 'down', 'left', 'right', 'place_bomb']
+
+# Observation planes, each a 0/1 board-sized grid. 'solid' covers walls
+# and boxes, 'box' only boxes.
+CHANNELS = [
+    'solid', 'box', 'powerup', 'goal', 'bomb', 'flame', 'enemy', 'player',
+]
+BOMB, FLAME, ENEMY, PLAYER = range(4, 8)
+
+# TILE_FLAGS as an array, to look up whole boards at once, and the flags
+# of the tile channels
+FLAGS = np.array(TILE_FLAGS, dtype=np.uint8)
+CHANNEL_FLAGS = np.array([TILE_SOLID, TILE_EXPLODABLE, TILE_POWERUP, TILE_GOAL], dtype=np.uint8).reshape(4, 1, 1)
+
+
+# A ClassicGame that keeps count of its player's deaths for the reward
+class TrainingGame(ClassicGame):
+    STATE = ClassicGame.STATE + ['deaths']
+
+    def __init__(self, *args, **kwargs):
+        self.deaths = 0
+        super().__init__(*args, **kwargs)
+
+    def player_died(self, player):
+        self.deaths += 1
+        super().player_died(player)
+
+
+class BatchedEnv:
+    # Rewards are the score gained (one enemy, Enemy.score_worth, is 50),
+    # times `score_scale`, plus `stage_reward` for every stage cleared and
+    # `death_reward` when the player dies.
+    def __init__(self, n, seed=None, frame_skip=1, max_steps=None,
+                 score_scale=1/50, stage_reward=5.0, death_reward=-5.0, **game_args):
+        self.n = n
+        self.rng = np.random.default_rng(seed)
+        self.frame_skip = frame_skip
+        self.max_steps = max_steps
+        self.score_scale = score_scale
+        self.stage_reward = stage_reward
+        self.death_reward = death_reward
+        self.game_args = game_args
+        self.contexts = [None]*n
+        self.steps = np.zeros(n, dtype=np.int64)
+        self.last = np.zeros((n, 3), dtype=np.int64)
+        self.weights = np.array([score_scale, stage_reward, death_reward])
+
+        ctx = self.new_context()
+        matrix = ctx.game.level.matrix
+        self.shape = (len(CHANNELS), matrix.height, matrix.width)
+        self.obs = np.zeros((n,) + self.shape, dtype=np.uint8)
+        # The key each action holds (0 for none)
+        controls = ctx.game.level.players[0].controls
+        self.bomb_key = controls['place_bomb']
+        self.action_keys = np.array([0] + [controls[a] for a in ACTIONS[1:]], dtype=np.int64)
+
+    def new_context(self):
+        seed = int(self.rng.integers(2**63))
+        return HeadlessContext(TrainingGame, seed=seed, **self.game_args)
+
+    def reset_one(self, i):
+        ctx = self.new_context()
+        self.contexts[i] = ctx
+        self.steps[i] = 0
+        game = ctx.game
+        self.last[i] = game.score, game.stage, game.deaths
+
+    def reset(self):
+        for i in range(self.n):
+            self.reset_one(i)
+        self.observe()
+        return self.obs.copy()
+
+    # Fills self.obs for the given games (all of them by default). The tile
+    # channels come from the tile bytes of every board looked up in FLAGS
+    # together, and the rest from one list of (game, channel, x, y) that is
+    # rounded to cells and written in one go.
+    def observe(self, envs=None):
+        rows = range(self.n) if envs is None else envs
+        at = slice(None) if envs is None else envs
+        levels = [self.contexts[i].game.level for i in rows]
+        h, w = self.shape[1:]
+        obs = self.obs
+        tiles = np.frombuffer(b''.join([lvl.matrix.tiles for lvl in levels]), dtype=np.uint8)
+        obs[at, :4] = FLAGS[tiles.reshape(-1, 1, h, w)] & CHANNEL_FLAGS != 0
+        obs[at, 4:] = 0
+
+        points = []
+        swarms = []
+        for i, lvl in zip(rows, levels):
+            points += [(i, BOMB, x, y) for x, y in lvl.bombs]
+            points += [(i, FLAME, f.pos[0], f.pos[1]) for f in lvl.flames]
+            points += [(i, ENEMY, e.pos[0], e.pos[1]) for e in lvl.enemies if e.alive]
+            player = lvl.players[0]
+            if player.alive:
+                points.append((i, PLAYER, player.pos[0], player.pos[1]))
+            swarm = lvl.swarm
+            if swarm is not None:
+                alive = swarm.alive
+                swarms.append(np.stack([
+                  np.full(alive.sum(), i), np.full(alive.sum(), ENEMY), swarm.x[alive], swarm.y[alive],
+                ], axis=1))
+        if points or swarms:
+            points = np.concatenate([np.array(points, dtype=float).reshape(-1, 4)] + swarms)
+            i, c = points[:, 0].astype(int), points[:, 1].astype(int)
+            obs[i, c, np.rint(points[:, 3]).astype(int), np.rint(points[:, 2]).astype(int)] = 1
+
+    # Holds the key of each action (releasing the others), pressing the
+    # bomb key anew for 'place_bomb', for `frame_skip` steps.
+    def step(self, actions):
+        actions = np.asarray(actions)
+        keys = self.action_keys[actions].tolist()
+        contexts = self.contexts
+        for ctx, key in zip(contexts, keys):
+            held = ctx.input.held
+            held.clear()
+            if key:
+                held.add(key)
+        for i in np.flatnonzero(actions == ACTIONS.index('place_bomb')):
+            if not contexts[i].menu.is_open:
+                contexts[i].game.handle_key(self.bomb_key)
+
+        frame_skip = self.frame_skip
+        for ctx in contexts:
+            for _ in range(frame_skip):
+                ctx.tick()
+                if ctx.menu.is_open:
+                    break
+        self.steps += 1
+
+        games = [ctx.game for ctx in contexts]
+        now = np.array([(g.score, g.stage, g.deaths) for g in games], dtype=np.int64)
+        rewards = ((now - self.last) @ self.weights).astype(np.float32)
+        self.last = now
+        game_over = np.array([ctx.menu.is_open for ctx in contexts])
+        truncated = self.steps >= self.max_steps if self.max_steps is not None else np.zeros(self.n, dtype=bool)
+        dones = game_over | truncated
+        self.observe()
+
+        infos = [{} for _ in range(self.n)]
+        ended = np.flatnonzero(dones).tolist()
+        for i in ended:
+            infos[i] = {
+                'final_obs': self.obs[i].copy(), 'score': games[i].score, 'stage': games[i].stage,
+                'steps': int(self.steps[i]), 'truncated': bool(truncated[i] and not game_over[i]),
+            }
+            self.reset_one(i)
+        if ended:
+            self.observe(ended)
+        return self.obs.copy(), rewards, dones, infos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--envs', type=int, default=64)
+    parser.add_argument('--steps', type=int, default=500)
+    parser.add_argument('--frame-skip', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    actions = rng.integers(len(ACTIONS), size=(args.steps, args.envs))
+    steps = args.envs*args.steps
+
+    env = BatchedEnv(args.envs, seed=args.seed, frame_skip=args.frame_skip)
+    env.reset()
+    episodes = 0
+    total_reward = 0.0
+    start = time.perf_counter()
+    for a in actions:
+        _, rewards, dones, _ = env.step(a)
+        episodes += dones.sum()
+        total_reward += rewards.sum()
+    batched = time.perf_counter() - start
+    print('{} env steps ({} game seconds) in {:.2f} s: {:.0f} steps/s, {:.1f} M steps/hour'.format(
+        steps, int(steps*args.frame_skip*TIME_STEP), batched, steps/batched, steps/batched*3600/1e6,
+    ))
+    print('{} episodes ended, mean reward per step {:.4f}'.format(episodes, total_reward/steps))
+
+    # The same games as environments of one game each, stepped in turn
+    envs = [BatchedEnv(1, frame_skip=args.frame_skip) for _ in range(args.envs)]
+    for e, ctx in zip(envs, env.contexts):
+        e.contexts[0] = HeadlessContext(TrainingGame, seed=ctx.game.seed)
+        e.observe()
+    start = time.perf_counter()
+    for a in actions:
+        for e, action in zip(envs, a):
+            e.step(action[None])
+    alone = time.perf_counter() - start
+    print('one env per game: {:.0f} steps/s, batched is {:.2f}x as fast'.format(steps/alone, alone/batched))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Plays many duel rounds between input policies, spread over a pool of
+processes, and reports how they went. Run from the repository root:
+
+    python selfplay.py --rounds 2000 --p1 random --p2 seeker
+"""
+
+
+import argparse
+import math
+import multiprocessing
+import random
+import statistics
+import time
+
+from bomberman import (
+    HeadlessContext, DuelGame, Bot, BotSight, Bots, BOARD_SIZE, TIME_STEP, TILE_FLAGS, TILE_EXPLODABLE,
+)
+
+
+# Holds a random movement key for a random number of ticks and now and
+# then drops a bomb.
+class RandomPolicy:
+    def __init__(self, rng, hold_ticks=(5, 40), bomb_chance=0.02):
+        self.rng = rng
+        self.hold_ticks = hold_ticks
+        self.bomb_chance = bomb_chance
+        self.key = None
+        self.ticks = 0
+
+    def hold(self, ctx, key, ticks):
+        if self.key is not None:
+            ctx.release(self.key)
+        self.key = key
+        self.ticks = ticks
+        if key is not None:
+            ctx.press(key)
+
+    def __call__(self, ctx, player, opponent):
+        if self.ticks <= 0:
+            direction = self.rng.choice(['up', 'down', 'left', 'right', None])
+            key = player.controls[direction] if direction is not None else None
+            self.hold(ctx, key, self.rng.randint(*self.hold_ticks))
+        self.ticks -= 1
+
+        bomb_key = player.controls['place_bomb']
+        ctx.release(bomb_key)
+        if self.rng.random() < self.bomb_chance:
+            ctx.press(bomb_key)
+
+
+# Never touches the keyboard
+class IdlePolicy:
+    def __init__(self, rng):
+        pass
+
+    def __call__(self, ctx, player, opponent):
+        pass
+
+
+# Walks towards the opponent and drops a bomb when the opponent is in its
+# blast or a box is in its way, if there's a way out of the blast, which
+# it then takes. Gets out of the way of any other blast coming, and
+# doesn't walk into one. The bombing and getting away go by a Bot's
+# search, with no time limit. Wanders at random (without bombing) for a
+# while when it gets stuck.
+class SeekerPolicy(RandomPolicy):
+    # Ticks between checks of whether it's getting anywhere
+    STUCK_TICKS = 10
+    AHEAD = {'up': (0, -1), 'down': (0, 1), 'left': (-1, 0), 'right': (1, 0)}
+
+    def __init__(self, rng):
+        super().__init__(rng, hold_ticks=(10, 30), bomb_chance=0)
+        self.last_pos = None
+        self.since_last_pos = 0
+        self.wandering = 0
+        self.bot = None
+
+    def __call__(self, ctx, player, opponent):
+        lvl = ctx.game.level
+        bot = self.bot
+        if bot is None or bot.level is not lvl:
+            bot = self.bot = Bot(lvl.players.index(player))
+            bot.level = lvl
+
+        stuck = False
+        self.since_last_pos -= 1
+        if self.since_last_pos <= 0:
+            if self.last_pos is not None:
+                stuck = abs(self.last_pos[0] - player.pos[0]) + abs(self.last_pos[1] - player.pos[1]) < 0.2
+            self.last_pos = list(player.pos)
+            self.since_last_pos = self.STUCK_TICKS
+
+        sight = BotSight(lvl)
+        while not sight.advance():
+            pass
+        w = lvl.matrix.width
+        x, y = Bot.cell_of(lvl, player)
+        start = y*w + x
+        danger, burning = sight.danger, sight.burning
+
+        # Taking the way out of a bomb of its own, or finding one from a
+        # blast coming its way. Half in a cell a blast is coming to, it
+        # goes back to the middle of its own.
+        if not bot.path:
+            px, py = player.pos
+            touching = {(math.floor(px), math.floor(py)), (math.ceil(px), math.ceil(py))}
+            if bot.unsafe(start, sight.now, danger, burning, stay=True):
+                plan = finish(bot.plan(lvl, player, sight))
+                if plan is not None:
+                    bot.follow(*plan)
+            elif any(bot.unsafe(j*w + i, sight.now, danger, burning, stay=True) for i, j in touching):
+                bot.follow([(x, y)])
+        ctx.release(player.controls['place_bomb'])
+        if bot.path:
+            # Going by the bot isn't getting stuck
+            self.last_pos = None
+            return self.steer(ctx, player, bot.keys(lvl, player))
+
+        if self.wandering > 0:
+            self.wandering -= 1
+            super().__call__(ctx, player, opponent)
+        else:
+            self.seek(ctx, lvl, player, opponent, stuck, start, sight)
+        # Waits for a blast ahead to be over rather than walking into it
+        ahead = {player.controls[d]: d for d in self.AHEAD}.get(self.key)
+        if ahead is not None and not bot.path:
+            dx, dy = self.AHEAD[ahead]
+            if bot.unsafe((y + dy)*w + x + dx, sight.now, danger, burning, stay=True):
+                self.hold(ctx, None, self.ticks)
+                self.last_pos = None
+
+    # Bombs the opponent if it's in the blast, or else steps towards it,
+    # along whichever way isn't blocked, bombing a box in the way
+    def seek(self, ctx, lvl, player, opponent, stuck, start, sight):
+        bot = self.bot
+        w = lvl.matrix.width
+        x, y = start % w, start // w
+        dx = opponent.pos[0] - player.pos[0]
+        dy = opponent.pos[1] - player.pos[1]
+        aligned = round(player.pos[0]) == round(opponent.pos[0]) or round(player.pos[1]) == round(opponent.pos[1])
+        in_blast = opponent.alive and aligned and abs(dx) + abs(dy) <= player.bomb_blast_radius
+        if in_blast and self.bomb(lvl, player, opponent, start, sight):
+            return self.steer(ctx, player, bot.keys(lvl, player))
+
+        across = 'right' if dx > 0 else 'left'
+        along = 'down' if dy > 0 else 'up'
+        ways = [across, along] if abs(dx) > abs(dy) else [along, across]
+        for direction in ways if not stuck else []:
+            sx, sy = self.AHEAD[direction]
+            j = (y + sy)*w + x + sx
+            if not sight.blocked[j]:
+                if self.key != player.controls[direction]:
+                    self.hold(ctx, player.controls[direction], 0)
+                return
+            if TILE_FLAGS[lvl.matrix.tiles[j]] & TILE_EXPLODABLE and self.bomb(lvl, player, opponent, start, sight):
+                return self.steer(ctx, player, bot.keys(lvl, player))
+
+        self.wandering = self.rng.randint(15, 45)
+        self.ticks = 0
+        super().__call__(ctx, player, opponent)
+
+    # Starts the bot on dropping a bomb here and getting out of its way,
+    # if there's a way out. Returns whether there is.
+    def bomb(self, lvl, player, opponent, start, sight):
+        if lvl.placed_bombs(player) >= player.max_bombs:
+            return False
+        targets = {(round(opponent.pos[0]), round(opponent.pos[1])): Bot.OPPONENT_WORTH}
+        spot = finish(self.bot.bomb_spot(
+          lvl, player, [(start, 0, sight.now)], {start: None}, sight.blocked, sight.danger, sight.burning, targets,
+        ))
+        if spot is not None:
+            self.bot.follow(*spot)
+        return spot is not None
+
+    # Holds `keys`, as given by Bot.keys()
+    def steer(self, ctx, player, keys):
+        bomb_key = player.controls['place_bomb']
+        if bomb_key in keys:
+            ctx.press(bomb_key)
+        key = next(iter(keys - {bomb_key}), None)
+        if key != self.key:
+            self.hold(ctx, key, 0)
+
+
+# Runs one of Bot's searches to the end and returns what it found
+def finish(search):
+    try:
+        while True:
+            next(search)
+    except StopIteration as done:
+        return done.value
+
+
+# The game's own computer player, searching within Bots.BUDGET every tick
+class BotPolicy:
+    def __init__(self, rng):
+        self.bots = None
+
+    def __call__(self, ctx, player, opponent):
+        if self.bots is None:
+            self.bots = Bots([Bot(ctx.game.level.players.index(player))])
+        self.bots.step(ctx.game)
+
+
+POLICIES = {
+    'random': RandomPolicy,
+    'idle': IdlePolicy,
+    'seeker': SeekerPolicy,
+    'bot': BotPolicy,
+}
+
+
+# Runs one round in a fresh game and returns (winner, ticks, sudden death)
+# where the winner is 1, 2, 0 for a draw (both players blown up at once)
+# or None for a round that hit the tick limit.
+def play_round(job):
+    seed, p1, p2, max_ticks, board_size = job
+    rng = random.Random(seed)
+    ctx = HeadlessContext(DuelGame, seed=rng.getrandbits(64), board_size=board_size)
+    policies = [POLICIES[p1](rng), POLICIES[p2](rng)]
+
+    def controller(ctx):
+        players = ctx.game.level.players
+        policies[0](ctx, players[0], players[1])
+        policies[1](ctx, players[1], players[0])
+
+    mode = ctx.run(max_ticks, controller)
+    winner = {'mp_gameover_winsp1': 1, 'mp_gameover_winsp2': 2, 'mp_gameover_draw': 0}.get(mode)
+    return winner, ctx.ticks, bool(ctx.game.sudden_death)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values)*p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=1000)
+    parser.add_argument('--p1', choices=POLICIES, default='random')
+    parser.add_argument('--p2', choices=POLICIES, default='random')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument(
+      '--max-seconds', type=float, default=600,
+      help='game seconds after which a round is given up as timed out',
+    )
+    parser.add_argument('--board', metavar='WxH', default='{}x{}'.format(*BOARD_SIZE), help='board size in cells')
+    args = parser.parse_args()
+    board_size = tuple(int(n) for n in args.board.lower().split('x'))
+
+    rng = random.Random(args.seed)
+    max_ticks = int(args.max_seconds/TIME_STEP)
+    jobs = [(rng.getrandbits(64), args.p1, args.p2, max_ticks, board_size) for _ in range(args.rounds)]
+
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.processes) as pool:
+        results = pool.map(play_round, jobs, chunksize=max(1, len(jobs)//(args.processes*8)))
+    elapsed = time.perf_counter() - start
+
+    winners = [r[0] for r in results]
+    seconds = [r[1]*TIME_STEP for r in results]
+    n = len(results)
+    print('{} rounds of {} (P1) vs {} (P2) on a {}x{} board, {} processes'.format(
+        n, args.p1, args.p2, *board_size, args.processes,
+    ))
+    print('P1 wins:       {:6.1%}'.format(winners.count(1)/n))
+    print('P2 wins:       {:6.1%}'.format(winners.count(2)/n))
+    print('draws:         {:6.1%}'.format(winners.count(0)/n))
+    print('timed out:     {:6.1%}'.format(winners.count(None)/n))
+    print('sudden death:  {:6.1%}'.format(sum(r[2] for r in results)/n))
+    print('round length:  mean {:.1f} s, median {:.1f} s, p95 {:.1f} s, max {:.1f} s'.format(
+        statistics.mean(seconds), statistics.median(seconds), percentile(seconds, 0.95), max(seconds),
+    ))
+    print('throughput:    {:.1f} rounds/s, {:.1f} rounds/s per process ({:.0f} ticks/s)'.format(
+        n/elapsed, n/elapsed/args.processes, sum(r[1] for r in results)/elapsed,
+    ))
+
+
+if __name__ == '__main__':
+    main()
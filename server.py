@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Authoritative duel server. Hosts many matches on one asyncio event loop,
+all ticked together at the game's fixed rate, and reports how long the
+ticks take. Run from the repository root:
+
+    python server.py --port 7878 --workers 4
+    python server.py --bots 300 --seconds 30
+
+Clients talk JSON, one object per line, over TCP. A client sends
+{"join": true} and gets {"match": id, "player": 0 or 1, "seed": seed} once
+an opponent is found. It then sends {"input": mask} whenever its input
+changes. The mask is a bit set of up, down, left, right and place_bomb, in
+that order. Every tick the server sends the state:
+
+    {"frame": n, "players": [[x, y, alive], ...], "bombs": [[x, y], ...],
+     "flames": [[x, y], ...], "wins": [p1, p2], "sudden_death": bool,
+     "tiles": hex (only when the board changed)}
+
+--bots fills the server with matches between random inputs, with no
+network, to measure how many matches a core can take. --clients does the
+same through real TCP connections.
+"""
+
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import time
+
+from bomberman import DuelGame, TIME_STEP
+from netplay import NetContext, RandomMasks, apply_inputs
+
+
+# One duel. Inputs are the latest masks received from the two players.
+class Match:
+    def __init__(self, id, seed):
+        self.id = id
+        self.context = NetContext()
+        self.game = DuelGame(self.context, None, seed=seed)
+        self.writers = [None, None]
+        self.inputs = [0, 0]
+        self.previous = [0, 0]
+        self.bots = None
+        self.frame = 0
+        self.tiles_version = None
+
+    def tick(self):
+        if self.bots is not None:
+            self.inputs = [bot() for bot in self.bots]
+        apply_inputs(self.context, self.game, self.inputs, self.previous)
+        self.previous = list(self.inputs)
+        self.game.loop(TIME_STEP)
+        if self.context.menu.is_open:
+            self.context.menu.is_open = False
+            self.game.play_again()
+        self.frame += 1
+
+    # The state message, encoded once for both players
+    def state(self):
+        game = self.game
+        lvl = game.level
+        state = {
+            'frame': self.frame,
+            'players': [[p.pos[0], p.pos[1], p.alive] for p in lvl.players],
+            'bombs': [list(pos) for pos in lvl.bombs],
+            'flames': [f.pos for f in lvl.flames],
+            'wins': [game.p1_wins, game.p2_wins],
+            'sudden_death': bool(game.sudden_death),
+        }
+        if lvl.matrix.version != self.tiles_version:
+            self.tiles_version = lvl.matrix.version
+            state['tiles'] = lvl.matrix.tiles.hex()
+        return (json.dumps(state, separators=(',', ':')) + '\n').encode()
+
+
+def percentiles(values, ps=(0.5, 0.95, 0.99)):
+    values = sorted(values)
+    return [values[min(len(values) - 1, int(len(values)*p))] for p in ps] + [values[-1]]
+
+
+class Server:
+    # Messages to a client that has this much unsent data are dropped
+    # rather than queued, so a slow client doesn't hold the others back.
+    MAX_BUFFERED = 64*1024
+
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+        self.matches = {}
+        self.waiting = None
+        self.next_id = 0
+        # Since the last report: time spent on each match tick and on
+        # each whole round of ticks, and rounds that ran late
+        self.match_ticks = []
+        self.rounds = []
+        self.late = 0
+
+    def new_match(self):
+        match = Match(self.next_id, self.rng.getrandbits(64))
+        self.matches[match.id] = match
+        self.next_id += 1
+        return match
+
+    def add_bots(self, n):
+        for _ in range(n):
+            match = self.new_match()
+            match.bots = [RandomMasks(self.rng.random()), RandomMasks(self.rng.random())]
+
+    async def handle_client(self, reader, writer):
+        match = player = None
+        try:
+            async for line in reader:
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(message, dict):
+                    continue
+                if 'join' in message and match is None:
+                    if self.waiting is None or self.waiting.writers[0].is_closing():
+                        match, player = self.new_match(), 0
+                        self.waiting = match
+                        # Not ticked until the opponent arrives
+                        del self.matches[match.id]
+                    else:
+                        match, player = self.waiting, 1
+                        self.waiting = None
+                        self.matches[match.id] = match
+                    match.writers[player] = writer
+                    if player == 1:
+                        for i, w in enumerate(match.writers):
+                            hello = {'match': match.id, 'player': i, 'seed': match.game.seed}
+                            w.write((json.dumps(hello) + '\n').encode())
+                elif isinstance(message.get('input'), int) and match is not None:
+                    match.inputs[player] = message['input'] & 0x1f
+        except ConnectionError:
+            pass
+        finally:
+            if match is not None:
+                self.matches.pop(match.id, None)
+                if self.waiting is match:
+                    self.waiting = None
+                for w in match.writers:
+                    if w is not None and w is not writer and not w.is_closing():
+                        w.write(b'{"end":"opponent left"}\n')
+                        w.close()
+            writer.close()
+
+    def tick(self):
+        start = time.perf_counter()
+        for match in list(self.matches.values()):
+            t = time.perf_counter()
+            match.tick()
+            self.match_ticks.append(time.perf_counter() - t)
+            if match.bots is None:
+                state = match.state()
+                for w in match.writers:
+                    if not w.is_closing() and w.transport.get_write_buffer_size() < self.MAX_BUFFERED:
+                        w.write(state)
+        self.rounds.append(time.perf_counter() - start)
+
+    # Ticks every match once per TIME_STEP. When a round of ticks runs late
+    # the next one starts right away, and the schedule is reset if it
+    # falls more than a few steps behind.
+    async def ticker(self):
+        loop = asyncio.get_running_loop()
+        due = loop.time()
+        while True:
+            self.tick()
+            due += TIME_STEP
+            now = loop.time()
+            if now > due:
+                self.late += 1
+                if now - due > 5*TIME_STEP:
+                    due = now
+            await asyncio.sleep(max(0, due - now))
+
+    def report(self, elapsed):
+        if not self.match_ticks:
+            return '{} matches, nothing ticked'.format(len(self.matches))
+        p50, p95, p99, worst = [t*1000 for t in percentiles(self.match_ticks)]
+        r50, r95, r99, rworst = [t*1000 for t in percentiles(self.rounds)]
+        mean = sum(self.match_ticks)/len(self.match_ticks)
+        line = (
+            '{} matches, {:.0f} rounds/s ({} late) | match tick ms p50 {:.3f} p95 {:.3f} p99 {:.3f} max {:.3f}'
+            ' | round ms p50 {:.2f} p95 {:.2f} p99 {:.2f} max {:.2f} | ~{:.0f} matches per core'.format(
+                len(self.matches), len(self.rounds)/elapsed, self.late,
+                p50, p95, p99, worst, r50, r95, r99, rworst, TIME_STEP/mean,
+            )
+        )
+        self.match_ticks = []
+        self.rounds = []
+        self.late = 0
+        return line
+
+    async def reporter(self, interval, prefix=''):
+        last = time.perf_counter()
+        while True:
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            print(prefix + self.report(now - last), flush=True)
+            last = now
+
+
+# Connects to the server and plays with random inputs, sent as they change
+async def random_client(host, port, seed):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b'{"join":true}\n')
+    player = RandomMasks(seed)
+    last = None
+
+    async def read_states():
+        async for line in reader:
+            pass
+
+    reading = asyncio.ensure_future(read_states())
+    try:
+        while not reading.done():
+            mask = player()
+            if mask != last:
+                writer.write(('{"input":%d}\n' % mask).encode())
+                last = mask
+            await asyncio.sleep(TIME_STEP)
+    finally:
+        reading.cancel()
+        writer.close()
+
+
+async def serve(args, worker=0):
+    server = Server(None if args.seed is None else args.seed + worker)
+    server.add_bots(args.bots)
+    tcp = await asyncio.start_server(server.handle_client, args.host, args.port, reuse_port=args.workers > 1)
+    tasks = [
+        asyncio.ensure_future(server.ticker()),
+        asyncio.ensure_future(server.reporter(args.report, '[{}] '.format(worker) if args.workers > 1 else '')),
+    ]
+    port = tcp.sockets[0].getsockname()[1]
+    for i in range(args.clients):
+        tasks.append(asyncio.ensure_future(random_client('127.0.0.1', port, i)))
+    async with tcp:
+        if args.seconds is None:
+            await tcp.serve_forever()
+        else:
+            await asyncio.sleep(args.seconds)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Lets the connections closed by the clients above wind down
+            await asyncio.sleep(0.1)
+
+
+def run_worker(args, worker):
+    asyncio.run(serve(args, worker))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=7878)
+    parser.add_argument(
+      '--workers', type=int, default=1,
+      help='server processes sharing the port (one per core), each with its own event loop',
+    )
+    parser.add_argument('--bots', type=int, default=0, help='matches between random inputs to add, per worker')
+    parser.add_argument('--clients', type=int, default=0, help='random TCP clients to connect, per worker')
+    parser.add_argument('--seconds', type=float, default=None, help='stop after this long')
+    parser.add_argument('--report', type=float, default=5, help='seconds between reports')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.workers == 1:
+        run_worker(args, 0)
+        return
+    workers = [multiprocessing.Process(target=run_worker, args=(args, i)) for i in range(args.workers)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+
+if __name__ == '__main__':
+    main()